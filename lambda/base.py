@@ -1,12 +1,69 @@
-import re, json, base64, decimal, datetime
+import re, json, time, base64, decimal, datetime, functools, threading
 
 str_to_float = lambda string: float(string)
 str_to_int = lambda string: int(string)
-is_target_file = lambda filepath, patterns: any(match_glob_pattern(filepath, pattern) for pattern in patterns)
-filter_targets = lambda filepaths, targets: [path for path in filepaths if is_target_file(path, targets)]
+is_target_file = lambda filepath, patterns: compile_targets(patterns).match(filepath)
+filter_targets = lambda filepaths, targets: compile_targets(targets).filter(filepaths)
 
-def trace(message):
-	print('Trace>', message)
+GLOB_TOKEN = re.compile(r'(\*\*/|\*\*|\*|\?)')
+GLOB_PRUNED_MAX_DIRS = 10000		# GlobMatcher记录的目录数上限，超过时清空重新记录
+
+def format_code_section(filepath, code):
+	return f'{filepath}\n```\n{code}\n```'
+
+def fill_code(prompt_data, code):
+	return { key: value.replace('{{code}}', code) if isinstance(value, str) else value for key, value in prompt_data.items() }
+
+class RateLimiter:
+	"""
+	按固定间隔放行调用的限速器，rate为每秒最多调用次数，rate <= 0 表示不限速。线程安全。
+	"""
+	def __init__(self, rate):
+		self.interval = 1.0 / rate if rate and rate > 0 else 0
+		self.next_time = 0
+		self.lock = threading.Lock()
+
+	def acquire(self):
+		if not self.interval: return
+		with self.lock:
+			now = time.monotonic()
+			wait = self.next_time - now
+			self.next_time = max(now, self.next_time) + self.interval
+		if wait > 0:
+			time.sleep(wait)
+
+class ThreadLocalResource:
+	"""
+	boto3的resource不是线程安全的。每个线程使用各自Session创建的resource，用法与boto3.resource(service_name)相同。
+	"""
+	def __init__(self, service_name):
+		self.service_name = service_name
+		self.local = threading.local()
+
+	def __getattr__(self, name):
+		resource = getattr(self.local, 'resource', None)
+		if resource is None:
+			import boto3
+			resource = self.local.resource = boto3.session.Session().resource(self.service_name)
+		return getattr(resource, name)
+
+def batch_get_items(dynamodb, table_name, keys, max_attempts=5):
+	"""
+	用BatchGetItem批量读取条目，每批最多100个键，重复的键只读取一次，未处理的键退避后重试。返回读取到的条目列表，顺序不定。
+	"""
+	keys = list({ dump_json(key): key for key in keys }.values())
+	items = []
+	for index in range(0, len(keys), 100):
+		request = { table_name: { 'Keys': keys[index:index + 100] } }
+		for attempt in range(max_attempts):
+			response = dynamodb.batch_get_item(RequestItems=request)
+			items += response.get('Responses', {}).get(table_name, [])
+			request = response.get('UnprocessedKeys') or {}
+			if not request: break
+			time.sleep(min(0.05 * 2 ** attempt, 1))
+		else:
+			raise Exception(f'Fail to get {len(request[table_name]["Keys"])} items from {table_name}.')
+	return items
 
 class CustomJsonEncoder(json.JSONEncoder):
 	def default(self, obj):
@@ -43,10 +100,70 @@ def decode_base64(base64_string):
 	string = string_bytes.decode('utf-8')
 	return string
 
+def translate_glob(pattern):
+	"""
+	把glob模式转换为正则：**/ 匹配零或多层目录，** 匹配任意字符，* 和 ? 不跨越目录。
+	模式匹配到目录时，目录下的所有文件也视为匹配。
+	"""
+	regex = []
+	for token in GLOB_TOKEN.split(pattern.strip().lstrip('/')):
+		if token == '**/':
+			regex.append('(?:.*/)?')
+		elif token == '**':
+			regex.append('.*')
+		elif token == '*':
+			regex.append('[^/]*')
+		elif token == '?':
+			regex.append('[^/]')
+		else:
+			regex.append(re.escape(token))
+	return ''.join(regex) + '(?:/.*)?'
+
+class GlobMatcher:
+	"""
+	把一组glob模式一次性编译成一个正则，以!开头的模式表示排除。
+	只有排除模式时默认包含所有文件。被排除的目录会被记录下来，其下的文件不再逐个匹配。
+	"""
+	def __init__(self, patterns):
+		patterns = [ pattern.strip() for pattern in patterns if pattern and pattern.strip() ]
+		includes = [ pattern for pattern in patterns if not pattern.startswith('!') ] or [ '**' ]
+		excludes = [ pattern[1:] for pattern in patterns if pattern.startswith('!') and pattern[1:].strip() ]
+		self.include = re.compile('|'.join(f'(?:{translate_glob(pattern)})' for pattern in includes), re.S)
+		self.exclude = re.compile('|'.join(f'(?:{translate_glob(pattern)})' for pattern in excludes), re.S) if excludes else None
+		self.pruned = {}
+
+	def is_pruned(self, directory):
+		# 目录本身匹配排除模式时，整个子树都被排除
+		if self.exclude is None or not directory: return False
+		pruned = self.pruned.get(directory)
+		if pruned is None:
+			parent = directory.rpartition('/')[0]
+			pruned = self.is_pruned(parent) or bool(self.exclude.fullmatch(directory))
+			# 匹配器按targets缓存并在调用之间复用，限制记录的目录数
+			if len(self.pruned) >= GLOB_PRUNED_MAX_DIRS:
+				self.pruned.clear()
+			self.pruned[directory] = pruned
+		return pruned
+
+	def match(self, filepath):
+		if self.exclude is not None and (self.is_pruned(filepath.rpartition('/')[0]) or self.exclude.fullmatch(filepath)):
+			return False
+		return bool(self.include.fullmatch(filepath))
+
+	def filter(self, filepaths):
+		return [ path for path in filepaths if self.match(path) ]
+
+@functools.lru_cache(maxsize=64)
+def compile_glob(patterns):
+	return GlobMatcher(patterns)
+
+def compile_targets(targets):
+	"""
+	获取targets对应的已编译匹配器，相同的targets只编译一次。
+	"""
+	if isinstance(targets, str):
+		targets = targets.split(',')
+	return compile_glob(tuple(target.strip() for target in targets if target.strip()))
+
 def match_glob_pattern(string, pattern):
-	regex = re.escape(pattern)
-	regex = regex.replace(r'\*\*', '.*')
-	regex = regex.replace(r'\*', '[^/]*')
-	regex = regex.replace(r'\?', '.')
-	match = re.match(regex, string)
-	return bool(match)
+	return compile_targets([ pattern ]).match(string)
@@ -0,0 +1,145 @@
+import os, time, decimal, threading
+import base, logger
+
+BEDROCK_LIMITER_TABLE 		= os.getenv('BEDROCK_LIMITER_TABLE')								# 为空时使用本地(单容器)限流状态
+BEDROCK_INITIAL_CONCURRENCY = base.str_to_float(os.getenv('BEDROCK_INITIAL_CONCURRENCY', '4'))	# 每个模型初始的并发上限
+BEDROCK_MIN_CONCURRENCY 	= base.str_to_float(os.getenv('BEDROCK_MIN_CONCURRENCY', '1'))
+BEDROCK_MAX_CONCURRENCY 	= base.str_to_float(os.getenv('BEDROCK_MAX_CONCURRENCY', '32'))
+BEDROCK_DECREASE_FACTOR 	= base.str_to_float(os.getenv('BEDROCK_DECREASE_FACTOR', '0.5'))	# 被限流时并发上限的乘性减小系数
+BEDROCK_SLOT_TIMEOUT 		= base.str_to_int(os.getenv('BEDROCK_SLOT_TIMEOUT', '900'))			# 超过此秒数未更新的占用视为泄漏，重置计数
+
+THROTTLING_ERROR_CODES = [ 'ThrottlingException', 'TooManyRequestsException', 'ServiceQuotaExceededException' ]
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+
+def is_throttling_error(ex):
+	# Bedrock调用异常被逐层包装，沿__cause__查找原始的ClientError
+	while ex is not None:
+		code = getattr(ex, 'response', {}).get('Error', {}).get('Code')
+		if code in THROTTLING_ERROR_CODES:
+			return True
+		ex = ex.__cause__
+	return False
+
+class LocalLimiter:
+	"""
+	进程内的AIMD并发控制器，与DynamoDBLimiter接口一致，用于本地运行和测试。
+	"""
+	def __init__(self):
+		self.states = {}
+		self.lock = threading.Lock()
+
+	def get_state(self, model):
+		return self.states.setdefault(model, dict(in_flight=0, limit=BEDROCK_INITIAL_CONCURRENCY))
+
+	def acquire(self, model):
+		with self.lock:
+			state = self.get_state(model)
+			if state['in_flight'] >= state['limit']:
+				return False
+			state['in_flight'] += 1
+			return True
+
+	def release(self, model, throttled=False):
+		with self.lock:
+			state = self.get_state(model)
+			state['in_flight'] = max(state['in_flight'] - 1, 0)
+			if throttled:
+				state['limit'] = max(state['limit'] * BEDROCK_DECREASE_FACTOR, BEDROCK_MIN_CONCURRENCY)
+			else:
+				state['limit'] = min(state['limit'] + 1 / state['limit'], BEDROCK_MAX_CONCURRENCY)
+
+	def get_limit(self, model):
+		with self.lock:
+			return self.get_state(model)['limit']
+
+class DynamoDBLimiter:
+	"""
+	以DynamoDB条件更新实现的跨Lambda并发控制器，每个模型一条记录：{ model, in_flight, limit, update_epoch }。
+	"""
+	def __init__(self, table_name):
+		self.table_name = table_name
+		self.initialized = set()
+
+	@property
+	def table(self):
+		# 每次按当前线程的resource获取Table，与except中当前线程的异常类一致
+		return dynamodb.Table(self.table_name)
+
+	def ensure_state(self, model):
+		if model in self.initialized: return
+		try:
+			self.table.put_item(
+				Item = dict(model=model, in_flight=0, limit=decimal.Decimal(str(BEDROCK_INITIAL_CONCURRENCY)), update_epoch=int(time.time())),
+				ConditionExpression = 'attribute_not_exists(#model)',
+				ExpressionAttributeNames = { '#model': 'model' },
+			)
+		except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+			pass
+		self.initialized.add(model)
+
+	def acquire(self, model):
+		self.ensure_state(model)
+		now = int(time.time())
+		try:
+			self.table.update_item(
+				Key = dict(model=model),
+				UpdateExpression = 'set in_flight = in_flight + :one, update_epoch = :now',
+				ConditionExpression = 'in_flight < #limit',
+				ExpressionAttributeNames = { '#limit': 'limit' },
+				ExpressionAttributeValues = { ':one': 1, ':now': now },
+			)
+			return True
+		except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+			pass
+
+		# 额度已满，但长时间没有任何更新，说明有占用未释放(例如Lambda超时)，重置计数
+		try:
+			self.table.update_item(
+				Key = dict(model=model),
+				UpdateExpression = 'set in_flight = :one, update_epoch = :now',
+				ConditionExpression = 'update_epoch < :stale',
+				ExpressionAttributeValues = { ':one': 1, ':now': now, ':stale': now - BEDROCK_SLOT_TIMEOUT },
+			)
+			logger.warning('Reset stale Bedrock concurrency slots.', model=model)
+			return True
+		except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+			return False
+
+	def release(self, model, throttled=False):
+		now = int(time.time())
+		try:
+			item = self.table.update_item(
+				Key = dict(model=model),
+				UpdateExpression = 'set in_flight = in_flight - :one, update_epoch = :now',
+				ConditionExpression = 'in_flight > :zero',
+				ExpressionAttributeValues = { ':one': 1, ':zero': 0, ':now': now },
+				ReturnValues = 'ALL_NEW',
+			).get('Attributes')
+		except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+			item = self.table.get_item(Key=dict(model=model)).get('Item')
+		if not item: return
+
+		# AIMD：成功时每次增加 1/limit，被限流时乘以减小系数。以旧值为条件，避免并发覆盖
+		limit = float(item.get('limit', BEDROCK_INITIAL_CONCURRENCY))
+		if throttled:
+			new_limit = max(limit * BEDROCK_DECREASE_FACTOR, BEDROCK_MIN_CONCURRENCY)
+		else:
+			new_limit = min(limit + 1 / limit, BEDROCK_MAX_CONCURRENCY)
+		if new_limit == limit: return
+		try:
+			self.table.update_item(
+				Key = dict(model=model),
+				UpdateExpression = 'set #limit = :new',
+				ConditionExpression = '#limit = :old',
+				ExpressionAttributeNames = { '#limit': 'limit' },
+				ExpressionAttributeValues = { ':new': decimal.Decimal(str(round(new_limit, 4))), ':old': item.get('limit') },
+			)
+		except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+			pass
+
+	def get_limit(self, model):
+		item = self.table.get_item(Key=dict(model=model)).get('Item') or {}
+		return float(item.get('limit', BEDROCK_INITIAL_CONCURRENCY))
+
+limiter = DynamoDBLimiter(BEDROCK_LIMITER_TABLE) if BEDROCK_LIMITER_TABLE else LocalLimiter()
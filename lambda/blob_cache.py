@@ -0,0 +1,135 @@
+import os, hashlib, threading, collections
+import boto3
+import base, logger
+
+BLOB_CACHE_BUCKET 			= os.getenv('BLOB_CACHE_BUCKET')										# 为空时只使用本地缓存
+BLOB_CACHE_PREFIX 			= os.getenv('BLOB_CACHE_PREFIX', 'blob-cache')
+BLOB_CACHE_LOCAL_DIR 		= os.getenv('BLOB_CACHE_LOCAL_DIR', '/tmp/blob-cache')
+BLOB_CACHE_LOCAL_MAX_BYTES 	= base.str_to_int(os.getenv('BLOB_CACHE_LOCAL_MAX_BYTES', str(256 * 1024 * 1024)))	# 本地缓存容量上限(字节)
+
+s3_client = boto3.client('s3')
+
+# 本地缓存索引：sha -> 字节数，按最近使用顺序排列。Lambda热启动时复用/tmp下的文件
+local_index = None
+local_size = 0
+local_lock = threading.Lock()
+
+def get_local_path(sha):
+	return os.path.join(BLOB_CACHE_LOCAL_DIR, sha)
+
+def get_s3_key(sha):
+	return f'{BLOB_CACHE_PREFIX}/{sha[:2]}/{sha}'
+
+def load_local_index():
+	global local_index, local_size
+	if local_index is not None: return
+	try:
+		os.makedirs(BLOB_CACHE_LOCAL_DIR, exist_ok=True)
+		entries = [ entry for entry in os.scandir(BLOB_CACHE_LOCAL_DIR) if entry.is_file() ]
+		entries.sort(key=lambda entry: entry.stat().st_atime)
+		local_index = collections.OrderedDict((entry.name, entry.stat().st_size) for entry in entries)
+	except OSError as ex:
+		logger.warning('Fail to load local blob cache.', error=str(ex))
+		local_index = collections.OrderedDict()
+	local_size = sum(local_index.values())
+
+def evict_local():
+	global local_size
+	while local_size > BLOB_CACHE_LOCAL_MAX_BYTES and local_index:
+		sha, size = local_index.popitem(last=False)
+		local_size -= size
+		try:
+			os.remove(get_local_path(sha))
+		except OSError:
+			pass
+
+def get_local(sha):
+	with local_lock:
+		load_local_index()
+		if sha not in local_index: return None
+		local_index.move_to_end(sha)
+	try:
+		with open(get_local_path(sha), 'rb') as f:
+			return f.read()
+	except OSError:
+		return None
+
+def put_local(sha, data):
+	"""
+	写入本地缓存。/tmp空间不足等写入失败只记录日志，不影响调用方使用已获取的内容。
+	"""
+	global local_size
+	if len(data) > BLOB_CACHE_LOCAL_MAX_BYTES: return
+	with local_lock:
+		load_local_index()
+		if sha in local_index: return
+		try:
+			with open(get_local_path(sha), 'wb') as f:
+				f.write(data)
+		except OSError as ex:
+			logger.warning('Fail to put blob to local cache.', sha=sha, error=str(ex))
+			try:
+				os.remove(get_local_path(sha))
+			except OSError:
+				pass
+			return
+		local_index[sha] = len(data)
+		local_size += len(data)
+		evict_local()
+
+def get_remote(sha):
+	if not BLOB_CACHE_BUCKET: return None
+	try:
+		response = s3_client.get_object(Bucket=BLOB_CACHE_BUCKET, Key=get_s3_key(sha))
+		return response['Body'].read()
+	except s3_client.exceptions.NoSuchKey:
+		return None
+	except Exception as ex:
+		logger.warning('Fail to get blob from cache bucket.', sha=sha, error=str(ex))
+		return None
+
+def put_remote(sha, data):
+	if not BLOB_CACHE_BUCKET: return
+	try:
+		s3_client.put_object(Bucket=BLOB_CACHE_BUCKET, Key=get_s3_key(sha), Body=data)
+	except Exception as ex:
+		logger.warning('Fail to put blob to cache bucket.', sha=sha, error=str(ex))
+
+def get_blob_id(data):
+	# 与Git相同的Blob SHA，可以与repository_tree返回的id对应
+	return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def put_blob(sha, content):
+	"""
+	把已经获取到的文件内容写入缓存，本地已有时跳过。
+	"""
+	if not sha or content is None: return
+	with local_lock:
+		load_local_index()
+		if sha in local_index: return
+	data = content.encode()
+	put_local(sha, data)
+	put_remote(sha, data)
+
+def get_blob(sha, fetch):
+	"""
+	按Git Blob SHA获取文件内容，依次查找本地缓存、S3缓存，都未命中时调用fetch()获取并回写缓存。
+	"""
+	if not sha:
+		return fetch()
+
+	data = get_local(sha)
+	if data is not None:
+		return data.decode()
+
+	data = get_remote(sha)
+	if data is not None:
+		put_local(sha, data)
+		return data.decode()
+
+	content = fetch()
+	if content is not None:
+		data = content.encode()
+		put_local(sha, data)
+		put_remote(sha, data)
+	return content
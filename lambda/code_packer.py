@@ -0,0 +1,113 @@
+import os
+import base
+
+SHARD_MAX_TOKENS 	= base.str_to_int(os.getenv('SHARD_MAX_TOKENS', '100000'))		# 单个分片代码的最大token数，需为提示词和输出预留空间
+CHARS_PER_TOKEN 	= base.str_to_float(os.getenv('CHARS_PER_TOKEN', '3'))			# 估算token数时每个token的平均字符数
+BATCH_MAX_TOKENS 	= base.str_to_int(os.getenv('BATCH_MAX_TOKENS', '20000'))		# 合并小文件时单个任务的最大token数，0表示不合并
+BATCH_SMALL_FILE_TOKENS = base.str_to_int(os.getenv('BATCH_SMALL_FILE_TOKENS', '4000'))	# 不超过此token数的文件视为小文件
+
+def estimate_tokens(text):
+	return int(len(text) / CHARS_PER_TOKEN) + 1
+
+def split_file(path, content, max_tokens):
+	"""
+	单个文件超过max_tokens时按行切分为多个片段 [(label, content), ...]。
+	"""
+	pieces, lines, start, size = [], [], 1, 0
+	for number, line in enumerate(content.split('\n'), 1):
+		tokens = estimate_tokens(line)
+		if lines and size + tokens > max_tokens:
+			pieces.append((f'{path} (lines {start}-{number - 1})', '\n'.join(lines)))
+			lines, start, size = [], number, 0
+		lines.append(line)
+		size += tokens
+	if lines:
+		pieces.append((f'{path} (lines {start}-{start + len(lines) - 1})', '\n'.join(lines)))
+	return pieces
+
+def make_units(files, max_tokens, depth=0):
+	"""
+	按目录层级递归划分打包单元：整个目录能放进一个分片时作为一个单元，否则按下一级目录继续拆分。
+	files为按路径排序的 [(path, content, tokens), ...]。
+	"""
+	groups = {}
+	for file in files:
+		key = '/'.join(file[0].split('/')[:depth + 1])
+		groups.setdefault(key, []).append(file)
+
+	units = []
+	for key, group in groups.items():
+		if sum(tokens for _, _, tokens in group) <= max_tokens:
+			units.append(group)
+		elif len(group) == 1 and group[0][0] == key:
+			path, content, _ = group[0]
+			for label, piece in split_file(path, content, max_tokens):
+				units.append([ (label, piece, estimate_tokens(base.format_code_section(label, piece))) ])
+		else:
+			units.extend(make_units(group, max_tokens, depth + 1))
+	return units
+
+def pack_shards(files, max_tokens=SHARD_MAX_TOKENS):
+	"""
+	将 [(path, content), ...] 装入若干不超过max_tokens的分片，同一目录的文件尽量放在同一个分片中。
+	"""
+	items = [ (path, content, estimate_tokens(base.format_code_section(path, content))) for path, content in sorted(files) ]
+
+	shards, shard, size = [], [], 0
+	for unit in make_units(items, max_tokens):
+		tokens = sum(tokens for _, _, tokens in unit)
+		if shard and size + tokens > max_tokens:
+			shards.append(shard)
+			shard, size = [], 0
+		shard.extend(unit)
+		size += tokens
+	if shard:
+		shards.append(shard)
+
+	return [ [ (path, content) for path, content, _ in shard ] for shard in shards ]
+
+def render_shard(shard):
+	return '\n\n'.join([ base.format_code_section(path, content) for path, content in shard ])
+
+def batch_contents(contents, max_tokens=BATCH_MAX_TOKENS, small_tokens=BATCH_SMALL_FILE_TOKENS):
+	"""
+	将多个小文件的提示词片段合并为一个，合并后的片段带有filepaths字段。max_tokens <= 0 表示不合并。
+	"""
+	if max_tokens <= 0: return contents
+
+	results, batch, size = [], [], 0
+	def flush():
+		if len(batch) == 1:
+			results.append(batch[0])
+		elif batch:
+			results.append(dict(
+				path = '<Batch of {} files>'.format(len(batch)),
+				filepaths = [ content.get('path') for content in batch ],
+				content = '\n\n'.join([ content.get('content') for content in batch ]),
+			))
+
+	for content in contents:
+		tokens = estimate_tokens(content.get('content'))
+		if tokens > small_tokens:
+			results.append(content)
+			continue
+		if batch and size + tokens > max_tokens:
+			flush()
+			batch, size = [], 0
+		batch.append(content)
+		size += tokens
+	flush()
+	return results
+
+def split_findings(findings, filepaths):
+	"""
+	按finding中的filepath字段(形如"path @ line 1-5")把合并审核的结果拆回各个文件，无法识别的归入None。
+	"""
+	groups = { filepath: [] for filepath in filepaths }
+	for finding in findings:
+		location = str(finding.get('filepath', '')) if isinstance(finding, dict) else ''
+		path = location.split('@')[0].strip()
+		if path not in groups:
+			path = next((filepath for filepath in filepaths if filepath in location), None)
+		groups.setdefault(path, []).append(finding)
+	return groups
@@ -1,4 +1,5 @@
 import datetime
+import yaml
 import gitlab_code
 
 def init_repo_context(params):
@@ -29,6 +30,30 @@ def get_project_code_text(repo_context, commit_id, targets):
 	else:
 		raise Exception(f'Code lib source({source}) is not support yet.')
 
+def get_project_code_files(repo_context, commit_id, targets):
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.get_project_code_files(repo_context.get('project'), commit_id, targets)
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
+def is_archive_enabled(repo_context):
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.GITLAB_SNAPSHOT_MODE == 'archive'
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
+def iter_project_files(repo_context, commit_id, targets):
+	"""
+	从一次下载的归档中逐个产出目标文件 (path, content)，不排序也不回退到逐个获取，调用方需要先用is_archive_enabled判断。
+	"""
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.iter_archive_files(repo_context.get('project'), commit_id, targets)
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
 def get_involved_files(repo_context, commit_id, previous_commit_id):
 	source = repo_context.get('source')
 	if source == 'gitlab':
@@ -37,10 +62,51 @@ def get_involved_files(repo_context, commit_id, previous_commit_id):
 	else:
 		raise Exception(f'Code lib source({source}) is not support yet.')
 
-def get_repository_file(repo_context, filepath, commit_id):
+def get_involved_changes(repo_context, commit_id, previous_commit_id):
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.get_involved_changes(repo_context.get('project'), previous_commit_id, commit_id)
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
+def get_repository_file(repo_context, filepath, commit_id, cached=False):
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.get_gitlab_file(repo_context.get('project'), filepath, commit_id, cached)
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
+def get_repository_blobs(repo_context, commit_id):
 	source = repo_context.get('source')
 	if source == 'gitlab':
-		return gitlab_code.get_gitlab_file(repo_context.get('project'), filepath, commit_id)
+		return gitlab_code.get_repository_blobs(repo_context.get('project'), commit_id)
 	else:
 		raise Exception(f'Code lib source({source}) is not support yet.')
-	
\ No newline at end of file
+
+def get_repository_blob(repo_context, filepath, blob_id, commit_id):
+	source = repo_context.get('source')
+	if source == 'gitlab':
+		return gitlab_code.get_gitlab_blob(repo_context.get('project'), filepath, blob_id, commit_id)
+	else:
+		raise Exception(f'Code lib source({source}) is not support yet.')
+
+def parse_target(variables):
+	target = variables.get('target')
+	if target: return target
+
+	targets = variables.get('targets')
+	if isinstance(targets, list):
+		return ', '.join(targets)
+	else:
+		return targets if targets else '**'
+
+def load_review_config(repo_context, commit_id):
+	"""
+	解析仓库中的.codereview.yaml，返回(target, variables)，variables中不再包含target(s)字段。
+	"""
+	desc = get_repository_file(repo_context, '.codereview.yaml', commit_id)
+	variables = yaml.safe_load(desc) if desc else dict()
+	target = parse_target(variables)
+	variables.pop('target', None)
+	variables.pop('targets', None)
+	return target, variables
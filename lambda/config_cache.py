@@ -0,0 +1,78 @@
+import os, time, datetime, threading
+import base, logger
+
+CONFIG_CACHE_TTL 		= base.str_to_int(os.getenv('CONFIG_CACHE_TTL', '300'))			# 配置缓存的最长有效秒数，0表示不缓存
+CONFIG_CHECK_INTERVAL 	= base.str_to_int(os.getenv('CONFIG_CHECK_INTERVAL', '30'))		# 每隔多少秒检查一次配置版本，版本变化时清空缓存
+
+# 配置版本标记与配置存放在同一张表中，使用不会出现在真实配置中的键
+VERSION_KEY = '#config_version'
+REPOSITORY_VERSION_KEY = dict(repository_url=VERSION_KEY, branch_regexp=VERSION_KEY)
+RULE_VERSION_KEY = dict(mode=VERSION_KEY, number=0)
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+
+def get_version(table_name, key):
+	item = dynamodb.Table(table_name).get_item(Key=key).get('Item')
+	return item.get('version') if item else None
+
+def bump_version(table_name, key):
+	"""
+	写入新的配置版本，各Lambda在下一次版本检查时丢弃已缓存的配置。
+	"""
+	version = str(time.time_ns())
+	dynamodb.Table(table_name).put_item(Item=dict(key, version=version, update_time=str(datetime.datetime.now())))
+	logger.info('Bumped config version.', table=table_name, version=version)
+	return version
+
+class TTLCache:
+	"""
+	进程级的缓存，在Lambda热启动的多次调用之间共享。条目超过ttl秒后重新加载；
+	提供version_loader时每隔CONFIG_CHECK_INTERVAL秒检查一次版本，版本变化时清空所有条目。线程安全。
+	"""
+	def __init__(self, name, ttl=CONFIG_CACHE_TTL, version_loader=None):
+		self.name = name
+		self.ttl = ttl
+		self.version_loader = version_loader
+		self.version = None
+		self.checked_at = None
+		self.entries = {}
+		self.lock = threading.Lock()
+
+	def check_version(self, now):
+		if self.version_loader is None: return
+		if self.checked_at is not None and now - self.checked_at < CONFIG_CHECK_INTERVAL: return
+		try:
+			version = self.version_loader()
+		except Exception as ex:
+			# 版本检查失败时保留现有缓存，由ttl兜底
+			logger.warning('Fail to check config version.', cache=self.name, error=str(ex))
+			version = self.version
+		with self.lock:
+			if version != self.version:
+				if self.entries:
+					logger.info('Config version changed, clear cache.', cache=self.name, version=version)
+				self.entries.clear()
+				self.version = version
+			self.checked_at = now
+
+	def get(self, key, loader):
+		if self.ttl <= 0:
+			return loader()
+		now = time.monotonic()
+		self.check_version(now)
+		with self.lock:
+			entry = self.entries.get(key)
+		if entry is not None and entry[1] > now:
+			return entry[0]
+		# 在锁外加载，并发的加载只会重复请求，不会互相阻塞
+		value = loader()
+		with self.lock:
+			self.entries[key] = (value, now + self.ttl)
+		return value
+
+	def invalidate(self, key=None):
+		with self.lock:
+			if key is None:
+				self.entries.clear()
+			else:
+				self.entries.pop(key, None)
@@ -1,6 +1,6 @@
-import traceback
 import json, os, re, datetime
 import boto3
+import config_cache, logger
 
 RULE_TABLE 				= os.getenv('RULE_TABLE')
 REPOSITORY_TABLE		= os.getenv('REPOSITORY_TABLE')
@@ -15,7 +15,7 @@ def process_repo_configs():
 		json_file = os.path.join(path, 'repos.json')
 		with open(json_file, 'r') as f:
 			repos = json.load(f)
-		print('Parsed repo config list: ', repos)
+		logger.info('Parsed repo config list.', count=len(repos))
 	except Exception as ex:
 		raise Exception(f'Fail to parse repo configs: {ex}') from ex
 	
@@ -31,17 +31,13 @@ def process_repo_configs():
 
 			if not errors:
 				dynamodb.Table(REPOSITORY_TABLE).put_item(Item=repo)
-				print(f'Succeed to initilize repository: {repo}')
+				logger.info('Succeed to initilize repository.', repository_url=repo.get('repository_url'), branch_regexp=repo.get('branch_regexp'))
 			else:
 				# 输出错误信息
-				print('SKIP REPOSITORY - fail to initilize repository for invalid field:', repo)
-				for error in errors:
-					print('Field({field}) invalid: {message}'.format(**error))
+				logger.warning('SKIP REPOSITORY - fail to initilize repository for invalid field.', repo=repo, errors=errors)
 				
 		except Exception as ex:
-			print('SKIP REPOSITORY - fail to initilize repository for exception:', repo)
-			print('Exception: ', ex)
-			traceback.print_exc()
+			logger.exception('SKIP REPOSITORY - fail to initilize repository for exception.', repo=repo, error=str(ex))
 	
  
 def process_rules():
@@ -52,7 +48,7 @@ def process_rules():
 		json_file = os.path.join(path, 'rules.json')
 		with open(json_file, 'r') as f:
 			rules = json.load(f)
-		print('Parsed rule list: ', rules)
+		logger.info('Parsed rule list.', count=len(rules))
 	except Exception as ex:
 		raise Exception(f'Fail to parse rules: {ex}') from ex
 	
@@ -61,10 +57,10 @@ def process_rules():
 
 			# 校验
 			errors = []
-			if rule.get('mode') not in [ 'all', 'single' ]:
+			if rule.get('mode') not in [ 'all', 'single', 'diff' ]:
 				errors.append(dict(
 					field='mode', 
-					message='Value({}) is invalid, only "all" and "single" are valid.'.format(rule.get('mode')))
+					message='Value({}) is invalid, only "all", "single" and "diff" are valid.'.format(rule.get('mode')))
 				)
 			if not rule.get('model'):
 				errors.append(dict(field='model', message='Field is not provided'))
@@ -78,24 +74,26 @@ def process_rules():
 
 			if not errors:
 				dynamodb.Table(RULE_TABLE).put_item(Item=rule)
-				print(f'Succeed to initilize rule: {rule}')
+				logger.info('Succeed to initilize rule.', mode=rule.get('mode'), number=rule.get('number'), name=rule.get('name'))
 			else:
 				# 输出错误信息
-				print('SKIP RULE - fail to initilize rule for invalid field:', rule)
-				for error in errors:
-					print('Field({field}) invalid: {message}'.format(**error))
+				logger.warning('SKIP RULE - fail to initilize rule for invalid field.', rule=rule, errors=errors)
 				
 		except Exception as ex:
-			print('Exception: ', ex)
-			traceback.print_exc()
+			logger.exception('SKIP RULE - fail to initilize rule for exception.', rule=rule, error=str(ex))
 	
 
 def lambda_handler(event, context):
 	
-	print('Event: ', event)
+	logger.start(stage='initialize')
+	logger.debug('Event.', event=event)
 
 	process_repo_configs()
 
 	process_rules()
+
+	# 通知各Lambda丢弃已缓存的仓库配置和规则
+	config_cache.bump_version(REPOSITORY_TABLE, config_cache.REPOSITORY_VERSION_KEY)
+	config_cache.bump_version(RULE_TABLE, config_cache.RULE_VERSION_KEY)
 	
 	return True
@@ -0,0 +1,298 @@
+import os, re, json, hashlib, posixpath
+from concurrent.futures import ThreadPoolExecutor
+import base, blob_cache, code_packer, codelib, config_cache, logger
+
+CONTEXT_MODES 				= [ mode.strip() for mode in os.getenv('CONTEXT_MODES', 'single').split(',') if mode.strip() ]	# 附带依赖文件作为上下文的审核模式
+CONTEXT_MAX_TOKENS 			= base.str_to_int(os.getenv('CONTEXT_MAX_TOKENS', '20000'))			# 每个文件附带的上下文的最大token数
+CONTEXT_MAX_FILES 			= base.str_to_int(os.getenv('CONTEXT_MAX_FILES', '10'))				# 每个文件最多附带的上下文文件数
+CONTEXT_FETCH_CONCURRENCY 	= base.str_to_int(os.getenv('CONTEXT_FETCH_CONCURRENCY', '8'))		# 建立索引时并发获取文件的线程数
+CONTEXT_INDEX_MAX_FILES 	= base.str_to_int(os.getenv('CONTEXT_INDEX_MAX_FILES', '20000'))	# 源文件超过此数量的仓库不建立索引
+CONTEXT_ARCHIVE_MIN_FILES 	= base.str_to_int(os.getenv('CONTEXT_ARCHIVE_MIN_FILES', '50'))		# 未缓存摘要的文件达到此数量时下载归档，否则逐个获取
+
+INDEX_VERSION = 2		# 提取规则变化时递增，使已缓存的文件摘要失效
+MAX_REFS = 500			# 每个文件记录的引用标识符的最大个数
+
+LANGUAGES = {
+	'.py': 'python',
+	'.java': 'java', '.kt': 'java',
+	'.js': 'javascript', '.jsx': 'javascript', '.mjs': 'javascript', '.cjs': 'javascript', '.ts': 'javascript', '.tsx': 'javascript',
+	'.go': 'go',
+}
+JAVASCRIPT_EXTENSIONS = [ '.ts', '.tsx', '.js', '.jsx', '.mjs', '.cjs' ]
+
+PYTHON_IMPORT 		= re.compile(r'^[ \t]*import[ \t]+([\w.]+(?:[ \t]+as[ \t]+\w+)?(?:[ \t]*,[ \t]*[\w.]+(?:[ \t]+as[ \t]+\w+)?)*)', re.M)
+PYTHON_FROM 		= re.compile(r'^[ \t]*from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+(?:\(([^)]*)\)|([\w \t,*]+))', re.M)	# 只有括号形式可以跨行
+PYTHON_DEFINE 		= re.compile(r'^(?:async[ \t]+)?(?:def|class)[ \t]+(\w+)', re.M)
+JAVA_PACKAGE 		= re.compile(r'^[ \t]*package[ \t]+([\w.]+)', re.M)
+JAVA_IMPORT 		= re.compile(r'^[ \t]*import[ \t]+(?:static[ \t]+)?([\w.]+(?:\.\*)?)', re.M)
+JAVA_DEFINE 		= re.compile(r'\b(?:class|interface|enum|record|object)[ \t]+([A-Z]\w*)')
+JAVA_TYPE_REF 		= re.compile(r'\b([A-Z]\w+)\b')
+JAVASCRIPT_IMPORT 	= re.compile(r'''(?:\bimport[ \t]+(?:[\w*{}\s,]+?[ \t]+from[ \t]+)?|\bexport[ \t]+[\w*{}\s,]+?[ \t]+from[ \t]+|\brequire[ \t]*\([ \t]*|\bimport[ \t]*\([ \t]*)['"]([^'"]+)['"]''')
+JAVASCRIPT_DEFINE 	= re.compile(r'^[ \t]*export[ \t]+(?:default[ \t]+)?(?:async[ \t]+)?(?:function\*?|class|const|let|var|interface|type|enum)[ \t]+(\w+)', re.M)
+GO_PACKAGE 			= re.compile(r'^package[ \t]+(\w+)', re.M)
+GO_IMPORT_BLOCK 	= re.compile(r'^import[ \t]*\((.*?)\)', re.M | re.S)
+GO_IMPORT_LINE 		= re.compile(r'^import[ \t]+((?:\w+[ \t]+)?"[^"]+")', re.M)
+GO_IMPORT_SPEC 		= re.compile(r'(?:(\w+)[ \t]+)?"([^"]+)"')
+GO_DEFINE 			= re.compile(r'^(?:func[ \t]+(?:\([^)]*\)[ \t]*)?|type[ \t]+|var[ \t]+|const[ \t]+)([A-Z]\w*)', re.M)
+GO_QUALIFIED_REF 	= re.compile(r'\b([a-z]\w*)\.([A-Z]\w*)')
+
+# 同一commit在热启动的多次调用之间复用索引
+index_cache = config_cache.TTLCache('dependency_index', ttl=600)
+
+def is_enabled(mode):
+	return mode in CONTEXT_MODES and CONTEXT_MAX_TOKENS > 0 and CONTEXT_MAX_FILES > 0
+
+def get_language(path):
+	return LANGUAGES.get(posixpath.splitext(path)[1].lower())
+
+def get_python_package(path):
+	return path.rsplit('/', 1)[0].split('/') if '/' in path else []
+
+def extract_python(path, content):
+	imports = []
+	for match in PYTHON_IMPORT.finditer(content):
+		for name in match.group(1).split(','):
+			imports.append([ name.split()[0] ])
+	for match in PYTHON_FROM.finditer(content):
+		module = match.group(1)
+		dots = len(module) - len(module.lstrip('.'))
+		if dots:
+			# 相对导入转换为从仓库根目录开始的模块名
+			package = get_python_package(path)
+			package = package[:len(package) - dots + 1] if dots > 1 else package
+			module = '.'.join(package + ([ module.lstrip('.') ] if module.lstrip('.') else []))
+		names = match.group(2) if match.group(2) is not None else match.group(3)
+		for name in re.sub(r'#[^\n]*', '', names).replace('\n', ',').split(','):
+			name = name.split()[0] if name.split() else ''
+			if not name: continue
+			if name == '*':
+				imports.append([ module ])
+			else:
+				imports.append([ f'{module}.{name}' if module else name, module ])
+	return dict(imports=imports, defines=PYTHON_DEFINE.findall(content))
+
+def extract_java(path, content):
+	package = JAVA_PACKAGE.search(content)
+	defines = sorted(set(JAVA_DEFINE.findall(content)))
+	refs = sorted(set(JAVA_TYPE_REF.findall(content)) - set(defines))[:MAX_REFS]
+	return dict(package=package.group(1) if package else '', imports=JAVA_IMPORT.findall(content), defines=defines, refs=refs)
+
+def extract_javascript(path, content):
+	imports = [ spec for spec in JAVASCRIPT_IMPORT.findall(content) if spec.startswith('.') or spec.startswith('/') ]
+	return dict(imports=sorted(set(imports)), defines=JAVASCRIPT_DEFINE.findall(content))
+
+def extract_go(path, content):
+	specs = []
+	for block in GO_IMPORT_BLOCK.findall(content):
+		specs.extend(GO_IMPORT_SPEC.findall(block))
+	for line in GO_IMPORT_LINE.findall(content):
+		specs.extend(GO_IMPORT_SPEC.findall(line))
+	package = GO_PACKAGE.search(content)
+	refs = sorted(set('.'.join(ref) for ref in GO_QUALIFIED_REF.findall(content)))[:MAX_REFS]
+	return dict(package=package.group(1) if package else '', imports=[ [ alias, spec ] for alias, spec in specs ], defines=sorted(set(GO_DEFINE.findall(content))), refs=refs)
+
+EXTRACTORS = dict(python=extract_python, java=extract_java, javascript=extract_javascript, go=extract_go)
+
+def extract(path, content):
+	"""
+	用正则从源文件中提取导入和定义的符号，返回可序列化的摘要。
+	"""
+	language = get_language(path)
+	summary = EXTRACTORS[language](path, content)
+	summary['language'] = language
+	return summary
+
+def get_summary_key(path, blob_id):
+	if not blob_id: return None
+	return hashlib.sha1(f'dependency-summary:{INDEX_VERSION}:{get_language(path)}:{blob_id}'.encode('utf-8')).hexdigest()
+
+def get_cached_summary(path, blob_id):
+	key = get_summary_key(path, blob_id)
+	if not key: return None
+	text = blob_cache.get_blob(key, lambda: None)
+	return json.loads(text) if text is not None else None
+
+def get_summary(repo_context, commit_id, path, blob_id):
+	"""
+	文件摘要按Blob SHA缓存，内容未变化的文件不需要重新获取和解析。
+	"""
+	key = get_summary_key(path, blob_id)
+	if not key:
+		return extract(path, codelib.get_repository_blob(repo_context, path, blob_id, commit_id) or '')
+	text = blob_cache.get_blob(key, lambda: base.dump_json(extract(path, codelib.get_repository_blob(repo_context, path, blob_id, commit_id) or '')))
+	return json.loads(text)
+
+def summarize_archive(repo_context, commit_id, targets, blobs, paths, executor):
+	"""
+	从一次下载的归档中提取paths中文件的摘要并写入缓存，代替逐个获取文件。返回{ path: summary }，归档中没有的文件不在其中。
+	"""
+	paths, summaries, writes = set(paths), {}, []
+	for path, content in codelib.iter_project_files(repo_context, commit_id, targets):
+		if path not in paths: continue
+		summaries[path] = extract(path, content)
+		key = get_summary_key(path, blobs.get(path))
+		if key:
+			writes.append(executor.submit(blob_cache.put_blob, key, base.dump_json(summaries[path])))
+	for write in writes:
+		write.result()
+	return summaries
+
+class DependencyIndex:
+	"""
+	仓库中源文件之间的导入/引用关系。dependencies[path]为path直接依赖的文件，dependents[path]为直接依赖path的文件。
+	"""
+	def __init__(self, summaries, blobs):
+		self.summaries = summaries
+		self.blobs = blobs
+		self.modules, self.classes, self.packages, self.directories = {}, {}, {}, {}
+		for path, summary in summaries.items():
+			self.add_keys(path, summary)
+		self.dependencies = { path: self.resolve(path, summary) - { path } for path, summary in summaries.items() }
+		self.dependents = { path: set() for path in summaries }
+		for path, dependencies in self.dependencies.items():
+			for dependency in dependencies:
+				self.dependents[dependency].add(path)
+
+	def add_keys(self, path, summary):
+		language = summary.get('language')
+		stem, _ = posixpath.splitext(path)
+		if language == 'python':
+			parts = stem.split('/')
+			if parts[-1] == '__init__':
+				parts = parts[:-1]
+			# 模块名可以从任意一级目录开始，兼容src等源码根目录
+			for index in range(len(parts)):
+				self.modules.setdefault('.'.join(parts[index:]), set()).add(path)
+		elif language == 'java':
+			package = summary.get('package', '')
+			for name in [ posixpath.basename(stem) ] + summary.get('defines', []):
+				self.classes.setdefault(f'{package}.{name}' if package else name, path)
+			self.packages.setdefault(package, []).append(path)
+		elif language == 'go':
+			self.directories.setdefault(posixpath.dirname(path), []).append(path)
+
+	def choose(self, importer, candidates):
+		# 同名模块有多个时选择与导入方目录最接近的
+		if not candidates: return None
+		return max(sorted(candidates), key=lambda path: len(posixpath.commonprefix([ path, importer ])))
+
+	def resolve(self, path, summary):
+		language = summary.get('language')
+		resolved = set()
+		if language == 'python':
+			for alternatives in summary.get('imports', []):
+				for module in alternatives:
+					target = self.choose(path, self.modules.get(module))
+					if target:
+						resolved.add(target)
+						break
+		elif language == 'java':
+			refs = set(summary.get('refs', []))
+			for name in summary.get('imports', []):
+				if name.endswith('.*'):
+					resolved.update(target for target in self.packages.get(name[:-2], []) if posixpath.splitext(posixpath.basename(target))[0] in refs)
+					continue
+				# 静态导入时去掉末尾的成员名
+				while name and name not in self.classes:
+					name = name.rpartition('.')[0]
+				if name:
+					resolved.add(self.classes[name])
+			# 同一个包中的类不需要导入
+			resolved.update(target for target in self.packages.get(summary.get('package', ''), []) if posixpath.splitext(posixpath.basename(target))[0] in refs)
+		elif language == 'javascript':
+			directory = posixpath.dirname(path)
+			for spec in summary.get('imports', []):
+				target = self.resolve_javascript(posixpath.normpath(posixpath.join(directory, spec)).lstrip('/'))
+				if target:
+					resolved.add(target)
+		elif language == 'go':
+			refs = {}
+			for ref in summary.get('refs', []):
+				alias, _, name = ref.partition('.')
+				refs.setdefault(alias, set()).add(name)
+			for alias, spec in summary.get('imports', []):
+				names = refs.get(alias or spec.rsplit('/', 1)[-1], set())
+				if not names: continue
+				for directory, targets in self.directories.items():
+					if directory and (spec == directory or spec.endswith('/' + directory)):
+						resolved.update(target for target in targets if names & set(self.summaries[target].get('defines', [])))
+		return resolved
+
+	def resolve_javascript(self, target):
+		stem, extension = posixpath.splitext(target)
+		candidates = [ target ] + [ target + extension for extension in JAVASCRIPT_EXTENSIONS ] + [ f'{target}/index{extension}' for extension in JAVASCRIPT_EXTENSIONS ]
+		if extension in JAVASCRIPT_EXTENSIONS:
+			# TypeScript中常以.js引用.ts文件
+			candidates += [ stem + extension for extension in JAVASCRIPT_EXTENSIONS ]
+		return next((candidate for candidate in candidates if candidate in self.summaries), None)
+
+	def get_related(self, paths):
+		"""
+		返回paths中各文件的直接依赖和直接被依赖的文件(不含paths本身)，依赖在前。
+		"""
+		related = []
+		for edges in [ self.dependencies, self.dependents ]:
+			for path in paths:
+				related += [ target for target in sorted(edges.get(path, set())) if target not in paths and target not in related ]
+		return related
+
+def build_index(repo_context, commit_id, targets):
+	blobs = codelib.get_repository_blobs(repo_context, commit_id)
+	paths = [ path for path in base.filter_targets(sorted(blobs), targets) if get_language(path) ]
+	if len(paths) > CONTEXT_INDEX_MAX_FILES:
+		logger.warning('Too many source files to build dependency index.', count=len(paths), limit=CONTEXT_INDEX_MAX_FILES)
+		return None
+
+	def lookup(path):
+		try:
+			return path, get_cached_summary(path, blobs.get(path))
+		except Exception as ex:
+			logger.warning('Fail to get cached summary for dependency index.', path=path, error=str(ex))
+			return path, None
+
+	def summarize(path):
+		try:
+			return path, get_summary(repo_context, commit_id, path, blobs.get(path))
+		except Exception as ex:
+			logger.warning('Fail to summarize file for dependency index.', path=path, error=str(ex))
+			return path, None
+
+	with ThreadPoolExecutor(max_workers=max(1, min(CONTEXT_FETCH_CONCURRENCY, len(paths)))) as executor:
+		# 先查缓存的摘要；缓存未命中的文件较多时从归档中提取，避免逐个调用Gitlab单文件API
+		summaries = dict(item for item in executor.map(lookup, paths) if item[1] is not None)
+		missing = [ path for path in paths if path not in summaries ]
+		cached = len(summaries)
+		if len(missing) >= CONTEXT_ARCHIVE_MIN_FILES and codelib.is_archive_enabled(repo_context):
+			try:
+				summaries.update(summarize_archive(repo_context, commit_id, targets, blobs, missing, executor))
+				missing = [ path for path in missing if path not in summaries ]
+			except Exception as ex:
+				logger.warning('Fail to build dependency index from repository archive, fall back to fetching files one by one.', commit_id=commit_id, error=str(ex))
+		summaries.update(item for item in executor.map(summarize, missing) if item[1] is not None)
+	index = DependencyIndex(summaries, blobs)
+	logger.info('Built dependency index.', files=len(summaries), cached=cached, edges=sum(len(dependencies) for dependencies in index.dependencies.values()))
+	return index
+
+def get_index(repo_context, commit_id, targets):
+	return index_cache.get((commit_id, tuple(targets)), lambda: build_index(repo_context, commit_id, targets))
+
+def select_context(index, repo_context, commit_id, filepaths, max_tokens=CONTEXT_MAX_TOKENS, max_files=CONTEXT_MAX_FILES):
+	"""
+	为一个提示词片段中的文件(合并审核时为多个)按依赖优先的顺序选取上下文文件 [(path, content), ...]，
+	总token数不超过max_tokens，放不下的文件跳过。片段中已有的文件不作为上下文。
+	"""
+	files, budget = [], max_tokens
+	for path in index.get_related(filepaths):
+		if len(files) >= max_files: break
+		content = codelib.get_repository_blob(repo_context, path, index.blobs.get(path), commit_id)
+		if not content: continue
+		tokens = code_packer.estimate_tokens(base.format_code_section(path, content))
+		if tokens > budget: continue
+		files.append((path, content))
+		budget -= tokens
+	return files
+
+def render_context(files):
+	if not files: return ''
+	sections = '\n\n'.join([ base.format_code_section(path, content) for path, content in files ])
+	return f'\n\nThe following files are direct dependencies or dependents of the files above, provided only as context. Do not report issues in them:\n\n{sections}'
@@ -0,0 +1,59 @@
+import os, re
+import base
+
+DIFF_CONTEXT_LINES 		= base.str_to_int(os.getenv('DIFF_CONTEXT_LINES', '20'))		# 每个hunk前后附带的上下文行数
+DIFF_EXPAND_SCOPE 		= os.getenv('DIFF_EXPAND_SCOPE', 'true').lower() == 'true'		# 是否向上扩展到所在函数/类的定义行
+DIFF_SCOPE_MAX_LINES 	= base.str_to_int(os.getenv('DIFF_SCOPE_MAX_LINES', '200'))		# 向上查找定义行的最大行数
+
+# 常见语言的函数/类定义行
+DEFINITION_PATTERN = re.compile(
+	r'^\s*('
+	r'(async\s+)?def\s|class\s|'
+	r'(export\s+)?(default\s+)?(async\s+)?function[\s*]|'
+	r'func\s|fn\s|pub\s+(async\s+)?fn\s|impl\b|interface\s|struct\s|'
+	r'((public|private|protected|static|final|abstract|synchronized|override|virtual|internal)\s+)+[\w<>\[\],\s]+\('
+	r')'
+)
+
+def find_scope_start(lines, start):
+	"""
+	从start(1起始)向上查找最近的函数/类定义行，找不到时返回start。
+	"""
+	lower = max(start - DIFF_SCOPE_MAX_LINES, 1)
+	for number in range(start, lower - 1, -1):
+		if DEFINITION_PATTERN.match(lines[number - 1]):
+			return number
+	return start
+
+def get_windows(lines, ranges):
+	"""
+	将hunk范围扩展上下文后合并为不重叠的窗口 [(start, end), ...]。
+	"""
+	windows = []
+	for start, end in sorted(ranges):
+		start = min(max(start - DIFF_CONTEXT_LINES, 1), len(lines))
+		end = min(end + DIFF_CONTEXT_LINES, len(lines))
+		if DIFF_EXPAND_SCOPE:
+			start = find_scope_start(lines, start)
+		if windows and start <= windows[-1][1] + 1:
+			windows[-1] = (min(windows[-1][0], start), max(windows[-1][1], end))
+		else:
+			windows.append((start, end))
+	return windows
+
+def make_diff_segment(filepath, code, ranges):
+	"""
+	只保留变化的hunk及其上下文，并附带行号，省略的部分以"..."表示。ranges为空时返回整个文件。
+	"""
+	lines = code.split('\n')
+	windows = get_windows(lines, ranges) if ranges else [ (1, len(lines)) ]
+	parts, previous_end = [], 0
+	for start, end in windows:
+		if start > previous_end + 1:
+			parts.append('...')
+		parts.extend('{:>6} | {}'.format(number, lines[number - 1]) for number in range(start, end + 1))
+		previous_end = end
+	if previous_end < len(lines):
+		parts.append('...')
+	text = '\n'.join(parts)
+	return base.format_code_section(filepath, text)
@@ -0,0 +1,121 @@
+import re, ast, json
+import logger
+
+# 只匹配包住整个回复的代码块，审核结果content中的代码块不受影响；输出被截断时可能没有结尾的```
+FENCE_PATTERN = re.compile(r'^```[\w+-]*[ \t]*\n(.*?)(?:\n[ \t]*```)?$', re.S)
+
+def parse_value(text):
+	"""
+	优先按JSON解析，失败时按Python字面量解析(兼容单引号、True/None等写法)，不执行任何代码。
+	"""
+	try:
+		return json.loads(text)
+	except ValueError:
+		return ast.literal_eval(text)
+
+class FindingsStream:
+	"""
+	增量解析模型输出中的JSON数组，每当数组中的一个对象完整时即返回该对象。
+	数组之前的文字以及Markdown代码块标记会被忽略；说明文字中不含对象的[...]不是审核结果，结束后继续查找下一个数组。
+	"""
+	def __init__(self):
+		self.buffer = ''
+		self.position = 0
+		self.depth = 0
+		self.started = False
+		self.in_string = None
+		self.escaped = False
+		self.object_start = None
+		self.objects = 0
+		self.empty = True
+		self.begin = None
+		self.end = None
+		self.findings = []
+
+	def feed(self, text):
+		self.buffer += text
+		found = []
+		while self.position < len(self.buffer):
+			char = self.buffer[self.position]
+			if self.in_string:
+				if self.escaped:
+					self.escaped = False
+				elif char == '\\':
+					self.escaped = True
+				elif char == self.in_string:
+					self.in_string = None
+			elif not self.started:
+				self.started = char == '['
+				if self.started:
+					self.depth, self.objects, self.empty, self.begin = 1, 0, True, self.position
+			elif self.depth > 0:
+				if self.depth == 1 and not char.isspace() and char != ']':
+					self.empty = False
+				if char in '"\'':
+					self.in_string = char
+				elif char in '[{':
+					if char == '{' and self.depth == 1:
+						self.object_start = self.position
+						self.objects += 1
+					self.depth += 1
+				elif char in ']}':
+					self.depth -= 1
+					if self.depth == 0:
+						self.end = self.position
+						if self.objects == 0 and not self.empty:
+							# 不含对象也不是空数组，例如"[2 in total]"，重新查找
+							self.started = False
+					if char == '}' and self.depth == 1 and self.object_start is not None:
+						finding = self.parse_object(self.buffer[self.object_start:self.position + 1])
+						if finding is not None:
+							found.append(finding)
+						self.object_start = None
+			self.position += 1
+		self.findings.extend(found)
+		return found
+
+	def parse_object(self, text):
+		try:
+			value = parse_value(text)
+			return value if isinstance(value, dict) else None
+		except (ValueError, SyntaxError) as ex:
+			logger.warning('Skip unparsable finding.', error=str(ex), finding=text)
+			return None
+
+	def is_complete(self):
+		return self.started and self.depth == 0
+
+def extract_findings(text):
+	"""
+	从模型输出中提取审核结果列表，兼容```json代码块、数组前后的说明文字以及被截断的输出。
+	用FindingsStream定位数组，字符串中的括号、代码块以及说明文字中的[...]不会干扰定位。
+	被截断时返回已完整的对象；完全无法识别时抛出ValueError。
+	"""
+	text = (text or '').strip()
+	match = FENCE_PATTERN.match(text)
+	if match:
+		text = match.group(1).strip()
+
+	# 只有一个对象、没有外层数组的回复
+	if text.startswith('{'):
+		try:
+			value = parse_value(text[:text.rfind('}') + 1])
+			if isinstance(value, dict):
+				return [ value ]
+		except (ValueError, SyntaxError):
+			pass
+
+	stream = FindingsStream()
+	stream.feed(text)
+	if not stream.started:
+		raise ValueError(f'Cannot find findings in reply: {text[:200]}')
+	if not stream.is_complete():
+		# 输出被截断，返回已完整的对象
+		return stream.findings
+	try:
+		value = parse_value(text[stream.begin:stream.end + 1])
+		if isinstance(value, list) and all(isinstance(item, dict) for item in value):
+			return value
+	except (ValueError, SyntaxError):
+		pass
+	return stream.findings
@@ -1,32 +1,91 @@
-import os, re, json
+import os, re, json, tarfile, tempfile, threading
+from urllib.parse import urlparse
+from concurrent.futures import ThreadPoolExecutor
 import gitlab
-import base
+import base, blob_cache, config_cache, logger
 
 DEFAULT_MODE 			= os.getenv('DEFAULT_MODE', 'all')
 DEFAULT_MODEL 			= os.getenv('DEFAULT_MODEL', 'claude3')
+GITLAB_FETCH_CONCURRENCY 	= base.str_to_int(os.getenv('GITLAB_FETCH_CONCURRENCY', '8'))	# 并发获取文件的线程数，1表示顺序获取
+GITLAB_FETCH_RATE 		= base.str_to_float(os.getenv('GITLAB_FETCH_RATE', '0'))		# 每个Gitlab Host每秒最大请求数，0表示不限制
+GITLAB_SNAPSHOT_MODE 	= os.getenv('GITLAB_SNAPSHOT_MODE', 'archive')					# 整库代码获取方式：archive(下载单个归档)或files(逐个文件获取)
+ARCHIVE_SPOOL_SIZE 		= base.str_to_int(os.getenv('ARCHIVE_SPOOL_SIZE', str(64 * 1024 * 1024)))	# 归档超过此字节数时落盘到/tmp
 
-def get_diff_files(project, from_commit_id, previous_commit_id):
-	commits = project.commits.list(ref_name=f'{from_commit_id}..{previous_commit_id}')
-	files = []
-	for commit in reversed(commits):
-		diff = commit.diff()
-		for item in diff:
-			if item['new_file']:
-				files.append(item['new_path'])
-			elif item['renamed_file']:
-				files.remove(item['old_path'])
-				files.append(item['new_path'])
-			elif item['deleted_file']:
-				files.remove(item['new_path'])
-			else:
-				files.append(item['new_path'])
-	return files
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+# Gitlab客户端及项目对象缓存，客户端内部的HTTP Session在热启动的调用之间复用连接
+client_cache = config_cache.TTLCache('gitlab_client')
+project_cache = config_cache.TTLCache('gitlab_project')
+
+def parse_hunk_ranges(diff_text):
+	"""
+	从unified diff文本中解析新文件侧的行号范围 [(start, end), ...]，纯删除的hunk记录为删除位置所在的一行。
+	"""
+	ranges = []
+	for match in re.finditer(r'^@@ -\d+(?:,\d+)? \+(\d+)(?:,(\d+))? @@', diff_text or '', flags=re.MULTILINE):
+		start = int(match.group(1))
+		count = int(match.group(2)) if match.group(2) is not None else 1
+		if count > 0:
+			ranges.append((start, start + count - 1))
+		else:
+			ranges.append((max(start, 1), max(start, 1)))
+	return ranges
+
+def get_diff_changes(project, from_commit_id, to_commit_id):
+	"""
+	一次repository_compare调用得到两个commit之间净变化的文件及其hunk范围：{ new_path: [(start, end), ...] }。
+	hunk范围为空表示diff过大被Gitlab省略，下游应按整个文件处理。
+	"""
+	compare = project.repository_compare(from_commit_id, to_commit_id)
+	changes = {}
+	for item in compare.get('diffs', []):
+		if item.get('deleted_file'): continue
+		changes[item['new_path']] = parse_hunk_ranges(item.get('diff'))
+	return changes
+
+def is_null_commit(commit_id):
+	# 新建分支的push事件中before为全0
+	return not commit_id or not commit_id.strip('0')
+
+def get_diff_changes_by_commits(project, from_commit_id, to_commit_id):
+	"""
+	逐个commit汇总净变化的文件。各commit的hunk行号无法对应到最终版本，hunk范围为空，按整个文件处理。
+	新建分支时没有可比较的起点，只取to_commit_id本身的变化。
+	"""
+	if is_null_commit(from_commit_id):
+		commits = [ project.commits.get(to_commit_id) ]
+	else:
+		commits = list(reversed(project.commits.list(ref_name=f'{from_commit_id}..{to_commit_id}', all=True)))
+	files = set()
+	for commit in commits:
+		for item in commit.diff(all=True):
+			if item['renamed_file'] or item['deleted_file']:
+				files.discard(item['old_path'])
+			if not item['deleted_file']:
+				files.add(item['new_path'])
+	return { path: [] for path in sorted(files) }
+
+def get_involved_changes(project, from_commit_id, to_commit_id):
+	"""
+	优先用repository_compare得到变化的文件及hunk范围，比较失败或新建分支时退回逐个commit汇总。
+	"""
+	if not is_null_commit(from_commit_id):
+		try:
+			return get_diff_changes(project, from_commit_id, to_commit_id)
+		except Exception as ex:
+			logger.warning('Fail to compare commits, fall back to walking commits.', from_commit_id=from_commit_id, to_commit_id=to_commit_id, error=str(ex))
+	return get_diff_changes_by_commits(project, from_commit_id, to_commit_id)
+
+def get_diff_files(project, from_commit_id, to_commit_id):
+	return sorted(get_involved_changes(project, from_commit_id, to_commit_id))
 
 def parse_gitlab_parameters(event):
 	
 	body = json.loads(event.get('body', '{}'))
 	event_type = body.get('object_kind', '').lower()
-	print(f'Received Gitlab event[{event_type}]:', base.dump_json(body))
+	logger.info('Received Gitlab event.', event_type=event_type, project=body.get('project', {}).get('path_with_namespace'))
+	logger.debug('Gitlab event body.', body=body)
 
 	headers = event.get('headers', {})
 	
@@ -42,7 +101,7 @@ def parse_gitlab_parameters(event):
 		if target_branch.startswith('refs/heads/'):
 			target_branch = target_branch[11:]
 		else:
-			print('Can\'t determine target branch for the field "ref" does not meet the expected format:', body)
+			logger.warning('Can\'t determine target branch for the field "ref" does not meet the expected format.', ref=target_branch)
 	elif event_type == 'merge_request':
 		target_branch = body.get('object_attributes', {}).get('target_branch')
 	
@@ -70,60 +129,141 @@ def parse_gitlab_parameters(event):
 			params['commit_id'] = body.get('object_attributes', {}).get('last_commit', {}).get('id')
 			params['ref'] = body.get('object_attributes', {}).get('source_branch')
 			params['username'] = body.get('user', {}).get('username')
-			print(f'The merge status is {merge_status}, it is going to invoke code review.')	
+			logger.info('The merge status is checking, it is going to invoke code review.', merge_status=merge_status)	
 		else:
 			params['commit_id'] = None
 			params['ref'] = None
 			params['username'] = None
-			print(f'The merge status is {merge_status}, it will skip code review.')	
+			logger.info('The merge status is not checking, it will skip code review.', merge_status=merge_status)	
 
 	if params.get('commit_id') is None: 
 		params['commit_id'] = ''
 
 	return params
 	
-def get_gitlab_file(project, path, ref):
+def get_gitlab_file(project, path, ref, cached=False):
 	try:
-		print(f'Try to get gitlab file in ref({ref}): {path}')
-		content = project.files.raw(file_path=path, ref=ref)
-		print(f'Got gitlab file {path} @ {ref}: {content}')
-		return content.decode()
+		logger.debug('Try to get gitlab file.', path=path, ref=ref)
+		data = project.files.raw(file_path=path, ref=ref)
+		content = data.decode()
+		if cached:
+			# 变更的文件几乎不会命中缓存，不再先取元数据；按Git Blob SHA写入缓存，供整库审核和依赖索引使用
+			blob_cache.put_blob(blob_cache.get_blob_id(data), content)
+		logger.debug('Got gitlab file.', path=path, ref=ref, size=len(content))
+		return content
 	except Exception as ex:
-		print(f'Fail to get git file {path} @ {ref}: {ex}')
+		logger.warning('Fail to get gitlab file.', path=path, ref=ref, error=str(ex))
 		return None
 
+def get_repository_blobs(project, commit_id):
+	"""
+	一次列出commit中所有文件的Blob SHA：{ path: blob_id }。
+	"""
+	items = project.repository_tree(ref=commit_id, all=True, recursive=True)
+	return { item['path']: item['id'] for item in items if item['type'] == 'blob' }
+
+def get_gitlab_blob(project, path, blob_id, ref):
+	"""
+	已知Blob SHA时直接查缓存，未命中时按限速获取文件内容。
+	"""
+	limiter = get_rate_limiter(project)
+	def fetch():
+		limiter.acquire()
+		return get_gitlab_file_content(project, path, ref)
+	return blob_cache.get_blob(blob_id, fetch)
+
 def get_gitlab_file_content(project, file_path, ref_name):
 	file_content = project.files.raw(file_path=file_path, ref=ref_name).decode()
-	print(f'File content({file_path}):', dict(path=file_path, content=file_content))
+	logger.debug('Got file content.', path=file_path, size=len(file_content))
 	return file_content
 
 
 def init_gitlab_context(repo_url, project_id, private_token):
 	try:
-		gl = gitlab.Gitlab(repo_url if repo_url else None, private_token=private_token)
-		print(f'Try to get project({project_id})')
-		project = gl.projects.get(project_id)
+		key = (repo_url or None, private_token)
+		gl = client_cache.get(key, lambda: gitlab.Gitlab(repo_url if repo_url else None, private_token=private_token))
+		logger.debug('Try to get project.', project_id=project_id)
+		project = project_cache.get(key + (str(project_id),), lambda: gl.projects.get(project_id))
 		return project
 	except Exception as ex:
 		raise Exception(f'Fail to get Gitlab project: {ex}') from ex
 	
 
-def get_project_code_text(repo_context, commit_id, targets):
-	
+def get_rate_limiter(project):
+	# 同一个Gitlab Host共享一个限速器，在Lambda热启动时复用
+	try:
+		host = urlparse(project.manager.gitlab.url).netloc
+	except Exception:
+		host = 'default'
+	with rate_limiters_lock:
+		if host not in rate_limiters:
+			rate_limiters[host] = base.RateLimiter(GITLAB_FETCH_RATE)
+		return rate_limiters[host]
+
+def iter_archive_files(project, commit_id, targets):
+	"""
+	下载commit对应的tar.gz归档，按targets过滤后逐个产出(path, content)，不调用单文件API。
+	"""
+	matcher = base.compile_targets(targets)
+	with tempfile.SpooledTemporaryFile(max_size=ARCHIVE_SPOOL_SIZE) as fp:
+		logger.debug('Try to download repository archive.', commit_id=commit_id)
+		project.repository_archive(sha=commit_id, format='tar.gz', streamed=True, action=fp.write)
+		logger.info('Downloaded repository archive.', commit_id=commit_id, size=fp.tell())
+		fp.seek(0)
+		with tarfile.open(fileobj=fp, mode='r|gz') as tar:
+			for member in tar:
+				if not member.isfile(): continue
+				# 归档中的文件都位于"{project}-{sha}/"目录下，去掉首层目录
+				parts = member.name.split('/', 1)
+				if len(parts) < 2 or not matcher.match(parts[1]): continue
+				data = tar.extractfile(member).read()
+				try:
+					yield parts[1], data.decode()
+				except UnicodeDecodeError:
+					logger.debug('Skip binary file in archive.', path=parts[1])
+
+def get_project_code_files(repo_context, commit_id, targets):
+	"""
+	获取项目中所有目标文件，返回按路径排序的 [(path, content), ...]。
+	"""
 	project = repo_context
+
+	if GITLAB_SNAPSHOT_MODE == 'archive':
+		try:
+			files = sorted(iter_archive_files(project, commit_id, targets))
+			logger.info('Scaned files in repository archive.', count=len(files), commit_id=commit_id, targets=targets)
+			return files
+		except Exception as ex:
+			logger.warning('Fail to get repository archive, fall back to fetching files one by one.', commit_id=commit_id, error=str(ex))
 	
 	# 用于存储文件路径的数组
 	items = project.repository_tree(ref=commit_id, all=True, recursive=True)
-	file_paths = base.filter_targets([ item['path'] for item in items if item['type'] == 'blob'], targets)
-	print('Scaned {} files after ext filtering in repository for commit_id({}), filters({}).'.format(len(file_paths), commit_id, targets))
+	blob_ids = { item['path']: item['id'] for item in items if item['type'] == 'blob' }
+	file_paths = sorted(base.filter_targets(list(blob_ids), targets))
+	logger.info('Scaned files after ext filtering in repository.', count=len(file_paths), commit_id=commit_id, targets=targets)
 
-	text = ''
-	for file_path in file_paths:
+	limiter = get_rate_limiter(project)
+
+	def fetch_file(file_path):
+		limiter.acquire()
+		return get_gitlab_file_content(project, file_path, commit_id)
+
+	def get_file(file_path):
 		try:
-			file_content = get_gitlab_file_content(project, file_path, commit_id)
-			section = f'{file_path}\n```\n{file_content}\n```'
-			text = '{}\n\n{}'.format(text, section) if text else section			
+			return file_path, blob_cache.get_blob(blob_ids.get(file_path), lambda: fetch_file(file_path))
 		except Exception as ex:
-			print(f'Fail to get file({file_path}) content: {ex}')
-  
-	return text
\ No newline at end of file
+			logger.warning('Fail to get file content.', path=file_path, error=str(ex))
+			return None
+
+	# 并发获取文件内容，map保证结果顺序与file_paths一致
+	if GITLAB_FETCH_CONCURRENCY > 1 and len(file_paths) > 1:
+		with ThreadPoolExecutor(max_workers=min(GITLAB_FETCH_CONCURRENCY, len(file_paths))) as executor:
+			files = list(executor.map(get_file, file_paths))
+	else:
+		files = [ get_file(file_path) for file_path in file_paths ]
+
+	return [ file for file in files if file ]
+
+def get_project_code_text(repo_context, commit_id, targets):
+	files = get_project_code_files(repo_context, commit_id, targets)
+	return '\n\n'.join([ base.format_code_section(file_path, file_content) for file_path, file_content in files ])
@@ -0,0 +1,89 @@
+import os, sys, random, datetime, threading, traceback
+import base
+
+LOG_LEVEL 				= os.getenv('LOG_LEVEL', 'INFO').upper()							# DEBUG / INFO / WARNING / ERROR
+LOG_MAX_VALUE_CHARS 	= base.str_to_int(os.getenv('LOG_MAX_VALUE_CHARS', '1000'))		# 单个字段值的最大字符数，超出部分截断
+LOG_MAX_LINE_CHARS 		= base.str_to_int(os.getenv('LOG_MAX_LINE_CHARS', '8000'))			# 单行日志的最大字符数
+LOG_DEBUG_SAMPLE_RATE 	= base.str_to_float(os.getenv('LOG_DEBUG_SAMPLE_RATE', '0'))		# 按此比例抽样，被抽中的调用输出DEBUG日志
+LOG_REDACT_KEYS 		= [ key.strip().lower() for key in os.getenv('LOG_REDACT_KEYS', 'private_token,x-gitlab-token').split(',') if key.strip() ]	# 不输出值的字段
+
+LEVELS = dict(DEBUG=10, INFO=20, WARNING=30, ERROR=40)
+
+# 每个线程独立的上下文字段(request_id、number、stage等)和抽样结果
+local = threading.local()
+
+def get_context():
+	if not hasattr(local, 'fields'):
+		local.fields = {}
+	return local.fields
+
+def start(**fields):
+	"""
+	开始处理一个新的事件：重置上下文字段，并决定本次是否输出DEBUG日志。
+	"""
+	local.fields = dict(fields)
+	local.sampled = LOG_DEBUG_SAMPLE_RATE > 0 and random.random() < LOG_DEBUG_SAMPLE_RATE
+
+def bind(**fields):
+	get_context().update({ key: value for key, value in fields.items() if value is not None })
+
+def is_enabled(level):
+	if LEVELS[level] >= LEVELS.get(LOG_LEVEL, LEVELS['INFO']):
+		return True
+	return level == 'DEBUG' and getattr(local, 'sampled', False)
+
+def truncate(value, limit=LOG_MAX_VALUE_CHARS):
+	"""
+	截断过长的字符串，容器类型逐个元素截断，并限制元素个数，敏感字段的值以***代替。
+	"""
+	if isinstance(value, str):
+		return value if len(value) <= limit else value[:limit] + f'...({len(value)} chars)'
+	if isinstance(value, bytes):
+		return f'<{len(value)} bytes>'
+	if isinstance(value, dict):
+		items = list(value.items())
+		result = { str(key): '***' if str(key).lower() in LOG_REDACT_KEYS else truncate(item, limit) for key, item in items[:50] }
+		if len(items) > 50:
+			result['...'] = f'{len(items)} keys'
+		return result
+	if isinstance(value, (list, tuple, set)):
+		items = list(value)
+		result = [ truncate(item, limit) for item in items[:50] ]
+		if len(items) > 50:
+			result.append(f'...({len(items)} items)')
+		return result
+	if value is None or isinstance(value, (bool, int, float)):
+		return value
+	return truncate(str(value), limit)
+
+def write(level, message, fields):
+	record = dict(level=level, time=datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'), message=truncate(str(message)))
+	record.update(truncate(get_context()))
+	record.update(truncate(fields))
+	try:
+		line = base.dump_json(record)
+	except Exception:
+		line = base.dump_json(truncate({ key: str(value) for key, value in record.items() }))
+	if len(line) > LOG_MAX_LINE_CHARS:
+		line = base.dump_json(dict(level=level, time=record['time'], message=record['message'], truncated=line[:LOG_MAX_LINE_CHARS]))
+	sys.stdout.write(line + '\n')
+
+def debug(message, **fields):
+	if is_enabled('DEBUG'): write('DEBUG', message, fields)
+
+def info(message, **fields):
+	if is_enabled('INFO'): write('INFO', message, fields)
+
+def warning(message, **fields):
+	if is_enabled('WARNING'): write('WARNING', message, fields)
+
+def error(message, **fields):
+	if is_enabled('ERROR'): write('ERROR', message, fields)
+
+def exception(message, **fields):
+	"""
+	输出ERROR日志，并附带当前异常的调用栈。
+	"""
+	if is_enabled('ERROR'):
+		fields['traceback'] = traceback.format_exc()[-LOG_MAX_VALUE_CHARS:]
+		write('ERROR', message, fields)
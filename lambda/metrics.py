@@ -0,0 +1,110 @@
+import os, sys, time, threading, contextlib
+from botocore.exceptions import ClientError
+import base, logger
+
+METRICS_ENABLED 	= os.getenv('METRICS_ENABLED', 'true').lower() == 'true'
+METRICS_NAMESPACE 	= os.getenv('METRICS_NAMESPACE', 'CodeReviewer')
+REQUEST_TABLE 		= os.getenv('REQUEST_TABLE')
+
+# 指标名以单位结尾，其余视为次数
+UNITS = [ ('_ms', 'Milliseconds'), ('_bytes', 'Bytes'), ('_tokens', 'Count') ]
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+
+def get_unit(name):
+	return next((unit for suffix, unit in UNITS if name.endswith(suffix)), 'Count')
+
+class Metrics:
+	"""
+	收集一个处理阶段(webhook、dispatch、review、report)的耗时和计数。
+	flush时以CloudWatch EMF格式输出一行日志，并把各项数值累加到请求记录的metrics字段中。
+	"""
+	def __init__(self, stage, **dimensions):
+		self.stage = stage
+		self.dimensions = { key: str(value) for key, value in dimensions.items() if value is not None }
+		self.values = {}
+		self.lock = threading.Lock()
+		self.start_time = time.perf_counter()
+
+	def add(self, name, value):
+		if not value: return
+		with self.lock:
+			self.values[name] = self.values.get(name, 0) + int(value)
+
+	@contextlib.contextmanager
+	def timer(self, name):
+		start = time.perf_counter()
+		try:
+			yield
+		finally:
+			self.add(name + '_ms', (time.perf_counter() - start) * 1000)
+
+	def add_usage(self, usage):
+		# Bedrock返回的token用量
+		usage = usage or {}
+		self.add('input_tokens', usage.get('input_tokens', 0))
+		self.add('output_tokens', usage.get('output_tokens', 0))
+		self.add('cache_read_tokens', usage.get('cache_read_input_tokens', 0))
+		self.add('cache_write_tokens', usage.get('cache_creation_input_tokens', 0))
+
+	def emit(self, **properties):
+		names = sorted(self.values)
+		record = {
+			'_aws': {
+				'Timestamp': int(time.time() * 1000),
+				'CloudWatchMetrics': [ {
+					'Namespace': METRICS_NAMESPACE,
+					'Dimensions': [ [ 'stage' ] + sorted(self.dimensions) ],
+					'Metrics': [ dict(Name=name, Unit=get_unit(name)) for name in names ],
+				} ],
+			},
+			'stage': self.stage,
+		}
+		record.update(self.dimensions)
+		record.update({ key: value for key, value in properties.items() if value is not None })
+		record.update(self.values)
+		sys.stdout.write(base.dump_json(record) + '\n')
+
+	def save(self, commit_id, request_id):
+		# ADD是原子累加，同一请求的多个子任务可以并发写入
+		names, values, actions = { '#metrics': 'metrics' }, {}, []
+		for index, name in enumerate(sorted(self.values)):
+			names[f'#n{index}'] = name
+			values[f':v{index}'] = self.values[name]
+			actions.append(f'#metrics.#n{index} :v{index}')
+		table = dynamodb.Table(REQUEST_TABLE)
+		update = lambda: table.update_item(
+			Key = dict(commit_id=commit_id, request_id=request_id),
+			UpdateExpression = 'add ' + ', '.join(actions),
+			ExpressionAttributeNames = names,
+			ExpressionAttributeValues = values,
+		)
+		try:
+			update()
+		except ClientError as ex:
+			# 旧的请求记录没有metrics字段，先创建空的字段再累加；记录不存在时不创建
+			if ex.response.get('Error', {}).get('Code') != 'ValidationException': raise
+			try:
+				table.update_item(
+					Key = dict(commit_id=commit_id, request_id=request_id),
+					UpdateExpression = 'set #metrics = :empty',
+					ConditionExpression = 'attribute_exists(commit_id) and attribute_not_exists(#metrics)',
+					ExpressionAttributeNames = { '#metrics': 'metrics' },
+					ExpressionAttributeValues = { ':empty': {} },
+				)
+			except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+				pass
+			update()
+
+	def flush(self, commit_id=None, request_id=None):
+		"""
+		记录本阶段的总耗时，输出EMF并保存到请求记录。指标失败不影响业务流程。
+		"""
+		if not METRICS_ENABLED: return
+		self.add(self.stage + '_ms', (time.perf_counter() - self.start_time) * 1000)
+		try:
+			self.emit(commit_id=commit_id, request_id=request_id)
+			if REQUEST_TABLE and commit_id and request_id:
+				self.save(commit_id, request_id)
+		except Exception as ex:
+			logger.warning('Fail to flush metrics.', stage=self.stage, error=str(ex))
@@ -0,0 +1,47 @@
+import os, gzip, hashlib, functools, threading
+import boto3
+import base, logger
+
+PAYLOAD_BUCKET 			= os.getenv('PAYLOAD_BUCKET')											# 为空时不使用Claim-Check，提示词直接放在SQS消息中
+PAYLOAD_PREFIX 			= os.getenv('PAYLOAD_PREFIX', 'payloads')
+PAYLOAD_MIN_BYTES 		= base.str_to_int(os.getenv('PAYLOAD_MIN_BYTES', str(64 * 1024)))		# 超过此字节数的代码块存入S3
+PAYLOAD_CACHE_SIZE 		= base.str_to_int(os.getenv('PAYLOAD_CACHE_SIZE', '16'))				# 执行端在内存中缓存的Payload个数
+
+s3_client = boto3.client('s3')
+
+# 本进程已上传的Payload，同一个请求中相同的代码块只上传一次
+uploaded_keys = set()
+uploaded_lock = threading.Lock()
+
+def is_enabled():
+	return bool(PAYLOAD_BUCKET)
+
+def should_offload(text):
+	return is_enabled() and len(text.encode('utf-8')) > PAYLOAD_MIN_BYTES
+
+def put_payload(request_id, text):
+	"""
+	将文本压缩后按内容哈希存入S3，返回引用 { key, sha256 }。
+	"""
+	data = text.encode('utf-8')
+	sha256 = hashlib.sha256(data).hexdigest()
+	key = f'{PAYLOAD_PREFIX}/{request_id}/{sha256}.gz'
+	with uploaded_lock:
+		if key in uploaded_keys:
+			return dict(key=key, sha256=sha256)
+	s3_client.put_object(Bucket=PAYLOAD_BUCKET, Key=key, Body=gzip.compress(data), ContentType='text/plain', ContentEncoding='gzip')
+	with uploaded_lock:
+		uploaded_keys.add(key)
+	logger.info('Payload is stored.', bucket=PAYLOAD_BUCKET, key=key, size=len(data))
+	return dict(key=key, sha256=sha256)
+
+@functools.lru_cache(maxsize=PAYLOAD_CACHE_SIZE)
+def load_payload(key, sha256):
+	response = s3_client.get_object(Bucket=PAYLOAD_BUCKET, Key=key)
+	data = gzip.decompress(response['Body'].read())
+	if hashlib.sha256(data).hexdigest() != sha256:
+		raise Exception(f'Payload s3://{PAYLOAD_BUCKET}/{key} does not match its hash.')
+	return data.decode('utf-8')
+
+def get_payload(ref):
+	return load_payload(ref.get('key'), ref.get('sha256'))
@@ -0,0 +1,38 @@
+import re, hashlib, threading
+
+PLACEHOLDER_PATTERN = re.compile(r'\{\{(\w+)\}\}')
+
+# 已编译的模板，按模板文本的哈希缓存，在Lambda热启动时复用
+compiled_templates = {}
+compiled_lock = threading.Lock()
+
+class PromptTemplate:
+	"""
+	将含有{{var}}占位符的提示词解析一次，渲染时只做一次join。
+	parts中偶数位为普通文本，奇数位为变量名。
+	"""
+	def __init__(self, text):
+		self.parts = PLACEHOLDER_PATTERN.split(text or '')
+		self.names = set(self.parts[1::2])
+
+	def render(self, values, keep=()):
+		"""
+		values中没有的变量以及keep中的变量保留原占位符。
+		"""
+		output = []
+		for index, part in enumerate(self.parts):
+			if index % 2 == 0:
+				output.append(part)
+			elif part in values and part not in keep:
+				output.append(values[part])
+			else:
+				output.append('{{' + part + '}}')
+		return ''.join(output)
+
+def compile_template(text):
+	key = hashlib.sha256((text or '').encode('utf-8')).hexdigest()
+	with compiled_lock:
+		template = compiled_templates.get(key)
+		if template is None:
+			template = compiled_templates[key] = PromptTemplate(text)
+		return template
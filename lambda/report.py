@@ -1,10 +1,22 @@
-import re, os, json, datetime, traceback
-import base
+import re, os, json, datetime
+import base, code_packer, logger, metrics
 import boto3
 
 get_s3_object = lambda s3, bucket, key: s3.Object(bucket, key).get()['Body'].read().decode('utf-8')
 put_s3_object = lambda s3, bucket, key, text, content_type: s3.Object(bucket, key).put(Body=text, ContentType=content_type)
 
+def make_task_result(commit_id, request_id, rule, findings, timestamp, filepaths=None):
+	"""
+	组装单个任务保存到Task表的结果。合并审核多个文件的任务按filepath拆分为多条结果。
+	"""
+	if not filepaths or not isinstance(findings, list):
+		return dict(commit_id=commit_id, request_id=request_id, rule=rule, content=findings, timestamp=timestamp)
+	groups = code_packer.split_findings(findings, filepaths)
+	return [
+		dict(commit_id=commit_id, request_id=request_id, rule=rule, filepath=filepath, content=items, timestamp=timestamp)
+		for filepath, items in groups.items() if items
+	]
+
 def get_json_directory(project_name, mode, commit_id):
 	name = re.sub(r'[^a-zA-Z0-9]+', '_', project_name.lower())
 	name = re.sub(r'^_+|_+$', '', name)
@@ -24,9 +36,11 @@ def generate_report_content(mode, project_name, data):
 		title = f'{project_name}代码审核报告(整库审核版)'
 	elif mode == 'single':
 		title = f'{project_name}代码审核报告(单文件审核版)'
+	elif mode == 'diff':
+		title = f'{project_name}代码审核报告(差异审核版)'
 	else:
 		title = f'{project_name}代码审核报告'
-		print(f'Mode({mode}) is invalid.')
+		logger.warning('Mode is invalid.', mode=mode)
 	subtitle = f'检测时间: {datetime_str}'
 
 	# 替换数据
@@ -38,20 +52,47 @@ def generate_report_content(mode, project_name, data):
 	const data = {all_data_text};
 	</script>
 	"""
-	print('Replacement:', dict(placement=replacement))
 	content = re.sub(r'<script id="diy">.*?</script>', replacement, content, flags=re.DOTALL)
-	print('New Content:', dict(content=content))
+	logger.debug('Report content is generated.', size=len(content))
 
 	return title, subtitle, content
 
+def merge_results(results):
+	"""
+	将同一规则(及文件)的多个任务(例如整库审核的多个分片)合并为一条结果，并去除重复的问题。
+	"""
+	merged = {}
+	for result in results:
+		if not isinstance(result, dict): continue
+		content = result.get('content')
+		content = content if isinstance(content, list) else [ content ]
+		key = (result.get('rule'), result.get('filepath'))
+		if key not in merged:
+			merged[key] = dict(result, content=[])
+		issues = merged[key]['content']
+		for issue in content:
+			if issue not in issues:
+				issues.append(issue)
+	return list(merged.values())
+
 def generate_report(record, event, context, clients):
 
 	commit_id = event.get('commit_id')
 	request_id = event.get('request_id')
 	mode = event.get('mode')
 
-	label = f'request record(commit_id={commit_id}, request_id={request_id})'
-	print(f'Generating report for {label}.')
+	logger.info('Generating report.', commit_id=commit_id, request_id=request_id)
+	report_metrics = metrics.Metrics('report', project=context.get('project_name'), mode=mode)
+	try:
+		return write_report(event, context, clients, report_metrics)
+	finally:
+		report_metrics.flush(commit_id, request_id)
+
+def write_report(event, context, clients, report_metrics):
+
+	commit_id = event.get('commit_id')
+	request_id = event.get('request_id')
+	mode = event.get('mode')
 
 	project_name = context.get('project_name')
 	directory = get_json_directory(project_name, request_id, commit_id)
@@ -59,39 +100,43 @@ def generate_report(record, event, context, clients):
 	# 写入data.js文件
 	dynamodb = clients.get('dynamodb')
 	TASK_TABLE = os.getenv('TASK_TABLE')
-	items = dynamodb.Table(TASK_TABLE).query(
-		KeyConditionExpression='request_id=:rid',
-		ExpressionAttributeValues={ ':rid': request_id }
-	)
+	with report_metrics.timer('report_query'):
+		items = dynamodb.Table(TASK_TABLE).query(
+			KeyConditionExpression='request_id=:rid',
+			ExpressionAttributeValues={ ':rid': request_id }
+		)
 	ret = [ item for item in items.get('Items') ]
 	all_data = []
 	for item in items.get('Items'):
 		try:
 			if item.get('succ') == True:
-				print('Found successful result for task(request_id={request_id}, number={number}): {result}'.format(**item))
+				logger.debug('Found successful result for task.', number=item.get('number'), result=item.get('result'))
 				json_data = json.loads(item.get('result'))
-				print('Parsed JSON data: ', json_data)
 				if type(json_data) is list:
 					all_data = all_data + json_data
 				else:
 					all_data.append(json_data)
 			else:
-				print('Found failed result for task(request_id={request_id}, number={number}).')
+				logger.info('Found failed result for task.', number=item.get('number'))
 		except Exception as ex:
-			print('Tail to get result for task:', ex)
-			traceback.print_exc()
-	print('Got all data: ', all_data)
+			logger.exception('Fail to get result for task.', number=item.get('number'), error=str(ex))
+	all_data = merge_results(all_data)
+	logger.info('Got all data.', count=len(all_data))
 
 	# 写入HTML文件
-	title, subtitle, content = generate_report_content(mode, project_name, all_data)
+	with report_metrics.timer('report_render'):
+		title, subtitle, content = generate_report_content(mode, project_name, all_data)
 	s3 = clients.get('s3')
 	BUCKET_NAME = os.getenv('BUCKET_NAME')
 	key = f'{directory}/index.html'
-	put_s3_object(s3, BUCKET_NAME, key, content, 'Content-Type: text/html')
-	print(f'Report is created to s3://{BUCKET_NAME}/{key}')
+	with report_metrics.timer('report_upload'):
+		put_s3_object(s3, BUCKET_NAME, key, content, 'Content-Type: text/html')
+	report_metrics.add('report_bytes', len(content.encode('utf-8')))
+	report_metrics.add('report_findings', sum(len(result.get('content', [])) for result in all_data))
+	logger.info('Report is created.', bucket=BUCKET_NAME, key=key)
 	
 	# 为index.html产生Presign URL
 	presigned_url = s3.Object(BUCKET_NAME, key).meta.client.generate_presigned_url('get_object', Params={'Bucket': BUCKET_NAME, 'Key': key}, ExpiresIn=3600 * 24 * 30)
-	print(f'Report URL:', presigned_url)
+	logger.debug('Report URL is generated.', url=presigned_url)
 
 	return dict(title=title, subtitle=subtitle, url=presigned_url, data=all_data)
@@ -1,5 +1,5 @@
 import os, re, json
-import base
+import logger
 import smtplib
 from email.mime.text import MIMEText
 from email.mime.multipart import MIMEMultipart
@@ -104,19 +104,20 @@ def send_mail(message):
 	with smtplib.SMTP_SSL(smtp_server, smtp_port) as server:
 		server.login(smtp_username, smtp_password)
 		server.send_message(msg)
-		print(f'Report is sent to mail {report_receiver}:', msg['Subject'])
+		logger.info('Report is sent to mail.', receiver=report_receiver, subject=msg['Subject'])
 
 def lambda_handler(event, context):
 	
-	print('Event:', base.dump_json(event))
+	logger.start()
+	logger.debug('Event.', event=event)
 
 	for record in event.get('Records'):
 		sns_message = record.get('Sns')
 		if sns_message:
 			subject = sns_message.get('Subject')
-			print(f'Got SNS subject: {subject}')
+			logger.info('Got SNS subject.', subject=subject)
 			message = sns_message.get('Message')
-			print(f'Got SNS message: {message}')
+			logger.debug('Got SNS message.', sns_message=message)
 			
 			# 发送邮件
 			send_mail(message)
@@ -0,0 +1,118 @@
+import os, time, datetime
+import base, config_cache, logger
+
+REQUEST_TABLE 			= os.getenv('REQUEST_TABLE')
+RULE_TABLE 				= os.getenv('RULE_TABLE')
+REQUEST_DEDUPE_SECONDS 	= base.str_to_int(os.getenv('REQUEST_DEDUPE_SECONDS', '86400'))	# 此时间内相同(项目、commit、mode、规则版本、single/diff模式的previous_commit_id)的事件合并到已有请求，0表示不去重
+SUPERSEDE_ENABLED 		= os.getenv('SUPERSEDE_ENABLED', 'true').lower() == 'true'			# 同一分支有更新的commit时跳过旧请求中尚未执行的任务
+SUPERSEDE_CHECK_TTL 	= base.str_to_int(os.getenv('SUPERSEDE_CHECK_TTL', '10'))			# 分支最新请求的缓存秒数
+MARKER_TTL_DAYS 		= base.str_to_int(os.getenv('MARKER_TTL_DAYS', '7'))				# 去重、投递和分支记录的保留天数，过期后由DynamoDB TTL(expire_time)删除
+
+# 去重和分支最新请求的记录与请求记录存放在同一张表中，request_id以#开头，不会与真实请求冲突
+REVIEW_PREFIX 	= '#review#'
+BRANCH_PREFIX 	= '#branch#'
+HEAD_KEY 		= '#head'
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+
+rule_version_cache = config_cache.TTLCache('rule_version', ttl=config_cache.CONFIG_CHECK_INTERVAL)
+branch_head_cache = config_cache.TTLCache('branch_head', ttl=SUPERSEDE_CHECK_TTL)
+
+def get_expire_time(seconds=0):
+	"""
+	以#开头的记录的过期时间(epoch秒)，至少保留seconds秒。
+	"""
+	return int(time.time()) + max(seconds, MARKER_TTL_DAYS * 24 * 3600)
+
+def get_rules_version():
+	if not RULE_TABLE: return 'none'
+	return rule_version_cache.get('version', lambda: config_cache.get_version(RULE_TABLE, config_cache.RULE_VERSION_KEY)) or 'none'
+
+def get_review_key(params):
+	parts = [ str(params.get('project_id')), params['mode'], str(get_rules_version()) ]
+	# single和diff模式审核的是previous_commit_id..commit_id的变更，相同commit在不同分支上的变更范围可能不同
+	if params['mode'] in [ 'single', 'diff' ]:
+		parts.append(str(params.get('previous_commit_id')))
+	return dict(commit_id=params['commit_id'], request_id=REVIEW_PREFIX + '#'.join(parts))
+
+def register_review(params, current_time):
+	"""
+	以(项目、commit、mode、规则版本，single/diff模式还包括previous_commit_id)登记一次审核。没有重复时返回None，
+	否则返回已有请求的request_id，重复的事件直接合并到该请求。
+	"""
+	if REQUEST_DEDUPE_SECONDS <= 0: return None
+	table = dynamodb.Table(REQUEST_TABLE)
+	key = get_review_key(params)
+	expired_time = str(current_time - datetime.timedelta(seconds=REQUEST_DEDUPE_SECONDS))
+	try:
+		# 不存在或已过期时登记为当前请求
+		table.put_item(
+			Item = dict(key, target_request_id=params['request_id'], create_time=str(current_time), expire_time=get_expire_time(REQUEST_DEDUPE_SECONDS)),
+			ConditionExpression = 'attribute_not_exists(request_id) or create_time < :e or target_request_id = :r',
+			ExpressionAttributeValues = { ':e': expired_time, ':r': params['request_id'] },
+		)
+		return None
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		item = table.get_item(Key=key, ConsistentRead=True).get('Item') or {}
+		return item.get('target_request_id')
+
+def release_review(params):
+	"""
+	请求失败或被取代时删除其登记，之后相同的事件可以重新发起审核。登记已属于其他请求时不删除。
+	"""
+	if REQUEST_DEDUPE_SECONDS <= 0: return
+	try:
+		dynamodb.Table(REQUEST_TABLE).delete_item(
+			Key = get_review_key(params),
+			ConditionExpression = 'target_request_id = :r',
+			ExpressionAttributeValues = { ':r': params['request_id'] },
+		)
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		pass
+
+def get_branch_key(context):
+	if not context.get('ref') or not context.get('project_id'): return None
+	return dict(
+		commit_id = BRANCH_PREFIX + '#'.join([ str(context.get('project_id')), str(context.get('event_type')), str(context.get('ref')) ]),
+		request_id = HEAD_KEY,
+	)
+
+def set_branch_head(params, current_time):
+	"""
+	把请求记为分支的最新请求。Webhook乱序到达时，较早的请求不会覆盖较新的请求。
+	"""
+	key = get_branch_key(params)
+	if not SUPERSEDE_ENABLED or key is None: return
+	try:
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = key,
+			UpdateExpression = 'set latest_request_id = :r, latest_commit_id = :c, latest_time = :t, expire_time = :x',
+			ConditionExpression = 'attribute_not_exists(latest_time) or latest_time < :t',
+			ExpressionAttributeValues = { ':r': params['request_id'], ':c': params['commit_id'], ':t': str(current_time), ':x': get_expire_time() },
+		)
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		logger.info('A newer request is already registered for the branch.', ref=params.get('ref'))
+
+def get_branch_head(context):
+	key = get_branch_key(context)
+	if key is None: return None
+	return branch_head_cache.get(key['commit_id'], lambda: dynamodb.Table(REQUEST_TABLE).get_item(Key=key).get('Item'))
+
+def get_superseding_request(context, request_id):
+	"""
+	同一分支有更新的请求时返回该请求的request_id，否则返回None。检查失败时视为未被取代。
+	"""
+	if not SUPERSEDE_ENABLED or not request_id: return None
+	try:
+		head = get_branch_head(context)
+	except Exception as ex:
+		logger.warning('Fail to get the latest request for the branch.', error=str(ex))
+		return None
+	if not head or head.get('latest_request_id') in [ None, request_id ]:
+		return None
+	# 缓存的最新请求可能已经过时，只有登记时间晚于当前请求的才算取代；同一commit的请求不视为被取代
+	if not context.get('create_time') or not head.get('latest_time') or head.get('latest_time') <= context.get('create_time'):
+		return None
+	if head.get('latest_commit_id') == context.get('commit_id'):
+		return None
+	return head.get('latest_request_id')
@@ -1,117 +1,192 @@
-import traceback
-import json, os, re, datetime
-import boto3, base, yaml
-import codelib
+import os, re, hashlib, datetime
+import boto3, base
+import codelib, config_cache, request_dedupe, logger, metrics
 
 REQUEST_TABLE 				= os.getenv('REQUEST_TABLE')
 REPOSITORY_TABLE 			= os.getenv('REPOSITORY_TABLE')
 TASK_DISPATCHER_FUN_NAME 	= os.getenv('TASK_DISPATCHER_FUN_NAME')
+WEBHOOK_FAST_PATH 			= os.getenv('WEBHOOK_FAST_PATH', 'true').lower() == 'true'	# 只保存最小的请求记录即应答，.codereview.yaml等在task_dispatcher中解析
+DELIVERY_PREFIX 			= '#delivery#'		# 记录Webhook投递的请求记录的request_id前缀，用于对Gitlab重试的投递去重
 	
 dynamodb = boto3.resource('dynamodb')
 lambda_client = boto3.client('lambda')
 sqs_client = boto3.client('sqs')
 
-def parse_target(variables):
-	target = variables.get('target')
-	if target: return target
+# 仓库配置缓存：{ repository_url: [ (编译后的branch_regexp, record), ... ] }
+repository_cache = config_cache.TTLCache('repository', version_loader=lambda: config_cache.get_version(REPOSITORY_TABLE, config_cache.REPOSITORY_VERSION_KEY))
 
-	targets = variables.get('targets')
-	if isinstance(targets, list):
-		return ', '.join(targets)
-	else:
-		return targets if targets else '**'
-	
-def parse_process_mode(params):
-	
-	web_url = params.get('web_url')
-	target_branch = params.get('target_branch')
-	event_type = params.get('event_type')
+def get_delivery_key(event, params):
+	"""
+	同一次Webhook投递的标识：优先使用Gitlab的Idempotency-Key或X-Gitlab-Event-UUID请求头，否则以事件内容的哈希代替。
+	"""
+	headers = { str(key).lower(): value for key, value in (event.get('headers') or {}).items() }
+	key = headers.get('idempotency-key') or headers.get('x-gitlab-event-uuid')
+	if key: return key
+	text = base.dump_json([ params.get('project_id'), params.get('event_type'), params.get('ref'), params.get('commit_id'), params.get('previous_commit_id') ])
+	return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
+def register_delivery(params, delivery_key, current_time):
+	"""
+	记录一次Webhook投递。首次投递返回None；重复的投递返回已有的记录，其中target_request_id为首次投递的request_id。
+	"""
+	table = dynamodb.Table(REQUEST_TABLE)
+	key = dict(commit_id=params['commit_id'], request_id=DELIVERY_PREFIX + delivery_key)
+	try:
+		table.put_item(
+			Item = dict(key, target_request_id=params['request_id'], invoked=False, create_time=str(current_time), expire_time=request_dedupe.get_expire_time()),
+			ConditionExpression = 'attribute_not_exists(request_id)',
+		)
+		return None
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		return table.get_item(Key=key, ConsistentRead=True).get('Item') or {}
+
+def complete_delivery(params, delivery_key):
+	dynamodb.Table(REQUEST_TABLE).update_item(
+		Key = dict(commit_id=params['commit_id'], request_id=DELIVERY_PREFIX + delivery_key),
+		UpdateExpression = 'set invoked = :i',
+		ExpressionAttributeValues = { ':i': True },
+	)
+
+def load_repository_configs(web_url):
 	response = dynamodb.Table(REPOSITORY_TABLE).query(
 		KeyConditionExpression='repository_url=:ru',
 		ExpressionAttributeValues={ ':ru': web_url }
 	)
-
-	records = []
+	configs = []
 	for record in response['Items']:
-		branch_regexp = record.get('branch_regexp')
-		if re.match(branch_regexp, target_branch):
-			records.append(record)
+		try:
+			configs.append((re.compile(record.get('branch_regexp')), record))
+		except re.error as ex:
+			logger.warning('Skip repository configuration with invalid branch_regexp.', repository_url=web_url, branch_regexp=record.get('branch_regexp'), error=str(ex))
+	return configs
+
+def parse_process_mode(params):
+	
+	web_url = params.get('web_url')
+	target_branch = params.get('target_branch')
+	event_type = params.get('event_type')
+
+	configs = repository_cache.get(web_url, lambda: load_repository_configs(web_url))
+	records = [ record for branch_regexp, record in configs if branch_regexp.match(target_branch) ]
 
 	for record in records:
-		print('Found {} repository configurations, use the first one: {}'.format(len(records), base.dump_json(record)))
+		logger.info('Found repository configurations, use the first one.', count=len(records), repository_url=record.get('repository_url'), branch_regexp=record.get('branch_regexp'))
 		result = {}
 		for key, value in record.items():
 			if key.startswith('event_'):
 				result[key[6:]] = value
 		mode = result.get(event_type)
-		print(f'Parsed code review mode({mode}) for branch({target_branch}) by configuration {record}')
+		logger.info('Parsed code review mode.', mode=mode, target_branch=target_branch)
 		return mode
 	
-	print(f'Can\'t parse any code review mode for branch({target_branch}) for no any repository configuration matched.')
+	logger.info('Can\'t parse any code review mode for no any repository configuration matched.', target_branch=target_branch)
 	return None
 
 def lambda_handler(event, context):
 	
-	print('Event:', base.dump_json(event))
+	logger.start(stage='webhook')
+	logger.debug('Event.', event=event)
 	current_time = datetime.datetime.now()
+	request_metrics = metrics.Metrics('webhook')
+	request_key = {}
 	
 	try:
 		
 		# 解析Gitlab参数
-		params = codelib.parse_parameters(event)
-		print('Request identifier:', params['request_id'])
-		print('Project={project_id}({project_name}), Commit={commit_id}, Ref={ref}'.format(**params))
-		print('Repository URL={repo_url}, Private Token={private_token}'.format(**params))
+		with request_metrics.timer('webhook_parse'):
+			params = codelib.parse_parameters(event)
+		request_metrics.dimensions['project'] = str(params.get('project_name'))
+		logger.bind(request_id=params['request_id'], commit_id=params['commit_id'])
+		logger.info('Parsed webhook request.', project_id=params.get('project_id'), project_name=params.get('project_name'), ref=params.get('ref'), repo_url=params.get('repo_url'))
 
 		if not params['commit_id']:
-			print(f'COMMID ID is not found, skip the processing.')
+			logger.info('COMMID ID is not found, skip the processing.')
 			return { 'statusCode': 200, 'body': base.dump_json(dict(succ=True, message='COMMID ID is not found, skip the processing.')) }
 	
-		mode = parse_process_mode(params)
-		if mode not in [ 'all', 'single' ]:
+		with request_metrics.timer('repo_config'):
+			mode = parse_process_mode(params)
+		if mode not in [ 'all', 'single', 'diff' ]:
 			message = 'Event {} of branch {} does not need to be handled.'.format(params.get('event_type'), params.get('target_branch'))
-			print(message)
+			logger.info(message)
 			return { 'statusCode': 200, 'body': base.dump_json(dict(succ=True, message=message)) }
 		params['mode'] = mode
+
+		# Gitlab在超时后会重试投递，已经调用过task_dispatcher的投递直接应答
+		with request_metrics.timer('dedupe'):
+			delivery_key = get_delivery_key(event, params)
+			delivery = register_delivery(params, delivery_key, current_time)
+		if delivery is not None:
+			if delivery.get('invoked') or not delivery.get('target_request_id'):
+				logger.info('Skip duplicated webhook delivery.', delivery_key=delivery_key, target_request_id=delivery.get('target_request_id'))
+				return { 'statusCode': 200, 'body': base.dump_json(dict(succ=True, duplicated=True, request_id=delivery.get('target_request_id'))) }
+			# 前一次投递未完成，沿用其request_id继续处理
+			params['request_id'] = delivery['target_request_id']
+			logger.bind(request_id=params['request_id'])
+			logger.info('Resume unfinished webhook delivery.', delivery_key=delivery_key)
+
+		# 相同项目、commit、mode和规则版本的事件(例如重复触发的merge_request checking)合并到已有请求
+		with request_metrics.timer('dedupe'):
+			existing_request_id = request_dedupe.register_review(params, current_time)
+		if existing_request_id and existing_request_id != params['request_id']:
+			logger.info('Attach duplicated event to the existing request.', target_request_id=existing_request_id)
+			complete_delivery(params, delivery_key)
+			return { 'statusCode': 200, 'body': base.dump_json(dict(succ=True, duplicated=True, request_id=existing_request_id)) }
+
+		if WEBHOOK_FAST_PATH:
+			# 获取项目和解析.codereview.yaml需要访问Gitlab，推迟到task_dispatcher中进行
+			params['deferred'] = True
+		else:
+			# 获取Code Lib Context
+			with request_metrics.timer('repo_context'):
+				repo_context = codelib.init_repo_context(params)
+
+			# 解析.codereview规则
+			with request_metrics.timer('review_config'):
+				params['target'], params['variables'] = codelib.load_review_config(repo_context, params['commit_id'])
+			logger.info('Parsed variables.', variables=params['variables'])
 		
-		# 获取Code Lib Context
-		repo_context = codelib.init_repo_context(params)
-
-		# 解析.codereview规则
-		desc = codelib.get_repository_file(repo_context, '.codereview.yaml', params['commit_id'])
-		variables = yaml.safe_load(desc) if desc else dict()
-		params['target'] = parse_target(variables)
-		if 'target' in variables: variables.pop('target')
-		if 'targets' in variables: variables.pop('targets')
-		params['variables'] = variables
-		print('Parsed variables:', base.dump_json(variables))
-		
-		# 向数据库插入记录
-		dynamodb.Table(REQUEST_TABLE).put_item(Item={
-			'commit_id': params['commit_id'],
-			'request_id': params['request_id'],
-			'mode': params['mode'],
-			'status': 'Start',
-			'task_complete': 0,
-			'task_failure': 0,
-			'task_total': 0,
-			'create_time': str(current_time),
-			'update_time': str(current_time),
-		})
-		print('Complete inserting record to ddb.')
+		# 向数据库插入记录，继续未完成的投递时记录可能已经存在
+		with request_metrics.timer('ddb'):
+			try:
+				dynamodb.Table(REQUEST_TABLE).put_item(
+					Item = {
+						'commit_id': params['commit_id'],
+						'request_id': params['request_id'],
+						'mode': params['mode'],
+						'status': 'Received' if WEBHOOK_FAST_PATH else 'Start',
+						'task_complete': 0,
+						'task_failure': 0,
+						'task_total': 0,
+						'metrics': {},
+						'create_time': str(current_time),
+						'update_time': str(current_time),
+					},
+					ConditionExpression = 'attribute_not_exists(request_id)',
+				)
+				logger.info('Complete inserting record to ddb.')
+			except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+				logger.info('Request record already exists.')
+		request_key = dict(commit_id=params['commit_id'], request_id=params['request_id'])
+
+		# 记为分支的最新请求，旧请求中尚未执行的任务将被跳过
+		params['create_time'] = str(current_time)
+		request_dedupe.set_branch_head(params, current_time)
 		
 		# 调用第二个Lambda函数，使用'Event'进行异步调用
 		payload = base.dump_json(params)
-		lambda_client.invoke(
-			FunctionName=TASK_DISPATCHER_FUN_NAME,
-			InvocationType='Event',
-			Payload=payload,
-		)
-		print('Complete invoking task dispatcher, payload is', payload)
+		with request_metrics.timer('dispatcher_invoke'):
+			lambda_client.invoke(
+				FunctionName=TASK_DISPATCHER_FUN_NAME,
+				InvocationType='Event',
+				Payload=payload,
+			)
+		logger.info('Complete invoking task dispatcher.', size=len(payload))
+		complete_delivery(params, delivery_key)
 
 		return { 'statusCode': 200, 'body': base.dump_json(dict(succ=True)) }
 
 	except Exception as ex:
-		print('Fail to process webhook request: {}, location: {}'.format(ex, traceback.format_exc()))
+		logger.exception('Fail to process webhook request.', error=str(ex))
 		return { 'statusCode': 200, 'body': base.dump_json(dict(succ=False, message=str(ex))) }
+	finally:
+		request_metrics.flush(**request_key)
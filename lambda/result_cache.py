@@ -0,0 +1,46 @@
+import os, json, time, hashlib
+import base, logger
+
+RESULT_CACHE_TABLE 		= os.getenv('RESULT_CACHE_TABLE')										# 为空时不使用结果缓存
+RESULT_CACHE_TTL_DAYS 	= base.str_to_int(os.getenv('RESULT_CACHE_TTL_DAYS', '30'))
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+
+def make_cache_key(rule, model, prompt_data, code=''):
+	"""
+	以(规则编号、规则名称、模型、提示词模板、代码)的哈希作为缓存键，规则或代码任何变化都会产生新的键。
+	"""
+	text = base.dump_json([
+		rule.get('number'),
+		rule.get('name'),
+		model,
+		prompt_data.get('prompt_system', ''),
+		prompt_data.get('prompt_user', ''),
+		hashlib.sha256(code.encode('utf-8')).hexdigest(),
+	])
+	return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+def get_results(cache_keys):
+	"""
+	批量读取缓存结果：{ cache_key: findings }，不存在、过期或读取失败的键不在结果中。
+	"""
+	keys = [ dict(cache_key=cache_key) for cache_key in cache_keys if cache_key ]
+	if not RESULT_CACHE_TABLE or not keys: return {}
+	try:
+		items = base.batch_get_items(dynamodb, RESULT_CACHE_TABLE, keys)
+	except Exception as ex:
+		logger.warning('Fail to get cached results.', count=len(keys), error=str(ex))
+		return {}
+	now = time.time()
+	return { item['cache_key']: json.loads(item.get('content')) for item in items if int(item.get('expire_time', 0)) >= now }
+
+def put_result(cache_key, content):
+	if not RESULT_CACHE_TABLE or not cache_key: return
+	try:
+		dynamodb.Table(RESULT_CACHE_TABLE).put_item(Item={
+			'cache_key': cache_key,
+			'content': base.dump_json(content),
+			'expire_time': int(time.time()) + RESULT_CACHE_TTL_DAYS * 24 * 3600,
+		})
+	except Exception as ex:
+		logger.warning('Fail to put cached result.', cache_key=cache_key, error=str(ex))
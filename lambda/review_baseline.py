@@ -0,0 +1,106 @@
+import os, gzip, json, hashlib, datetime
+import boto3
+import base, code_packer, logger
+
+REQUEST_TABLE 		= os.getenv('REQUEST_TABLE')
+TASK_TABLE 			= os.getenv('TASK_TABLE')
+BUCKET_NAME 		= os.getenv('BUCKET_NAME')
+ALL_INCREMENTAL 	= os.getenv('ALL_INCREMENTAL', 'true').lower() == 'true'		# 整库审核时复用目标分支上一次完成的整库审核中未变化的分片
+MANIFEST_PREFIX 	= os.getenv('MANIFEST_PREFIX', 'manifests')					# 分片清单在BUCKET_NAME中的前缀
+
+# 目标分支最近一次完成的整库审核，与请求记录存放在同一张表中
+BASELINE_PREFIX 	= '#baseline#'
+BASELINE_KEY 		= '#all'
+
+dynamodb = base.ThreadLocalResource('dynamodb')
+s3_client = boto3.client('s3')
+
+def is_enabled():
+	return ALL_INCREMENTAL and bool(BUCKET_NAME)
+
+def hash_content(content):
+	return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def get_baseline_key(context):
+	if not context.get('project_id') or not context.get('target_branch'): return None
+	return dict(commit_id=BASELINE_PREFIX + '#'.join([ str(context.get('project_id')), str(context.get('target_branch')) ]), request_id=BASELINE_KEY)
+
+def save_manifest(request_id, manifest):
+	key = f'{MANIFEST_PREFIX}/{request_id}.json.gz'
+	s3_client.put_object(Bucket=BUCKET_NAME, Key=key, Body=gzip.compress(base.dump_json(manifest).encode('utf-8')), ContentType='application/json', ContentEncoding='gzip')
+	return key
+
+def load_manifest(key):
+	response = s3_client.get_object(Bucket=BUCKET_NAME, Key=key)
+	return json.loads(gzip.decompress(response['Body'].read()).decode('utf-8'))
+
+def load_baseline(context):
+	"""
+	读取目标分支最近一次完成的整库审核及其分片清单，没有可用的基线时返回None。
+	"""
+	key = get_baseline_key(context)
+	if not is_enabled() or key is None: return None
+	try:
+		item = dynamodb.Table(REQUEST_TABLE).get_item(Key=key).get('Item')
+		if not item or not item.get('manifest_key'): return None
+		manifest = load_manifest(item['manifest_key'])
+		logger.info('Loaded baseline review.', baseline_request_id=item.get('baseline_request_id'), baseline_commit_id=item.get('baseline_commit_id'), shards=len(manifest.get('shards', [])))
+		return manifest
+	except Exception as ex:
+		logger.warning('Fail to load baseline review, review the whole project.', error=str(ex))
+		return None
+
+def set_baseline(context, commit_id, request_id, manifest_key):
+	"""
+	完整成功的整库审核成为目标分支的新基线，较早完成的审核不会覆盖较新的基线。
+	"""
+	key = get_baseline_key(context)
+	if not is_enabled() or key is None or not manifest_key: return
+	datetime_str = str(datetime.datetime.now())
+	try:
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = key,
+			UpdateExpression = 'set baseline_request_id = :r, baseline_commit_id = :c, manifest_key = :m, update_time = :t',
+			ConditionExpression = 'attribute_not_exists(update_time) or update_time < :t',
+			ExpressionAttributeValues = { ':r': request_id, ':c': commit_id, ':m': manifest_key, ':t': datetime_str },
+		)
+		logger.info('Review is saved as the baseline of the branch.', target_branch=context.get('target_branch'))
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		logger.info('A newer baseline is already saved for the branch.', target_branch=context.get('target_branch'))
+
+def plan_shards(files, manifest):
+	"""
+	按基线划分分片：文件内容与基线完全相同的分片原样保留并带上基线的任务编号，
+	其余文件(变化、新增或所在分片有文件被删除)重新打包。返回 [(shard, baseline), ...]，baseline为None表示需要重新审核。
+	"""
+	hashes = { path: hash_content(content) for path, content in files }
+	contents = dict(files)
+	planned, dirty, covered = [], [], set()
+	for shard in (manifest or {}).get('shards', []):
+		shard_files = shard.get('files', {})
+		covered.update(shard_files)
+		if shard_files and all(hashes.get(path) == digest for path, digest in shard_files.items()):
+			planned.append(([ (path, contents[path]) for path in sorted(shard_files) ], dict(request_id=manifest.get('request_id'), tasks=shard.get('tasks', {}))))
+		else:
+			dirty.extend(path for path in shard_files if path in contents)
+	dirty.extend(path for path in contents if path not in covered)
+	planned.extend((shard, None) for shard in code_packer.pack_shards([ (path, contents[path]) for path in dirty ]))
+	return sorted(planned, key=lambda item: item[0][0][0])
+
+def load_tasks_findings(request_id, numbers):
+	"""
+	批量读取基线中任务的审核结果：{ number: findings }，任务失败、只有部分结果或读取失败的任务不在结果中。
+	"""
+	if not numbers: return {}
+	try:
+		items = base.batch_get_items(dynamodb, TASK_TABLE, [ dict(request_id=request_id, number=int(number)) for number in numbers ])
+	except Exception as ex:
+		logger.warning('Fail to load baseline task results.', baseline_request_id=request_id, count=len(numbers), error=str(ex))
+		return {}
+	findings = {}
+	for item in items:
+		if item.get('succ') != True or item.get('partial'): continue
+		result = json.loads(item.get('result'))
+		if isinstance(result, dict) and isinstance(result.get('content'), list):
+			findings[int(item['number'])] = result['content']
+	return findings
@@ -1,18 +1,28 @@
 import boto3
-import os, re, base64, datetime, traceback
-import base, codelib
+import os, base64, datetime
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import base, codelib, config_cache, dependency_index, request_dedupe, review_baseline, report, result_cache, payload_store, prompt_template, diff_context, code_packer, logger, metrics
 
 
 
 # Environment variables and constants
 REQUEST_TABLE 			= os.getenv('REQUEST_TABLE')
+TASK_TABLE 				= os.getenv('TASK_TABLE')
 RULE_TABLE 				= os.getenv('RULE_TABLE')
 TASK_SQS_URL 			= os.getenv('TASK_SQS_URL')
+SQS_SEND_CONCURRENCY 	= base.str_to_int(os.getenv('SQS_SEND_CONCURRENCY', '8'))	# 并发发送SQS批次的线程数
+SQS_BATCH_SIZE 			= 10					# send_message_batch单次最多10条消息
+SQS_MAX_BATCH_BYTES 	= 256 * 1024			# send_message_batch单次请求的最大字节数
+SQS_MAX_MESSAGE_BYTES 	= 256 * 1024			# 单条SQS消息的最大字节数
+PROMPT_CODE_MODE 		= os.getenv('PROMPT_CODE_MODE', 'shared')	# shared: 代码作为共享片段由task_executor填入；inline: 在dispatcher中填入提示词
 
 # Initialize AWS services clients
 dynamodb = boto3.resource("dynamodb")
 sqs_client = boto3.client("sqs")
 
+# 按mode缓存规则列表
+rule_cache = config_cache.TTLCache('rule', version_loader=lambda: config_cache.get_version(RULE_TABLE, config_cache.RULE_VERSION_KEY))
+
 def encode_base64(string):
 	string_bytes = string.encode('utf-8')
 	base64_bytes = base64.b64encode(string_bytes)
@@ -25,7 +35,7 @@ def decode_base64(base64_string):
 	string = string_bytes.decode('utf-8')
 	return string
 
-def get_rules(mode):
+def load_rules(mode):
 	items = dynamodb.Table(RULE_TABLE).query(
 		KeyConditionExpression='#mode=:mode',
 		ExpressionAttributeNames={ '#mode': 'mode' },
@@ -34,53 +44,151 @@ def get_rules(mode):
 	ret = [ item for item in items.get('Items') ]
 	return ret
 
-def match_glob_pattern(string, pattern):
-	regex = re.escape(pattern)
-	regex = regex.replace(r'\*\*', '.*')
-	regex = regex.replace(r'\*', '[^/]*')
-	regex = regex.replace(r'\?', '.')
-	match = re.match(regex, string)
-	return bool(match)
+def get_rules(mode):
+	return list(rule_cache.get(mode, lambda: load_rules(mode)))
 
-def send_message(data):
+def send_message(data, delay=0):
 	sqs_url = TASK_SQS_URL
 	try:
-		print(f'Prepare to send message to SQS({sqs_url}): {data}')
+		logger.debug('Prepare to send message to SQS.', sqs_url=sqs_url, data=data)
 		message = encode_base64(base.dump_json(data))
-		response = sqs_client.send_message(QueueUrl=sqs_url, MessageBody=message)
-		print(f'Succeed to send message to SQS({sqs_url}) in base64: {message}')
+		response = sqs_client.send_message(QueueUrl=sqs_url, MessageBody=message, DelaySeconds=delay)
+		logger.info('Succeed to send message to SQS.', type=data.get('type'), size=len(message))
 		return True
 	except Exception as ex:
-		print(f'Fail to send message to SQS({sqs_url}): {ex}')
-		traceback.print_exc()
+		logger.exception('Fail to send message to SQS.', sqs_url=sqs_url, error=str(ex))
 		return False
 
+def iter_batches(items):
+	# 逐条编码消息，每批最多SQS_BATCH_SIZE条，且总大小不超过SQS单次请求的上限
+	batch, size = [], 0
+	for index, item in enumerate(items):
+		body = encode_base64(base.dump_json(item))
+		if batch and (len(batch) >= SQS_BATCH_SIZE or size + len(body) > SQS_MAX_BATCH_BYTES):
+			yield batch
+			batch, size = [], 0
+		batch.append(dict(Id=str(index), MessageBody=body))
+		size += len(body)
+	if batch:
+		yield batch
+
+def send_batch(batch):
+	sqs_url = TASK_SQS_URL
+	try:
+		response = sqs_client.send_message_batch(QueueUrl=sqs_url, Entries=batch)
+		failed = response.get('Failed', [])
+		for entry in failed:
+			logger.warning('Fail to send message to SQS.', id=entry.get('Id'), code=entry.get('Code'), error=entry.get('Message', ''))
+		return len(failed)
+	except Exception as ex:
+		logger.exception('Fail to send messages to SQS.', count=len(batch), sqs_url=sqs_url, error=str(ex))
+		return len(batch)
+
+def send_messages(items):
+	"""
+	使用send_message_batch并发批量发送消息，返回发送失败的消息数。
+	"""
+	if not items: return 0
+
+	# 边编码边发送，限制待发送的批次数，避免所有消息同时驻留内存
+	count, batches, failures, pending = 0, 0, 0, set()
+	with ThreadPoolExecutor(max_workers=SQS_SEND_CONCURRENCY) as executor:
+		for batch in iter_batches(items):
+			count += len(batch)
+			batches += 1
+			pending.add(executor.submit(send_batch, batch))
+			if len(pending) >= SQS_SEND_CONCURRENCY * 2:
+				done, pending = wait(pending, return_when=FIRST_COMPLETED)
+				failures += sum(future.result() for future in done)
+		failures += sum(future.result() for future in pending)
+	logger.info('Sent messages to SQS.', sent=count - failures, count=count, batches=batches)
+	return failures
+
 def format_prompt(pattern, variables, commit_id=None, code=None):
-	text = pattern
-	for key in variables:
-		text = text.replace('{{' + key + '}}', variables.get(key, '').strip())
+	values = { key: str(value if value is not None else '').strip() for key, value in (variables or {}).items() }
 	if commit_id: 
-		text = text.replace('{{commit_id}}', commit_id)
-	if code: 
-		text = text.replace('{{code}}', code)
-	return text
+		values['commit_id'] = commit_id
+	if code is not None: 
+		values['code'] = code
+	return prompt_template.compile_template(pattern).render(values)
 
 def get_prompt_data(mode, rule, commit_id, code, variables):
 	
 	if rule.get('mode') != mode: return None
 	
-	if rule.get('model') == 'claude3':
+	if str(rule.get('model', '')).startswith('claude3'):
 		prompt_system = format_prompt(rule.get('prompt_system'), variables, code=code)
 		prompt_user = format_prompt(rule.get('prompt_user'), variables, code=code)
 		return dict(prompt_system=prompt_system, prompt_user=prompt_user)
 	else:
 		return None
-	
-def send_task_to_sqs(event, request_id, commit_id, mode, contents, variables):
+
+def get_message_size(item, code_size):
+	# 估算消息大小，共享的代码片段只计算一次长度，不做序列化复制
+	size = len(base.dump_json({ key: value for key, value in item.items() if key != 'code' }).encode('utf-8'))
+	if 'code' in item:
+		size += code_size
+	return int(size * 4 / 3)
+
+def make_task_payload(request_id, item, prompt_data, code, code_size):
+	"""
+	大的代码块以Claim-Check方式存入S3，消息中只携带引用，多个规则共享同一份代码。
+	shared模式下代码作为独立字段随消息发送，由task_executor填入提示词，dispatcher中不为每个规则复制一份。
+	消息仍超过SQS上限时，代码或整个提示词存入S3。
+	"""
+	item['prompt_data'] = prompt_data
+	if payload_store.should_offload(code):
+		item['code_ref'] = payload_store.put_payload(request_id, code)
+	elif PROMPT_CODE_MODE == 'shared':
+		item['code'] = code
+	else:
+		item['prompt_data'] = base.fill_code(prompt_data, code)
+
+	if payload_store.is_enabled() and get_message_size(item, code_size) > SQS_MAX_MESSAGE_BYTES and 'code' in item:
+		item['code_ref'] = payload_store.put_payload(request_id, item.pop('code'))
+	if payload_store.is_enabled() and get_message_size(item, code_size) > SQS_MAX_MESSAGE_BYTES:
+		item['prompt_ref'] = payload_store.put_payload(request_id, base.dump_json(item.pop('prompt_data')))
+	return item
+
+def complete_tasks_from_cache(commit_id, request_id, mode, tasks):
+	"""
+	用缓存或基线的审核结果直接完成任务 [(number, rule_name, findings, filepaths), ...]，返回完成的任务编号集合。
+	Task表批量写入，请求记录只更新一次；写入失败时返回空集合，这些任务照常发送到SQS。
+	"""
+	try:
+		datetime_str = str(datetime.datetime.now())
+		# 直接写入Task表，与task_executor中完成的任务格式一致
+		with dynamodb.Table(TASK_TABLE).batch_writer() as writer:
+			for number, rule_name, findings, filepaths in tasks:
+				result = report.make_task_result(commit_id, request_id, rule_name, findings, datetime_str, filepaths)
+				writer.put_item(Item={
+					'request_id': request_id,
+					'number': number,
+					'mode': mode,
+					'succ': True,
+					'cached': True,
+					'result': base.dump_json(result),
+					'create_time': datetime_str,
+					'update_time': datetime_str,
+				})
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = dict(commit_id=commit_id, request_id=request_id),
+			UpdateExpression = 'set task_complete = task_complete + :tc, update_time = :t',
+			ExpressionAttributeValues = { ':tc': len(tasks), ':t': datetime_str },
+			ReturnValues = 'ALL_NEW'
+		)
+		logger.info('Review results are loaded from cache for tasks.', count=len(tasks))
+		return set(number for number, _, _, _ in tasks)
+	except Exception as ex:
+		logger.warning('Fail to complete tasks from cache.', count=len(tasks), error=str(ex))
+		return set()
+
+def send_task_to_sqs(event, request_id, commit_id, mode, contents, variables, dispatch_metrics):
 	
 	rules = get_rules(mode)
-	print('Get rules:', base.dump_json(rules))
-	
+	logger.info('Get rules.', rules=[ (rule.get('number'), rule.get('name'), rule.get('model')) for rule in rules ])
+	logger.debug('Rule details.', rules=rules)
+
 	# 更新记录的任务总数
 	count = len(contents) * len(rules)
 	try:
@@ -99,54 +207,126 @@ def send_task_to_sqs(event, request_id, commit_id, mode, contents, variables):
 			ReturnValues = "ALL_NEW",
 		)
 	except Exception as ex:
-		print(f'Fail to update status for request record(commit_id={commit_id}), request_id={request_id}): {ex}')
-		traceback.print_exc()
+		logger.exception('Fail to update status for request record.', error=str(ex))
 		return False
 		
-	# 每一个content与每一个rule组合成一个Bedrock Task
-	number = 0
+	# 每一个content与每一个rule组合成一个Bedrock Task，先规划全部任务，再批量查询基线和缓存结果
+	number, tasks, items, failures = 0, [], [], 0
+	manifest = dict(commit_id=commit_id, request_id=request_id, shards=[])
 	for content in contents:
+		code = content.get('content') or ''
+		code_size = len(code.encode('utf-8'))
+		baseline = content.get('baseline') or {}
+		shard = dict(files=content.get('files') or {}, tasks={})
+		manifest['shards'].append(shard)
 		for rule in rules:
-			result = True
 			try:
 				model = rule.get('model')
-				prompt_data = get_prompt_data(mode, rule, commit_id, content.get('content'), variables)
-				print('Make up new prompt data:' , base.dump_json(prompt_data))
+				# 先保留{{code}}占位符，代码在发送前或在task_executor中填入
+				prompt_data = get_prompt_data(mode, rule, commit_id, None, variables)
 				if not prompt_data: continue
 			
 				number += 1
 				rule_name = rule.get('name', 'none')
 				identity = '{}-{}-{}-{}-{}'.format(mode, model, number, rule_name, content.get('path', 'none')).lower()
-				item = dict(
-					context = event, 
-					commit_id = commit_id, 
-					request_id = request_id,
+
+				# 分片中的文件与基线相同，且规则和提示词未变化时，可以沿用基线的审核结果
+				rule_key = result_cache.make_cache_key(rule, model, prompt_data)
+				shard['tasks'][rule_key] = number
+				baseline_number = baseline.get('tasks', {}).get(rule_key)
+
+				tasks.append(dict(
 					number = number,
-					mode = mode, 
 					model = model,
-					filepath = content.get('filepath'),
 					rule_name = rule_name,
-					prompt_data=prompt_data
-				)
-				result = send_message(item)
-				if not result:
-					print('Fail to send bedrock task to SQS')
+					prompt_data = prompt_data,
+					content = content,
+					code = code,
+					code_size = code_size,
+					baseline = (baseline['request_id'], int(baseline_number)) if baseline_number is not None else None,
+					cache_key = result_cache.make_cache_key(rule, model, prompt_data, code),
+				))
 			except Exception as ex:
-				print(f'Fail to create SQS task: {ex}')
-				result = False
-			
-			if not result:
-				try:
-					table.update_item(
-						Key=dict(commit_id=commit_id, scan_scope=mode),
-						UpdateExpression="set task_failure = task_failure + :tf",
-						ExpressionAttributeValues={ ':tf': 1 },
-						ReturnValues="ALL_NEW",
-					)
-				except Exception as ex:
-					print(f'Fail to update FAILURE COUNT for commit_id({commit_id}) and mode({mode}): {ex}')
-
-	# 最后一个Task，定期检查任务进度
+				logger.warning('Fail to create SQS task.', number=number, error=str(ex))
+				failures += 1
+
+	# 沿用基线的审核结果
+	found = {}
+	with dispatch_metrics.timer('baseline_lookup'):
+		baselines = {}
+		for task in tasks:
+			if task['baseline']:
+				baselines.setdefault(task['baseline'][0], []).append(task['baseline'][1])
+		baseline_findings = { (baseline_request_id, number): findings for baseline_request_id, numbers in baselines.items() for number, findings in review_baseline.load_tasks_findings(baseline_request_id, numbers).items() }
+	for task in tasks:
+		if task['baseline'] in baseline_findings:
+			found[task['number']] = (baseline_findings[task['baseline']], 'carried_over')
+
+	# 相同规则、模型和提示词已经审核过，直接使用缓存结果，不再调用Bedrock
+	with dispatch_metrics.timer('cache_lookup'):
+		cached = result_cache.get_results([ task['cache_key'] for task in tasks if task['number'] not in found ])
+	for task in tasks:
+		if task['number'] not in found and task['cache_key'] in cached:
+			found[task['number']] = (cached[task['cache_key']], 'cache_hits')
+
+	completed = set()
+	if found:
+		with dispatch_metrics.timer('cache_complete'):
+			completed = complete_tasks_from_cache(commit_id, request_id, mode, [ (task['number'], task['rule_name'], found[task['number']][0], task['content'].get('filepaths')) for task in tasks if task['number'] in found ])
+		for number in completed:
+			dispatch_metrics.add(found[number][1], 1)
+
+	for task in tasks:
+		if task['number'] in completed: continue
+		try:
+			content = task['content']
+			item = dict(
+				context = event, 
+				commit_id = commit_id, 
+				request_id = request_id,
+				number = task['number'],
+				mode = mode, 
+				model = task['model'],
+				filepath = content.get('path'),
+				filepaths = content.get('filepaths'),
+				rule_name = task['rule_name'],
+				cache_key = task['cache_key'],
+			)
+			items.append(make_task_payload(request_id, item, task['prompt_data'], task['code'], task['code_size']))
+		except Exception as ex:
+			logger.warning('Fail to create SQS task.', number=task['number'], error=str(ex))
+			failures += 1
+
+	# 保存整库审核的分片清单，审核全部成功后成为下一次增量审核的基线
+	if mode == 'all' and review_baseline.is_enabled():
+		try:
+			manifest_key = review_baseline.save_manifest(request_id, manifest)
+			table.update_item(
+				Key = dict(commit_id=commit_id, request_id=request_id),
+				UpdateExpression = 'set manifest_key = :m',
+				ExpressionAttributeValues = { ':m': manifest_key },
+			)
+		except Exception as ex:
+			logger.warning('Fail to save shard manifest.', error=str(ex))
+
+	# 批量发送到SQS，发送失败的任务计入失败数
+	with dispatch_metrics.timer('fanout'):
+		failures += send_messages(items)
+	dispatch_metrics.add('tasks', count)
+	dispatch_metrics.add('task_messages', len(items))
+	dispatch_metrics.add('task_failures', failures)
+	if failures:
+		try:
+			table.update_item(
+				Key=dict(commit_id=commit_id, request_id=request_id),
+				UpdateExpression="set task_failure = task_failure + :tf",
+				ExpressionAttributeValues={ ':tf': failures },
+				ReturnValues="ALL_NEW",
+			)
+		except Exception as ex:
+			logger.warning('Fail to update FAILURE COUNT.', failures=failures, error=str(ex))
+
+	# 最后一个Task，作为超时兜底定期检查任务进度。立即执行一次，以处理全部命中缓存的情况
 	result = send_message(dict(
 		type = 'checker',
 		context = event, 
@@ -184,9 +364,10 @@ def validate_sqs_event(event):
 	"""
 	mode = all
 	mode = single，commit_id, previous_commit_id
+	mode = diff，commit_id, previous_commit_id
 	"""
 	required = [ 'commit_id', 'request_id', 'mode', 'target' ]
-	if event['mode'] == 'single':
+	if event['mode'] in [ 'single', 'diff' ]:
 		required.append('previous_commit_id')
 		
 	for field in required:
@@ -194,15 +375,93 @@ def validate_sqs_event(event):
 			raise Exception(f'SQS event does not have field {field} - {event}')
 	return True
 
+def resolve_deferred_request(event, dispatch_metrics):
+	"""
+	快速应答模式下webhook只保存了最小的请求记录，在这里获取项目并解析.codereview.yaml。
+	请求记录从Received改为Resolving，重复的调用会因条件更新失败而跳过。返回False表示不需要继续处理。
+	"""
+	table = dynamodb.Table(REQUEST_TABLE)
+	key = dict(commit_id=event['commit_id'], request_id=event['request_id'])
+	try:
+		table.update_item(
+			Key = key,
+			UpdateExpression = 'set #s = :s, update_time = :t',
+			ConditionExpression = '#s = :received',
+			ExpressionAttributeNames = { '#s': 'status' },
+			ExpressionAttributeValues = { ':s': 'Resolving', ':received': 'Received', ':t': str(datetime.datetime.now()) },
+		)
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		logger.info('Skip dispatching: request is already being processed.')
+		return False
+
+	try:
+		with dispatch_metrics.timer('repo_context'):
+			repo_context = codelib.init_repo_context(event)
+		with dispatch_metrics.timer('review_config'):
+			event['target'], event['variables'] = codelib.load_review_config(repo_context, event['commit_id'])
+		logger.info('Parsed variables.', variables=event['variables'])
+		return True
+	except Exception as ex:
+		logger.exception('Fail to resolve review config.', error=str(ex))
+		finish_request(event, 'Failure', str(ex))
+		return False
+
 def lambda_handler(event, context):
 	
-	print('Event:', base.dump_json(event))
+	logger.start(stage='dispatch', request_id=event.get('request_id'), commit_id=event.get('commit_id'))
+	logger.debug('Event.', event=event)
+	dispatch_metrics = metrics.Metrics('dispatch', project=event.get('project_name'), mode=event.get('mode'))
+	try:
+		return handle_dispatch(event, dispatch_metrics)
+	finally:
+		dispatch_metrics.flush(event.get('commit_id'), event.get('request_id'))
+
+def mark_superseded(event, superseded_by):
+	"""
+	记录请求被同一分支更新的请求取代，并释放去重登记，相同的事件可以重新发起审核。
+	"""
+	dynamodb.Table(REQUEST_TABLE).update_item(
+		Key = dict(commit_id=event['commit_id'], request_id=event['request_id']),
+		UpdateExpression = 'set #s = :s, superseded_by = :b, update_time = :t',
+		ExpressionAttributeNames = { '#s': 'status' },
+		ExpressionAttributeValues = { ':s': 'Superseded', ':b': superseded_by, ':t': str(datetime.datetime.now()) },
+	)
+	request_dedupe.release_review(event)
+
+def finish_request(event, status, message):
+	"""
+	请求没有产生任何任务就结束时记录最终状态。失败时同时释放去重登记，相同的事件可以重新发起审核。
+	"""
+	try:
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = dict(commit_id=event['commit_id'], request_id=event['request_id']),
+			UpdateExpression = 'set #s = :s, message = :m, update_time = :t',
+			ExpressionAttributeNames = { '#s': 'status' },
+			ExpressionAttributeValues = { ':s': status, ':m': message, ':t': str(datetime.datetime.now()) },
+		)
+		if status == 'Failure':
+			request_dedupe.release_review(event)
+	except Exception as ex:
+		logger.exception('Fail to update final status for request record.', status=status, error=str(ex))
+
+def handle_dispatch(event, dispatch_metrics):
+
+	# 同一分支已有更新的请求时不再获取代码和发送任务
+	superseded_by = request_dedupe.get_superseding_request(event, event.get('request_id'))
+	if superseded_by:
+		logger.info('Skip dispatching: request is superseded by a newer request.', superseded_by=superseded_by)
+		mark_superseded(event, superseded_by)
+		return {"statusCode": 200, "body": dict(succ = False, superseded_by = superseded_by) }
+
+	if event.get('deferred') and not resolve_deferred_request(event, dispatch_metrics):
+		return {"statusCode": 200, "body": dict(succ = False) }
 	
 	# 校验SQS Event必要字段
 	try:
 		validate_sqs_event(event)
 	except Exception as ex:
-		print('Fail to validate SQS event:', ex)
+		logger.error('Fail to validate SQS event.', error=str(ex))
+		finish_request(event, 'Failure', str(ex))
 		return {"statusCode": 500, "body": str(ex)}
 	
 	# 初始化变量
@@ -213,33 +472,117 @@ def lambda_handler(event, context):
 	
 	targets = [ target.strip() for target in event['target'].split(',') if target.strip() ]
 	if not targets:
-		print('Skipped code review: target is empty.')
-		return
+		logger.info('Skipped code review: target is empty.')
+		finish_request(event, 'Skipped', 'Target is empty.')
+		return {"statusCode": 200, "body": dict(succ = False) }
 	
+	# 获取代码或发送任务失败时记录失败状态；快速应答模式下请求已被认领，Lambda的异步重试不会再处理它
+	try:
+		result = dispatch(event, request_id, commit_id, previous_commit_id, mode, targets, dispatch_metrics)
+	except Exception as ex:
+		logger.exception('Fail to dispatch review tasks.', error=str(ex))
+		finish_request(event, 'Failure', str(ex))
+		return {"statusCode": 500, "body": str(ex)}
+	if not result:
+		finish_request(event, 'Failure', 'Fail to send review tasks.')
+	return {"statusCode": 200, "body": dict(succ = result) }
+
+def attach_dependency_context(repo_context, commit_id, targets, contents, dispatch_metrics):
+	"""
+	按仓库的导入/引用索引给每个提示词片段附带其中文件的直接依赖和被依赖的文件。建立索引失败时不附带上下文。
+	"""
+	try:
+		with dispatch_metrics.timer('dependency_index'):
+			index = dependency_index.get_index(repo_context, commit_id, targets)
+	except Exception as ex:
+		logger.warning('Fail to build dependency index.', error=str(ex))
+		return
+	if index is None: return
+
+	for content in contents:
+		with dispatch_metrics.timer('context'):
+			context_files = dependency_index.select_context(index, repo_context, commit_id, content.get('filepaths') or [ content.get('path') ])
+		dispatch_metrics.add('context_files', len(context_files))
+		dispatch_metrics.add('context_bytes', sum(len(context.encode('utf-8')) for _, context in context_files))
+		content['content'] += dependency_index.render_context(context_files)
+
+def dispatch(event, request_id, commit_id, previous_commit_id, mode, targets, dispatch_metrics):
+	"""
+	按mode获取需要审核的代码并组装成提示词片段，然后发送审核任务。
+	"""
+
 	# 获取Code Lib Context
-	repo_context = codelib.init_repo_context(event)
+	with dispatch_metrics.timer('repo_context'):
+		repo_context = codelib.init_repo_context(event)
 		
 	# 计算需要处理的文件，存入contents中
 	contents = []
 	
 	if mode == 'all':
-		text = codelib.get_project_code_text(repo_context, commit_id, targets)      # 计算完整的代码块
-		contents.append(dict(path = '<The Whole Project>', content=text))
+		with dispatch_metrics.timer('fetch'):
+			files = codelib.get_project_code_files(repo_context, commit_id, targets)
+		dispatch_metrics.add('files', len(files))
+		dispatch_metrics.add('fetch_bytes', sum(len(content.encode('utf-8')) for _, content in files))
+		
+		# 按token预算把整库代码切分成多个分片，每个分片单独审核；有基线时未变化的分片沿用基线的划分和审核结果
+		with dispatch_metrics.timer('baseline'):
+			manifest = review_baseline.load_baseline(event)
+		with dispatch_metrics.timer('pack'):
+			shards = review_baseline.plan_shards(files, manifest) if manifest else [ (shard, None) for shard in code_packer.pack_shards(files) ]
+		logger.info('Packed files into shards.', files=len(files), shards=len(shards), unchanged=sum(1 for _, baseline in shards if baseline))
+		for index, (shard, baseline) in enumerate(shards, 1):
+			if len(shards) == 1:
+				path = '<The Whole Project>'
+			else:
+				path = '<The Project Shard {}/{}: {} ~ {}>'.format(index, len(shards), shard[0][0], shard[-1][0])
+			hashes = { filepath: review_baseline.hash_content(code) for filepath, code in shard }
+			contents.append(dict(path = path, content = code_packer.render_shard(shard), files = hashes, baseline = baseline))
 		
 	if mode == 'single':
 
 		# 获取涉及的文件
-		files = codelib.get_involved_files(repo_context, commit_id, previous_commit_id)
-		print('Get involved files before filtering: ', base.dump_json(files))
+		with dispatch_metrics.timer('diff'):
+			files = codelib.get_involved_files(repo_context, commit_id, previous_commit_id)
+		logger.debug('Get involved files before filtering.', files=files)
 		files = base.filter_targets(files, targets)
-		print('Filter files by {}: {}'.format(targets, base.dump_json(files)))
+		logger.info('Filter involved files.', targets=targets, count=len(files), files=files)
 
 		# 逐个文件组装成提示词片段
 		for filepath in files:
-			code = codelib.get_repository_file(repo_context, filepath, commit_id)
-			content = f'{filepath}\n```\n{code}\n```'
+			with dispatch_metrics.timer('fetch'):
+				code = codelib.get_repository_file(repo_context, filepath, commit_id, cached=True)
+			dispatch_metrics.add('files', 1)
+			dispatch_metrics.add('fetch_bytes', len((code or '').encode('utf-8')))
+			content = base.format_code_section(filepath, code)
 			contents.append(dict(path = filepath, content = content))
-		print('Prompt segments for involved files:', base.dump_json(contents))
+		logger.info('Prompt segments for involved files.', count=len(contents))
+
+	if mode == 'diff':
+
+		# 获取涉及的文件及其变化的hunk范围
+		with dispatch_metrics.timer('diff'):
+			changes = codelib.get_involved_changes(repo_context, commit_id, previous_commit_id)
+		files = base.filter_targets(sorted(changes), targets)
+		logger.info('Filter changed files.', targets=targets, count=len(files), files=files)
+
+		# 逐个文件只截取变化的hunk及其上下文
+		for filepath in files:
+			with dispatch_metrics.timer('fetch'):
+				code = codelib.get_repository_file(repo_context, filepath, commit_id, cached=True)
+			if code is None: continue
+			dispatch_metrics.add('files', 1)
+			dispatch_metrics.add('fetch_bytes', len(code.encode('utf-8')))
+			content = diff_context.make_diff_segment(filepath, code, changes.get(filepath))
+			contents.append(dict(path = filepath, content = content))
+		logger.info('Prompt segments for changed hunks.', count=len(contents))
+
+	# 单文件模式下将多个小文件合并为一个任务，减少Bedrock调用次数
+	if mode in [ 'single', 'diff' ]:
+		contents = code_packer.batch_contents(contents)
+		logger.info('Batched into prompt segments.', count=len(contents))
+
+	# 合并之后再附带上下文，上下文不影响小文件的判断，同一片段中的文件不会重复作为上下文
+	if contents and dependency_index.is_enabled(mode):
+		attach_dependency_context(repo_context, commit_id, targets, contents, dispatch_metrics)
 			
-	result = send_task_to_sqs(event, request_id, commit_id, mode, contents, event.get('variables'))
-	return {"statusCode": 200, "body": dict(succ = result) }
+	return send_task_to_sqs(event, request_id, commit_id, mode, contents, event.get('variables'), dispatch_metrics)
@@ -1,7 +1,8 @@
 import boto3
 import traceback
-import os, json, time, datetime, base64
-import base, report
+import os, json, time, random, datetime, base64
+from concurrent.futures import ThreadPoolExecutor
+import base, report, result_cache, payload_store, bedrock_limiter, findings_parser, request_dedupe, review_baseline, logger, metrics
 
 TASK_TABLE 				= os.getenv('TASK_TABLE')
 REQUEST_TABLE 			= os.getenv('REQUEST_TABLE')
@@ -10,17 +11,34 @@ SNS_TOPIC_ARN 			= os.getenv('SNS_TOPIC_ARN')
 SQS_MAX_DELAY 			= base.str_to_int(os.getenv('SQS_MAX_DELAY', '60'))   		# 最大延迟时间(秒)
 SQS_BASE_DELAY 			= base.str_to_int(os.getenv('SQS_BASE_DELAY', '2'))   		# 初始延迟时间(秒)
 SQS_MAX_RETRIES 		= base.str_to_int(os.getenv('SQS_MAX_RETRIES', '5'))		# 最大重试次数
+SQS_MAX_THROTTLE_RETRIES = base.str_to_int(os.getenv('SQS_MAX_THROTTLE_RETRIES', '50'))	# 因限流而放回SQS的最大次数
+SQS_RECORD_CONCURRENCY 	= base.str_to_int(os.getenv('SQS_RECORD_CONCURRENCY', '10'))		# 单次调用中并发处理的SQS消息数
 MAX_FAILED_TIMES 		= base.str_to_int(os.getenv('MAX_FAILED_TIMES', '6'))
 MAX_TOKEN_TO_SAMPLE 	= base.str_to_int(os.getenv('MAX_TOKEN_TO_SAMPLE', '10000'))
 REPORT_TIMEOUT_SECONDS 	= base.str_to_int(os.getenv('REPORT_TIMEOUT_SECONDS', '900'))
+CHECKER_DELAY_SECONDS 	= base.str_to_int(os.getenv('CHECKER_DELAY_SECONDS', '300'))		# 兜底Checker的检查间隔(秒)，最大900
 TOP_P 					= base.str_to_float(os.getenv('TOP_P', '0.9'))
 TEMPERATURE 			= base.str_to_float(os.getenv('TEMPERATURE', '0.1'))
+PROMPT_CACHE_MODELS 	= [ model.strip() for model in os.getenv('PROMPT_CACHE_MODELS', 'claude3.5-haiku,claude3.7-sonnet').split(',') if model.strip() ]	# 使用Bedrock Prompt Caching的模型
+PROMPT_CODE_PREFIX 		= 'The following is the code to be reviewed:\n'
+PROMPT_CODE_REFERENCE 	= '(The code to be reviewed is provided in the <code> section at the beginning of the system prompt.)'
+BEDROCK_INFERENCE_PROFILE = os.getenv('BEDROCK_INFERENCE_PROFILE', '')	# 跨区域推理配置文件的前缀(us/eu/apac)，为空时按Lambda所在区域确定
+
+BEDROCK_STREAMING 		= os.getenv('BEDROCK_STREAMING', 'true').lower() == 'true'			# 使用流式输出，边生成边解析审核结果
+STREAM_SAVE_INTERVAL 	= base.str_to_int(os.getenv('STREAM_SAVE_INTERVAL', '5'))			# 流式输出时保存部分结果的最小间隔(秒)
+STREAM_DEADLINE_MARGIN 	= base.str_to_int(os.getenv('STREAM_DEADLINE_MARGIN', '30'))		# Lambda剩余时间少于此秒数时停止接收输出，保留已有结果
+
+# 本次Lambda调用的截止时间，由lambda_handler设置
+lambda_deadline = None
 
 bedrock = boto3.client(service_name="bedrock-runtime")
-dynamodb = boto3.resource("dynamodb")
-s3 = boto3.resource("s3")
+dynamodb = base.ThreadLocalResource("dynamodb")
+s3 = base.ThreadLocalResource("s3")
 sqs = boto3.client("sqs")
-sns = boto3.resource('sns')
+sns = base.ThreadLocalResource('sns')
+
+# 处理SQS消息的线程池在热启动的多次调用之间复用，各线程的boto3 resource也随之复用
+record_executor = ThreadPoolExecutor(max_workers=SQS_RECORD_CONCURRENCY) if SQS_RECORD_CONCURRENCY > 1 else None
 
 def encode_base64(string):
 	string_bytes = string.encode('utf-8')
@@ -36,36 +54,105 @@ def decode_base64(base64_string):
 
 
 
+def is_review_complete(item):
+	if not item: return False
+	total, completes, failures = [ item.get(key, 0) for key in ['task_total', 'task_complete', 'task_failure' ] ]
+	return completes + failures >= total
+
+def claim_report(commit_id, request_id):
+	# 以条件更新抢占报告生成权，保证同一个请求只生成一次报告；生成报告的Lambda异常退出时，超时后可以重新抢占
+	current_time = datetime.datetime.now()
+	try:
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = {'commit_id': commit_id, 'request_id': request_id},
+			UpdateExpression = 'set report_status = :s, report_claim_time = :t, update_time = :t',
+			ConditionExpression = 'attribute_not_exists(report_status) or (report_status = :s and report_claim_time < :e)',
+			ExpressionAttributeValues = { ':s': 'Generating', ':t': str(current_time), ':e': str(current_time - datetime.timedelta(seconds=REPORT_TIMEOUT_SECONDS)) },
+		)
+		return True
+	except dynamodb.meta.client.exceptions.ConditionalCheckFailedException:
+		return False
+
+def complete_review(record, event, context):
+	"""
+	生成报告并发送通知。报告已生成或正在由其他调用生成时返回False。
+	"""
+
+	commit_id = event.get('commit_id')
+	request_id = event.get('request_id')
+	label = f'request record(commit_id={commit_id}, request_id={request_id})'
+
+	if not claim_report(commit_id, request_id):
+		logger.info('Report is already generated or being generated.')
+		return False
+
+	try:
+		result = report.generate_report(record, event, context, dict(s3=s3, dynamodb=dynamodb))
+	except Exception as ex:
+		# 释放报告生成权，由Checker超时兜底重新生成
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = {'commit_id': commit_id, 'request_id': request_id},
+			UpdateExpression = 'remove report_status',
+		)
+		raise Exception(f'Fail to generate report for {label}.') from ex
+	
+	# 更新数据库Task状态
+	item = dynamodb.Table(REQUEST_TABLE).update_item(
+		Key = {'commit_id': commit_id, 'request_id': request_id},
+		UpdateExpression = 'set task_status = :s, report_status = :rs, update_time = :t',
+		ExpressionAttributeValues = { ':s': 'Complete', ':rs': 'Complete', ':t': str(datetime.datetime.now()) },
+		ReturnValues = 'ALL_NEW'
+	).get('Attributes') or {}
+
+	# 全部任务成功的整库审核作为目标分支的增量审核基线
+	if item.get('mode') == 'all' and item.get('manifest_key') and not item.get('task_failure'):
+		try:
+			review_baseline.set_baseline(context, commit_id, request_id, item.get('manifest_key'))
+		except Exception as ex:
+			logger.warning('Fail to save baseline review.', error=str(ex))
+
+	# 被更新的请求取代的审核不再发送通知
+	if item.get('superseded_by'):
+		logger.info('Skip SNS message for superseded request.', superseded_by=item.get('superseded_by'))
+		return True
+
+	# 发送SNS消息
+	message = dict(title=result.get('title'), subtitle=result.get('subtitle'), report_url=result.get('url'), data=result.get('data'))
+	response = sns.Topic(SNS_TOPIC_ARN).publish(Message=base.dump_json(message), Subject=result.get('title', 'none'))
+	logger.info('SNS message is sent.', message_id=response['MessageId'])
+	return True
+
 def handle_progress_check(record, event, context):
 
-	print('Progress Event:', base.dump_json(event))
-	print('Progress Context:', base.dump_json(context))
+	logger.bind(stage='check', request_id=event.get('request_id'), commit_id=event.get('commit_id'))
+	logger.debug('Progress Event.', event=event)
 
 	commit_id = event.get('commit_id')
 	request_id = event.get('request_id')
 	
-	print(f'Checking code review result for request record(commit_id={commit_id}, request_id={request_id})...')
+	logger.info('Checking code review result for request record.')
 
-	is_completed = False
+	is_completed, generate = False, False
 	
 	# 找不到数据视为已经完成
-	print('Table:',REQUEST_TABLE)
 	item = dynamodb.Table(REQUEST_TABLE).get_item(Key=dict(commit_id=commit_id, request_id=request_id), ConsistentRead=True)
 
-	label = f'request record(commit_id={commit_id}, request_id={request_id})'
 	if item.get('Item') is None:
 		is_completed = True
-		print(f'Mark code review complete. For cannot find record for {label}.')
+		logger.info('Mark code review complete. For cannot find request record.')
 	else:
 		item = item.get('Item')
-		print('Load request record:', item)
+		logger.debug('Load request record.', item=item)
 		total, completes, failures = [ item.get(key) for key in ['task_total', 'task_complete', 'task_failure' ] ]
-		# 检查整个Code Review是否完成
-		if completes + failures >= total:
+		# 检查整个Code Review是否完成。报告正在生成时继续检查，生成失败时由Checker重新生成
+		if item.get('report_status') == 'Complete':
 			is_completed = True
-			print(f'Mark code review complete. For all sub-task are complete for {label}.')
+			logger.info('Report is already generated.')
+		elif is_review_complete(item):
+			is_completed, generate = True, True
+			logger.info('Mark code review complete. For all sub-task are complete.')
 		else:
-			print(f'Code review is uncomplete. Completes({completes}) + Failures({failures}) < Total({total}) for {label}.')
+			logger.info('Code review is uncomplete.', completes=completes, failures=failures, total=total)
 
 			# 检查整个Code Review是否超时
 			create_time = item.get('create_time')
@@ -73,34 +160,24 @@ def handle_progress_check(record, event, context):
 			current_time = datetime.datetime.now()
 			time_diff_seconds = (current_time - specified_time).total_seconds()
 			if time_diff_seconds > REPORT_TIMEOUT_SECONDS:
-				is_completed = True
-				print(f'Mark code review complete. For timeout({REPORT_TIMEOUT_SECONDS} seconds) for {label}.')				
-
-	# Code Review完成，则产生报告
-	if is_completed:
+				is_completed, generate = True, True
+				logger.info('Mark code review complete. For timeout.', timeout=REPORT_TIMEOUT_SECONDS)
 
-		result = report.generate_report(record, event, context, dict(s3=s3, dynamodb=dynamodb))
-		
-		# 更新数据库Task状态
-		dynamodb.Table(REQUEST_TABLE).update_item(
-			Key = {'commit_id': commit_id, 'request_id': request_id},
-			UpdateExpression = 'set task_status = :s, update_time = :t',
-			ExpressionAttributeValues = { ':s': 'Complete', ':t': str(datetime.datetime.now()) },
-			ReturnValues = 'ALL_NEW'
-		)
-
-		# 发送SNS消息
-		message = dict(title=result.get('title'), subtitle=result.get('subtitle'), report_url=result.get('url'), data=result.get('data'))
-		response = sns.Topic(SNS_TOPIC_ARN).publish(Message=base.dump_json(message), Subject=result.get('title', 'none'))
-		print('SNS message is sent:', response['MessageId'])
+	# Code Review完成，则产生报告；报告正在由其他调用生成时继续检查
+	if generate:
+		try:
+			is_completed = complete_review(record, event, context)
+		except Exception as ex:
+			logger.exception('Fail to complete code review.', error=str(ex))
+			is_completed = False
 
 	# Code Review未完成，则继续放一个Checker到SQS
 	if not is_completed:	
 		try:
 			# message_data = dict(type = 'checker', context = context, commit_id = commit_id, request_id = request_id, mode=mode )
 			message = base.encode_base64(base.dump_json(event))
-			sqs.send_message(QueueUrl=TASK_SQS_URL, MessageBody=message, DelaySeconds=10 )
-			print(f'Code review is not complete, resend checker back to SQS:', event)
+			sqs.send_message(QueueUrl=TASK_SQS_URL, MessageBody=message, DelaySeconds=CHECKER_DELAY_SECONDS )
+			logger.info('Code review is not complete, resend checker back to SQS.', delay=CHECKER_DELAY_SECONDS)
 		except Exception as ex:
 			raise Exception('Fail to create checker repeatly.') from ex
 
@@ -108,9 +185,54 @@ def handle_progress_check(record, event, context):
 	try:
 		sqs.delete_message(QueueUrl=TASK_SQS_URL, ReceiptHandle=record["receiptHandle"])
 	except Exception as ex:
-		print('Fail to delete the old checker:' , ex)
-
-def invoke_claude3(model, prompt_data, task_name):
+		logger.warning('Fail to delete the old checker.', error=str(ex))
+
+class ReplyTruncatedException(Exception):
+	"""
+	Lambda即将超时，流式输出被提前结束，reply为已收到的部分输出。
+	"""
+	def __init__(self, message, reply):
+		super().__init__(message)
+		self.reply = reply
+
+def read_claude3_stream(response, task_name, on_text, task_metrics):
+	texts, usage, start = [], {}, time.perf_counter()
+	for event in response.get('body'):
+		chunk = json.loads(event.get('chunk', {}).get('bytes', b'{}'))
+		if chunk.get('type') == 'message_start':
+			usage.update(chunk.get('message', {}).get('usage', {}))
+		elif chunk.get('type') == 'content_block_delta':
+			text = chunk.get('delta', {}).get('text', '')
+			if not texts:
+				task_metrics.add('first_token_ms', (time.perf_counter() - start) * 1000)
+			texts.append(text)
+			if on_text: on_text(text)
+		elif chunk.get('type') == 'message_delta':
+			usage.update(chunk.get('usage', {}))
+			usage['stop_reason'] = chunk.get('delta', {}).get('stop_reason')
+
+		if lambda_deadline and time.time() > lambda_deadline:
+			task_metrics.add_usage(usage)
+			response.get('body').close()
+			raise ReplyTruncatedException(f'Lambda is about to time out while streaming reply for {task_name}.', ''.join(texts))
+
+	logger.info('Bedrock - Claude3 usage.', task=task_name, usage=usage)
+	task_metrics.add_usage(usage)
+	return ''.join(texts)
+
+def get_inference_profile_id(llm_id):
+	"""
+	Claude 3.5 Haiku和Claude 3.7 Sonnet只能通过跨区域推理配置文件调用，模型ID需要加上区域前缀，例如us.anthropic.claude-3-7-sonnet-20250219-v1:0。
+	"""
+	prefix = BEDROCK_INFERENCE_PROFILE
+	if not prefix:
+		region = os.getenv('AWS_REGION') or os.getenv('AWS_DEFAULT_REGION') or 'us-east-1'
+		prefix = { 'eu': 'eu', 'ap': 'apac' }.get(region.split('-')[0], 'us')
+	return f'{prefix}.{llm_id}'
+
+def invoke_claude3(model, prompt_data, task_name, on_text=None, task_metrics=None):
+
+	task_metrics = task_metrics or metrics.Metrics('review')
 
 	params = dict(
 		max_tokens = MAX_TOKEN_TO_SAMPLE,
@@ -119,7 +241,12 @@ def invoke_claude3(model, prompt_data, task_name):
 		anthropic_version= 'bedrock-2023-05-31',
 	)
 	
-	if prompt_data.get('prompt_system'):
+	if prompt_data.get('prompt_prefix'):
+		# 代码作为稳定前缀放在最前面并标记cache_control，同一请求的其他规则可复用缓存的前缀
+		params['system'] = [ dict(type='text', text=prompt_data.get('prompt_prefix'), cache_control=dict(type='ephemeral')) ]
+		if prompt_data.get('prompt_system'):
+			params['system'].append(dict(type='text', text=prompt_data.get('prompt_system')))
+	elif prompt_data.get('prompt_system'):
 		params['system'] = prompt_data.get('prompt_system')
 	
 	params['messages'] = [
@@ -140,88 +267,266 @@ def invoke_claude3(model, prompt_data, task_name):
 		llm_id = 'anthropic.claude-3-sonnet-20240229-v1:0'
 	elif model == 'claude3-haiku':
 		llm_id = 'anthropic.claude-3-haiku-20240307-v1:0'
+	elif model == 'claude3.5-haiku':
+		llm_id = get_inference_profile_id('anthropic.claude-3-5-haiku-20241022-v1:0')
+	elif model == 'claude3.7-sonnet':
+		llm_id = get_inference_profile_id('anthropic.claude-3-7-sonnet-20250219-v1:0')
 	elif model == 'claude3': # 默认使用Sonnet
 		llm_id = 'anthropic.claude-3-sonnet-20240229-v1:0'
 	else:
 		raise Exception(f'Invalid claude3 model {model}')
 		
+	if BEDROCK_STREAMING:
+		try:
+			logger.debug('Bedrock - Invoking claude3 with response stream.', model=llm_id, params=params)
+			response = bedrock.invoke_model_with_response_stream(body=base.dump_json(params), modelId=llm_id)
+			reply = read_claude3_stream(response, task_name, on_text, task_metrics)
+			logger.debug('Bedrock - Claude3 replied.', reply=reply)
+			return reply
+		except ReplyTruncatedException:
+			raise
+		except Exception as ex:
+			raise Exception(f'Fail to invoke Claude3 with response stream: {ex}') from ex
+
 	try:
-		print(f'Bedrock - Invoking claude3 for {task_name}:', base.dump_json(params))
+		logger.debug('Bedrock - Invoking claude3.', model=llm_id, params=params)
 		response = bedrock.invoke_model(body=base.dump_json(params), modelId=llm_id)
 		response_body = json.loads(response.get('body').read())
 		reply = response_body.get('content')[0]
-		print(f'Bedrock - Claude3 replied for {task_name}:', base.dump_json(reply))
+		logger.debug('Bedrock - Claude3 replied.', reply=reply)
+		logger.info('Bedrock - Claude3 usage.', task=task_name, usage=response_body.get('usage'))
+		task_metrics.add_usage(response_body.get('usage'))
 		return reply['text']
 	except Exception as ex:
 		raise Exception(f'Fail to invoke Claude3: {ex}') from ex
 
-def invoke_bedrock(model, full_prompt, task_name):
+def invoke_bedrock(model, full_prompt, task_name, on_text=None, task_metrics=None):
 	# 这里可以设置策略来选择LLM，此处暂时仅仅选择Claude3
-	if model in ['claude3', 'claude3-haiku', 'claude3-sonnet', 'claude3-opus']:
-		reply = invoke_claude3(model, full_prompt, task_name)
+	if model in ['claude3', 'claude3-haiku', 'claude3-sonnet', 'claude3-opus', 'claude3.5-haiku', 'claude3.7-sonnet']:
+		reply = invoke_claude3(model, full_prompt, task_name, on_text, task_metrics)
 	return reply
 
 def validate_sqs_event(event):
-	required = [ 'context', 'commit_id', 'mode', 'model', 'rule_name', 'prompt_data' ]
+	required = [ 'context', 'commit_id', 'mode', 'model', 'rule_name' ]
 	for field in required:
 		if field not in event:
 			raise Exception(f'SQS event does not have field {field} - {event}')
+	if 'prompt_data' not in event and 'prompt_ref' not in event:
+		raise Exception(f'SQS event does not have field prompt_data or prompt_ref - {event}')
 	return True
 
+def make_cached_prompt(prompt_data, code):
+	"""
+	把代码移到只与代码有关的稳定前缀中，规则提示词中的{{code}}改为引用该前缀。
+	"""
+	prompt_data = base.fill_code(prompt_data, PROMPT_CODE_REFERENCE)
+	prompt_data['prompt_prefix'] = PROMPT_CODE_PREFIX + '<code>\n' + code + '\n</code>'
+	return prompt_data
+
+def load_prompt_data(event, model):
+	# Claim-Check：提示词或代码块存放在S3中时按引用取回；代码作为共享片段时在此填入
+	if event.get('prompt_ref'):
+		prompt_data = json.loads(payload_store.get_payload(event['prompt_ref']))
+	else:
+		prompt_data = event['prompt_data']
+
+	code = None
+	if event.get('code_ref'):
+		code = payload_store.get_payload(event['code_ref'])
+	elif event.get('code') is not None:
+		code = event['code']
+
+	if code is None:
+		return prompt_data
+	if model in PROMPT_CACHE_MODELS:
+		return make_cached_prompt(prompt_data, code)
+	return base.fill_code(prompt_data, code)
+
+class PartialFindings:
+	"""
+	流式输出时增量解析审核结果，并按间隔保存到Task表，调用失败或Lambda超时时不丢失已生成的结果。
+	"""
+	def __init__(self, request_id, number, mode):
+		self.request_id = request_id
+		self.number = number
+		self.mode = mode
+		self.stream = findings_parser.FindingsStream()
+		self.saved_count = 0
+		self.save_time = 0
+
+	def feed(self, text):
+		if self.stream.feed(text) and time.time() - self.save_time >= STREAM_SAVE_INTERVAL:
+			self.save()
+
+	def save(self):
+		findings = self.stream.findings
+		if len(findings) <= self.saved_count: return
+		try:
+			save_partial_task(self.request_id, self.number, self.mode, findings)
+			self.saved_count = len(findings)
+			self.save_time = time.time()
+		except Exception as ex:
+			logger.warning('Fail to save partial findings for task.', error=str(ex))
+
+class RetryLaterException(Exception):
+	"""
+	任务需要稍后重试，lambda_handler会把消息的可见性超时设置为delay秒并放回SQS。
+	提供event时改为延迟delay秒重新发送event，用于在消息中累计重试次数。
+	"""
+	def __init__(self, message, delay, event=None):
+		super().__init__(message)
+		self.delay = delay
+		self.event = event
+
+def get_retry_delay(receive_count):
+	# 指数退避，并加入随机抖动避免大量任务同时重试
+	delay = min(SQS_BASE_DELAY * 2 ** min(receive_count, 16), SQS_MAX_DELAY)
+	return int(delay * random.uniform(0.5, 1.0)) + 1
+
 def handle_code_review(record, event, context):
+	task_metrics = metrics.Metrics('review', project=context.get('project_name'), model=event.get('model'))
+	try:
+		review_task(record, event, context, task_metrics)
+	finally:
+		task_metrics.flush(event.get('commit_id'), event.get('request_id'))
+
+def review_task(record, event, context, task_metrics):
 
-	print('Task Event:', base.dump_json(event))
-	print('Task Context:', base.dump_json(context))
+	logger.bind(stage='review', request_id=event.get('request_id'), commit_id=event.get('commit_id'), number=event.get('number'))
+	logger.debug('Task Event.', event=event)
 
 	request_id = event.get('request_id')
 	number = event.get('number')
 	label = f'task(request_id={request_id}, number={number})'
-	print(f'Try to do code review for {label}...')
+	logger.info('Try to do code review for task.', rule_name=event.get('rule_name'), filepath=event.get('filepath'))
 
 	# 校验SQS Event必要字段
 	validate_sqs_event(event)
 	mode 				= event['mode']
 	model 				= event['model'].lower()
 	commit_id 			= event['commit_id']
-	prompt_data 		= event['prompt_data']
 	current_timestamp 	= datetime.datetime.now()
 
-	error_messages = []
-	retries, delay = 0, SQS_BASE_DELAY
-	while retries < SQS_MAX_RETRIES:
+	# ApproximateReceiveCount也包含因没有并发额度而放回SQS的次数，只用于退避；调用失败的次数记录在消息中
+	receive_count 		= base.str_to_int(record.get('attributes', {}).get('ApproximateReceiveCount', '1'))
+	sent_timestamp 		= base.str_to_int(record.get('attributes', {}).get('SentTimestamp', '0'))
+	attempts 			= base.str_to_int(str(event.get('attempts', 0)))
+	throttles 			= base.str_to_int(str(event.get('throttles', 0)))
+	if sent_timestamp:
+		task_metrics.add('queue_wait_ms', time.time() * 1000 - sent_timestamp)
+
+	# 同一分支已有更新的请求时不再调用Bedrock
+	superseded_by = request_dedupe.get_superseding_request(context, request_id)
+	if superseded_by:
+		logger.info('Skip task: request is superseded by a newer request.', superseded_by=superseded_by)
+		task_metrics.add('superseded', 1)
+		with task_metrics.timer('ddb'):
+			item = update_superseded_task(commit_id, request_id, number, mode, superseded_by, context)
+		if is_review_complete(item):
+			try:
+				complete_review(record, event, context)
+			except Exception as ex:
+				logger.exception('Fail to complete code review.', error=str(ex))
+		return
+
+	# 没有可用的Bedrock并发额度时不在Lambda中等待，延迟后重新投递
+	if not bedrock_limiter.limiter.acquire(model):
+		task_metrics.add('limiter_rejects', 1)
+		raise RetryLaterException(f'No Bedrock concurrency is available for {label}.', get_retry_delay(receive_count))
+
+	throttled, error_message, item = False, None, None
+	partial = PartialFindings(request_id, number, mode)
+	try:
+		if attempts + throttles > 0:
+			task_metrics.add('retries', 1)
+			logger.info('Retry for task.', times=attempts + throttles, errors=attempts, throttles=throttles)
+
+		# 调用LLM
+		prompt_data = load_prompt_data(event, model)
+		try:
+			with task_metrics.timer('bedrock'):
+				reply = invoke_bedrock(model, prompt_data, label, partial.feed, task_metrics)
+			findings, truncated = findings_parser.extract_findings(reply), False
+		except ReplyTruncatedException as ex:
+			# 重试同样会超时，直接使用已经完整输出的结果；无法从截断的回复中解析时使用流式解析得到的结果
+			try:
+				findings = findings_parser.extract_findings(ex.reply) or partial.stream.findings
+			except ValueError:
+				findings = partial.stream.findings
+			truncated = True
+			logger.warning('Reply is truncated, use findings received so far.', error=str(ex), count=len(findings))
+		result = report.make_task_result(commit_id, request_id, event['rule_name'], findings, str(current_timestamp), event.get('filepaths'))
+
+		with task_metrics.timer('ddb'):
+			item = update_complete_task(commit_id, request_id, number, mode, result, truncated)
+		task_metrics.add('findings', len(findings))
+		logger.info('Review result is saved.', count=len(findings), truncated=truncated)
+		if not truncated:
+			result_cache.put_result(event.get('cache_key'), findings)
+
+	except Exception as ex:
+		throttled = bedrock_limiter.is_throttling_error(ex)
+		task_metrics.add('throttles' if throttled else 'errors', 1)
+		logger.exception('Fail to process SQS record.', times=attempts + throttles + 1, error=str(ex))
+		error_message = dict(err=str(ex), traceback=traceback.format_exc())
+		partial.save()
+	finally:
+		bedrock_limiter.limiter.release(model, throttled)
+
+	if error_message:
+		# 未超过重试次数时带上累计的失败次数重新发送，延迟后重试
+		if throttled:
+			throttles += 1
+			tries, max_retries = throttles, SQS_MAX_THROTTLE_RETRIES
+		else:
+			attempts += 1
+			tries, max_retries = attempts, SQS_MAX_RETRIES
+		if tries < max_retries:
+			raise RetryLaterException(f'Fail to process {label}, throttled({throttled}).', get_retry_delay(tries), dict(event, attempts=attempts, throttles=throttles))
+
+		# 重试次数用尽时，优先使用之前保存的部分结果
+		findings = load_partial_findings(request_id, number)
+		if findings:
+			result = report.make_task_result(commit_id, request_id, event['rule_name'], findings, str(current_timestamp), event.get('filepaths'))
+			with task_metrics.timer('ddb'):
+				item = update_complete_task(commit_id, request_id, number, mode, result, True)
+			task_metrics.add('partial_results', 1)
+			logger.info('Partial review result is saved.', attempts=attempts + throttles, count=len(findings))
+		else:
+			with task_metrics.timer('ddb'):
+				item = update_failure_task(commit_id, request_id, number, mode, base.dump_json([ error_message ]))
+			task_metrics.add('task_failures', 1)
+			logger.info('Review failure is saved.', attempts=attempts + throttles)
+
+	# 最后一个完成的子任务直接生成报告，Checker仅作为超时兜底
+	if is_review_complete(item):
 		try:
-			if retries > 0:
-				print(f'Retry for the {retries} times...')
-				
-			# 调用LLM
-			reply = invoke_bedrock(model, prompt_data, label)
-			result = dict(
-				commit_id = commit_id,
-				request_id = request_id,
-				rule = event['rule_name'],
-				content = eval(reply),
-				timestamp = str(current_timestamp),
-			)
-
-			update_complete_task(commit_id, request_id, number, mode, result)
-			print(f'Review result is saved in {label}: {result}')
-			return 
-   
+			complete_review(record, event, context)
 		except Exception as ex:
-			retries += 1
-			delay = min(delay * 2, SQS_MAX_DELAY)  # 计算下一次重试的延迟时间
-			print(f'Fail to process SQS record for the {retries} times: {ex}')
-			traceback.print_exc()
-			error_messages.append(dict(err=ex, traceback=traceback.format_exc()))
-			print(f"Retrying in {delay} seconds...")
-			time.sleep(delay)  # 延迟一段时间后重试
-	
-	update_failure_task(commit_id, request_id, number, mode, base.dump_json(error_messages))
-	# 跳出循环即表示重试多次失败
-	print(f'Review failure is saved in {label}.')
-	raise Exception(f'Fail to process {label} for {SQS_MAX_RETRIES} times')
+			logger.exception('Fail to complete code review.', error=str(ex))
+
+def save_partial_task(request_id, number, mode, findings):
+	# succ为False，生成报告时不会被统计；任务完成时被完整结果覆盖
+	datetime_str = str(datetime.datetime.now())
+	dynamodb.Table(TASK_TABLE).put_item(Item={
+		'request_id': request_id,
+		'number': number,
+		'mode': mode,
+		'succ': False,
+		'partial_findings': base.dump_json(findings),
+		'create_time': datetime_str,
+		'update_time': datetime_str,
+	})
+
+def load_partial_findings(request_id, number):
+	try:
+		item = dynamodb.Table(TASK_TABLE).get_item(Key=dict(request_id=request_id, number=number)).get('Item') or {}
+		return json.loads(item.get('partial_findings', '[]'))
+	except Exception as ex:
+		logger.warning('Fail to load partial findings for task.', error=str(ex))
+		return []
 
-def update_complete_task(commit_id, request_id, number, mode, result):
+def update_complete_task(commit_id, request_id, number, mode, result, partial=False):
 	try:
 		datetime_str = str(datetime.datetime.now())
 		# 更新Task表
@@ -230,17 +535,19 @@ def update_complete_task(commit_id, request_id, number, mode, result):
 			'number': number,
 			'mode': mode,
 			'succ': True,
+			'partial': partial,
 			'result': base.dump_json(result),
 			'create_time': datetime_str,
 			'update_time': datetime_str,
 		})
 		# 更新Request表
-		dynamodb.Table(REQUEST_TABLE).update_item(
+		response = dynamodb.Table(REQUEST_TABLE).update_item(
 			Key = { 'commit_id': commit_id, 'request_id': request_id },
 			UpdateExpression = 'set task_status = :s, task_complete = task_complete + :tc, update_time = :t',
 			ExpressionAttributeValues = { ':s': 'LLM_PROCESSING', ':tc': 1, ':t': datetime_str },
 			ReturnValues = 'ALL_NEW'
 		)
+		return response.get('Attributes')
 	except Exception as e:
 		raise Exception (f'Fail to update TASK COMPLETE for commit_id({commit_id}) and mode({mode}).') from e
 	
@@ -258,52 +565,89 @@ def update_failure_task(commit_id, request_id, number, mode, error_message):
 			'update_time': datetime_str,
 		})
 		# 更新Request表
-		dynamodb.Table(REQUEST_TABLE).update_item(
-			Key = {'commit_id': commit_id, 'scan_scope': mode},
+		response = dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = {'commit_id': commit_id, 'request_id': request_id},
 			UpdateExpression = 'set task_status = :s, task_failure = task_failure + :tf, update_time = :t',
 			ExpressionAttributeValues = { ':s': 'LLM_PROCESSING', ':tf': 1, ':t': datetime_str },
 			ReturnValues = 'ALL_NEW'
 		)
+		return response.get('Attributes')
 	except Exception as ex:
-		print(f'Fail to update TASK FAILURE for commit_id({commit_id}) and mode({mode}).')
+		logger.exception('Fail to update TASK FAILURE.', mode=mode, error=str(ex))
 	
-def lambda_handler(event, context):
-
-	print('Event:', base.dump_json(event))
-	print('Receiving {} SQS records'.format(len(event["Records"])))
-
-	clients = dict(dynamodb=dynamodb, sqs=sqs, sns=sns)
-	
-	batch_item_failures, batch_item_successes = [], []
-	for record in event["Records"]:
-		
-		print('Processing SQS record:', record)
-
+def update_superseded_task(commit_id, request_id, number, mode, superseded_by, context):
+	# 记为失败的任务，使请求仍能完成并生成报告；首次记录取代时释放去重登记，相同的事件可以重新发起审核
+	item = update_failure_task(commit_id, request_id, number, mode, base.dump_json([ dict(err=f'Superseded by request {superseded_by}.') ]))
+	if item is not None and not item.get('superseded_by'):
+		dynamodb.Table(REQUEST_TABLE).update_item(
+			Key = {'commit_id': commit_id, 'request_id': request_id},
+			UpdateExpression = 'set superseded_by = :b',
+			ExpressionAttributeValues = { ':b': superseded_by },
+		)
+		try:
+			request_dedupe.release_review(context)
+		except Exception as ex:
+			logger.warning('Fail to release review registration.', error=str(ex))
+	return item
+
+def process_record(record):
+	"""
+	处理单条SQS消息，成功返回True，需要放回SQS重试返回False。
+	"""
+	logger.start(message_id=record.get('messageId'))
+	try:
 		base64_text = record["body"]
 		body_text = decode_base64(base64_text)
-		print('Plain body:', body_text)
+		logger.debug('Plain body.', body=body_text)
 		
 		sqs_event = json.loads(body_text)
 		sqs_context = sqs_event.get('context', {})
 
-		# commit_id = sqs_event.get('commit_id')
-		# mode = sqs_event.get('mode')
-
 		if sqs_event.get('type') == 'checker':
-			try:
-				handle_progress_check(record, sqs_event, sqs_context)
-				batch_item_successes.append({"itemIdentifier": record['messageId']})
-			except Exception as ex:
-				print('Fail to check code review result: {}: {}'.format(ex, traceback.format_exc()))
-				batch_item_failures.append({"itemIdentifier": record['messageId']})
+			handle_progress_check(record, sqs_event, sqs_context)
 		else:
+			handle_code_review(record, sqs_event, sqs_context)
+		return True
+
+	except RetryLaterException as ex:
+		if ex.event is not None:
 			try:
-				result = handle_code_review(record, sqs_event, sqs_context)
-				batch_item_successes.append({"itemIdentifier": record['messageId']})
-			except Exception as ex:
-				print('Fail to check code review result: {}: {}'.format(ex, traceback.format_exc()))
-				batch_item_failures.append({"itemIdentifier": record['messageId']})
+				# 重新发送后原消息按成功处理并被删除
+				sqs.send_message(QueueUrl=TASK_SQS_URL, MessageBody=encode_base64(base.dump_json(ex.event)), DelaySeconds=min(ex.delay, 900))
+				logger.info('Send the task back to queue.', delay=ex.delay, attempts=ex.event.get('attempts'), throttles=ex.event.get('throttles'), reason=str(ex))
+				return True
+			except Exception as e:
+				logger.warning('Fail to send the task back to queue.', error=str(e))
+		logger.info('Return the SQS record back to queue.', delay=ex.delay, reason=str(ex))
+		try:
+			sqs.change_message_visibility(QueueUrl=TASK_SQS_URL, ReceiptHandle=record['receiptHandle'], VisibilityTimeout=ex.delay)
+		except Exception as e:
+			logger.warning('Fail to change message visibility.', error=str(e))
+		return False
+	except Exception as ex:
+		logger.exception('Fail to process SQS record.', error=str(ex))
+		return False
+
+def lambda_handler(event, context):
+
+	logger.start(stage='execute')
+	records = event["Records"]
+	logger.info('Receiving SQS records.', count=len(records))
+
+	global lambda_deadline
+	if hasattr(context, 'get_remaining_time_in_millis'):
+		lambda_deadline = time.time() + context.get_remaining_time_in_millis() / 1000 - STREAM_DEADLINE_MARGIN
+
+	# 同一批次的消息并发处理，结果顺序与records一致
+	if record_executor is not None and len(records) > 1:
+		results = list(record_executor.map(process_record, records))
+	else:
+		results = [ process_record(record) for record in records ]
+
+	batch_item_failures = [ {"itemIdentifier": record['messageId']} for record, succ in zip(records, results) if not succ ]
+	logger.info('SQS process results.', succeeded=len(records) - len(batch_item_failures), failed=len(batch_item_failures))
 
-	batch_response = dict(batchItemSeccesses = batch_item_successes, batchItemFailures = batch_item_failures)
-	print('SQS process results:', batch_response)
+	# Partial batch response只识别batchItemFailures，未列出的消息视为成功并被删除
+	batch_response = dict(batchItemFailures = batch_item_failures)
+	logger.debug('SQS batch response.', response=batch_response)
 	return batch_response
@@ -1,3 +1,4 @@
+import { Duration } from 'aws-cdk-lib';
 import { Construct } from 'constructs';
 import { Bucket, BucketEncryption, BlockPublicAccess } from 'aws-cdk-lib/aws-s3';
 
@@ -25,6 +26,14 @@ export class CRBucket extends Construct {
 			versioned: true,
 			serverAccessLogsBucket: access_logs_bucket,
 			serverAccessLogsPrefix: 'logs/',
+			lifecycleRules: [
+				// Claim-Check方式存放的提示词，仅在任务执行期间需要
+				{ prefix: 'payloads/', expiration: Duration.days(7), noncurrentVersionExpiration: Duration.days(1) },
+				// 按Git Blob SHA缓存的文件内容和依赖摘要，过期后按需重新获取
+				{ prefix: 'blob-cache/', expiration: Duration.days(30), noncurrentVersionExpiration: Duration.days(1) },
+				// 整库增量审核的分片清单，过期后退回完整的整库审核
+				{ prefix: 'manifests/', expiration: Duration.days(90), noncurrentVersionExpiration: Duration.days(1) },
+			],
 		});
 	}
 }
\ No newline at end of file
@@ -71,25 +71,63 @@ export class CodeReviewerStack extends cdk.Stack {
 		api.request_handler.addEnvironment('REQUEST_TABLE', database.request_table.tableName)
 		api.request_handler.addEnvironment('REPOSITORY_TABLE', database.repo_table.tableName)
 		api.request_handler.addEnvironment('TASK_DISPATCHER_FUN_NAME', api.task_dispatcher.functionName)
+		api.request_handler.addEnvironment('WEBHOOK_FAST_PATH', 'true')
+		api.request_handler.addEnvironment('RULE_TABLE', database.rule_table.tableName)
+		api.request_handler.addEnvironment('REQUEST_DEDUPE_SECONDS', '86400')
 		
 		api.task_dispatcher.addEnvironment('REQUEST_TABLE', database.request_table.tableName)
 		api.task_dispatcher.addEnvironment('RULE_TABLE', database.rule_table.tableName)
 		api.task_dispatcher.addEnvironment('TASK_SQS_URL', sqs.task_queue.queueUrl)
+		api.task_dispatcher.addEnvironment('SQS_SEND_CONCURRENCY', '8')
+		api.task_dispatcher.addEnvironment('GITLAB_FETCH_CONCURRENCY', '8')
+		api.task_dispatcher.addEnvironment('GITLAB_FETCH_RATE', '0')
+		api.task_dispatcher.addEnvironment('GITLAB_SNAPSHOT_MODE', 'archive')
+		api.task_dispatcher.addEnvironment('BLOB_CACHE_BUCKET', buckets.report_bucket.bucketName)
+		api.task_dispatcher.addEnvironment('BLOB_CACHE_PREFIX', 'blob-cache')
+		api.task_dispatcher.addEnvironment('TASK_TABLE', database.task_table.tableName)
+		api.task_dispatcher.addEnvironment('PAYLOAD_BUCKET', buckets.report_bucket.bucketName)
+		api.task_dispatcher.addEnvironment('PAYLOAD_MIN_BYTES', '65536')
+		api.task_dispatcher.addEnvironment('BUCKET_NAME', buckets.report_bucket.bucketName)
+		api.task_dispatcher.addEnvironment('ALL_INCREMENTAL', 'true')
+		api.task_dispatcher.addEnvironment('PROMPT_CODE_MODE', 'shared')
+		api.task_dispatcher.addEnvironment('RESULT_CACHE_TABLE', database.result_cache_table.tableName)
+		api.task_dispatcher.addEnvironment('RESULT_CACHE_TTL_DAYS', '30')
+		api.task_dispatcher.addEnvironment('DIFF_CONTEXT_LINES', '20')
+		api.task_dispatcher.addEnvironment('DIFF_EXPAND_SCOPE', 'true')
+		api.task_dispatcher.addEnvironment('CONTEXT_MODES', 'single')
+		api.task_dispatcher.addEnvironment('CONTEXT_MAX_TOKENS', '20000')
+		api.task_dispatcher.addEnvironment('CONTEXT_MAX_FILES', '10')
+		api.task_dispatcher.addEnvironment('SHARD_MAX_TOKENS', '100000')
+		api.task_dispatcher.addEnvironment('BATCH_MAX_TOKENS', '20000')
+		api.task_dispatcher.addEnvironment('BATCH_SMALL_FILE_TOKENS', '4000')
 
 		api.task_executor.addEnvironment('BUCKET_NAME', buckets.report_bucket.bucketName)
+		api.task_executor.addEnvironment('PAYLOAD_BUCKET', buckets.report_bucket.bucketName)
 		api.task_executor.addEnvironment('REQUEST_TABLE', database.request_table.tableName)
 		api.task_executor.addEnvironment('RULE_TABLE', database.rule_table.tableName)
 		api.task_executor.addEnvironment('TASK_TABLE', database.task_table.tableName)
 		api.task_executor.addEnvironment('TASK_SQS_URL', sqs.task_queue.queueUrl)
 		api.task_executor.addEnvironment('SNS_TOPIC_ARN', sns.report_topic.topicArn)
 		api.task_executor.addEnvironment('SQS_MAX_RETRIES', '5')
+		api.task_executor.addEnvironment('SQS_MAX_THROTTLE_RETRIES', '50')
+		api.task_executor.addEnvironment('SQS_RECORD_CONCURRENCY', '10')
 		api.task_executor.addEnvironment('SQS_BASE_DELAY', '2')
 		api.task_executor.addEnvironment('SQS_MAX_DELAY', '60')
 		api.task_executor.addEnvironment('TEMPERATURE', '0')
+		api.task_executor.addEnvironment('PROMPT_CACHE_MODELS', 'claude3.5-haiku,claude3.7-sonnet')
+		api.task_executor.addEnvironment('BEDROCK_STREAMING', 'true')
+		api.task_executor.addEnvironment('STREAM_SAVE_INTERVAL', '5')
+		api.task_executor.addEnvironment('STREAM_DEADLINE_MARGIN', '30')
 		api.task_executor.addEnvironment('TOP_P', '0.5')
 		api.task_executor.addEnvironment('MAX_TOKEN_TO_SAMPLE', '10000')
 		api.task_executor.addEnvironment('MAX_FAILED_TIMES', '6')
 		api.task_executor.addEnvironment('REPORT_TIMEOUT_SECONDS', '900')
+		api.task_executor.addEnvironment('CHECKER_DELAY_SECONDS', '300')
+		api.task_executor.addEnvironment('RESULT_CACHE_TABLE', database.result_cache_table.tableName)
+		api.task_executor.addEnvironment('RESULT_CACHE_TTL_DAYS', '30')
+		api.task_executor.addEnvironment('BEDROCK_LIMITER_TABLE', database.limiter_table.tableName)
+		api.task_executor.addEnvironment('BEDROCK_INITIAL_CONCURRENCY', '4')
+		api.task_executor.addEnvironment('BEDROCK_MAX_CONCURRENCY', '32')
 
 		api.report_receiver.addEnvironment('SMTP_SERVER', smtp_server.valueAsString)
 		api.report_receiver.addEnvironment('SMTP_PORT', smtp_port.valueAsString)
@@ -98,12 +136,22 @@ export class CodeReviewerStack extends cdk.Stack {
 		api.report_receiver.addEnvironment('REPORT_SENDER', report_sender.valueAsString)
 		api.report_receiver.addEnvironment('REPORT_RECEIVER', report_receiver.valueAsString)
 
+		for (const fn of [ api.data_initializer, api.request_handler, api.task_dispatcher, api.task_executor, api.report_receiver ]) {
+			fn.addEnvironment('LOG_LEVEL', 'INFO')
+			fn.addEnvironment('LOG_MAX_VALUE_CHARS', '1000')
+			fn.addEnvironment('LOG_DEBUG_SAMPLE_RATE', '0.01')
+			fn.addEnvironment('METRICS_NAMESPACE', 'CodeReviewer')
+			fn.addEnvironment('CONFIG_CACHE_TTL', '300')
+			fn.addEnvironment('CONFIG_CHECK_INTERVAL', '30')
+		}
+
 		/* 触发Lambda */
-		api.task_executor.addEventSource(new SqsEventSource(sqs.task_queue))
+		api.task_executor.addEventSource(new SqsEventSource(sqs.task_queue, { reportBatchItemFailures: true }))
 		api.report_receiver.addEventSource(new SnsEventSource(sns.report_topic))
 
 		/* 权限配置 */
 		buckets.report_bucket.grantReadWrite(api.task_executor)
+		buckets.report_bucket.grantReadWrite(api.task_dispatcher)
 		
 		database.repo_table.grantReadWriteData(api.request_handler)
 		
@@ -112,11 +160,17 @@ export class CodeReviewerStack extends cdk.Stack {
 		database.request_table.grantReadWriteData(api.task_executor)
 
 		database.repo_table.grantReadData(api.request_handler)
+		database.rule_table.grantReadData(api.request_handler)
 		database.repo_table.grantWriteData(api.data_initializer)
 		database.rule_table.grantWriteData(api.data_initializer)
 		database.rule_table.grantReadData(api.task_dispatcher)
 
 		database.task_table.grantReadWriteData(api.task_executor)
+		database.task_table.grantReadWriteData(api.task_dispatcher)
+
+		database.result_cache_table.grantReadData(api.task_dispatcher)
+		database.result_cache_table.grantReadWriteData(api.task_executor)
+		database.limiter_table.grantReadWriteData(api.task_executor)
 		
 		sqs.task_queue.grantSendMessages(api.task_dispatcher)
 		sqs.task_queue.grantSendMessages(api.task_executor)
@@ -10,6 +10,8 @@ export class CRDatabase extends Construct {
 	public readonly task_table: dynamodb.Table;
 	public readonly repo_table: dynamodb.Table;
 	public readonly rule_table: dynamodb.Table;
+	public readonly result_cache_table: dynamodb.Table;
+	public readonly limiter_table: dynamodb.Table;
 
 	constructor(scope: Construct, id: string, props: { prefix: string }) {
 		super(scope, id);
@@ -34,6 +36,8 @@ export class CRDatabase extends Construct {
 			encryption: dynamodb.TableEncryption.AWS_MANAGED,
 			stream: dynamodb.StreamViewType.NEW_IMAGE,
 			pointInTimeRecovery: true,
+			// 只有去重、投递和分支记录(request_id以#开头)设置expire_time
+			timeToLiveAttribute: 'expire_time',
 		})
 
 		/* Task Table */
@@ -57,6 +61,23 @@ export class CRDatabase extends Construct {
 			stream: dynamodb.StreamViewType.NEW_IMAGE,
 			pointInTimeRecovery: true,
 		})
+
+		/* Result Cache Table */
+		this.result_cache_table = new dynamodb.Table(this, 'ResultCacheTable', {
+			tableName: `${props.prefix}-result-cache`,
+			partitionKey: { name: 'cache_key', type: dynamodb.AttributeType.STRING },
+			billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+			encryption: dynamodb.TableEncryption.AWS_MANAGED,
+			timeToLiveAttribute: 'expire_time',
+		})
+
+		/* Bedrock Limiter Table */
+		this.limiter_table = new dynamodb.Table(this, 'LimiterTable', {
+			tableName: `${props.prefix}-limiter`,
+			partitionKey: { name: 'model', type: dynamodb.AttributeType.STRING },
+			billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+			encryption: dynamodb.TableEncryption.AWS_MANAGED,
+		})
 		
 	}
 
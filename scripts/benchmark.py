@@ -0,0 +1,729 @@
+"""
+离线基准测试：在进程内依次驱动 request_handler → task_dispatcher → task_executor → report，
+Gitlab、DynamoDB、SQS、S3、SNS、Lambda和Bedrock均使用内存中的替身，不访问任何AWS资源。
+
+示例：
+	python scripts/benchmark.py --mode all --files 500 --requests 3
+	python scripts/benchmark.py --mode diff --changed 50 --bedrock-latency 0.5 --throttle-rate 0.1 --json
+"""
+import os, io, re, sys, json, time, copy, types, random, tarfile, difflib, hashlib, argparse, resource
+import threading, tempfile, tracemalloc, contextlib, collections
+from concurrent.futures import ThreadPoolExecutor
+
+LAMBDA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda')
+
+# 各替身服务的API调用次数
+calls = collections.Counter()
+calls_lock = threading.Lock()
+
+def count_call(name):
+	with calls_lock:
+		calls[name] += 1
+
+# ---------------------------------------------------------------------------
+# botocore异常
+# ---------------------------------------------------------------------------
+
+try:
+	from botocore.exceptions import ClientError
+except ImportError:
+	class ClientError(Exception):
+		def __init__(self, error_response, operation_name):
+			super().__init__(f'An error occurred ({error_response.get("Error", {}).get("Code")}) when calling the {operation_name} operation')
+			self.response = error_response
+			self.operation_name = operation_name
+	botocore = types.ModuleType('botocore')
+	botocore.exceptions = types.ModuleType('botocore.exceptions')
+	botocore.exceptions.ClientError = ClientError
+	sys.modules['botocore'] = botocore
+	sys.modules['botocore.exceptions'] = botocore.exceptions
+
+def make_error(code, operation):
+	return ClientError({ 'Error': { 'Code': code, 'Message': code } }, operation)
+
+class ConditionalCheckFailedException(ClientError):
+	def __init__(self):
+		super().__init__({ 'Error': { 'Code': 'ConditionalCheckFailedException' } }, 'UpdateItem')
+
+class NoSuchKey(ClientError):
+	def __init__(self):
+		super().__init__({ 'Error': { 'Code': 'NoSuchKey' } }, 'GetObject')
+
+# ---------------------------------------------------------------------------
+# DynamoDB
+# ---------------------------------------------------------------------------
+
+class Expression:
+	"""
+	DynamoDB表达式的最小实现，覆盖本项目用到的 set / add / remove、算术、比较和attribute_(not_)exists。
+	"""
+	def __init__(self, names, values):
+		self.names = names or {}
+		self.values = values or {}
+
+	def path(self, text):
+		return [ self.names.get(part, part) for part in text.strip().split('.') ]
+
+	def get(self, item, path):
+		for part in path:
+			if not isinstance(item, dict) or part not in item:
+				return None
+			item = item[part]
+		return item
+
+	def put(self, item, path, value):
+		parent = self.get(item, path[:-1]) if len(path) > 1 else item
+		if not isinstance(parent, dict):
+			raise make_error('ValidationException', 'UpdateItem')
+		parent[path[-1]] = value
+
+	def operand(self, item, text):
+		text = text.strip()
+		if text.startswith(':'):
+			return self.values[text]
+		value = self.get(item, self.path(text))
+		if value is None:
+			raise make_error('ValidationException', 'UpdateItem')
+		return value
+
+	def update(self, item, expression):
+		for action, body in re.findall(r'(?i)\b(set|add|remove)\s+(.*?)(?=\b(?:set|add|remove)\s+|$)', expression):
+			action = action.lower()
+			for clause in [ clause.strip() for clause in body.split(',') if clause.strip() ]:
+				if action == 'set':
+					target, value = clause.split('=', 1)
+					match = re.match(r'(.+?)\s*([+-])\s*(.+)', value.strip())
+					if match:
+						left, right = self.operand(item, match.group(1)), self.operand(item, match.group(3))
+						result = left + right if match.group(2) == '+' else left - right
+					else:
+						result = copy.deepcopy(self.operand(item, value))
+					self.put(item, self.path(target), result)
+				elif action == 'add':
+					target, value = clause.rsplit(None, 1)
+					path = self.path(target)
+					self.put(item, path, (self.get(item, path) or 0) + self.values[value])
+				else:
+					path = self.path(clause)
+					parent = self.get(item, path[:-1]) if len(path) > 1 else item
+					if isinstance(parent, dict):
+						parent.pop(path[-1], None)
+
+	def check(self, item, expression):
+		return any(self.check_all(item, clause) for clause in re.split(r'(?i)\s+or\s+', expression or ''))
+
+	def check_all(self, item, expression):
+		for term in re.split(r'(?i)\s+and\s+', expression):
+			term = term.strip()
+			if not term: continue
+			match = re.match(r'(attribute_not_exists|attribute_exists)\((.+)\)$', term)
+			if match:
+				exists = self.get(item, self.path(match.group(2))) is not None
+				if exists != (match.group(1) == 'attribute_exists'):
+					return False
+				continue
+			left, op, right = re.match(r'(.+?)\s*(<=|>=|<>|=|<|>)\s*(.+)', term).groups()
+			left, right = self.get(item, self.path(left)) if not left.startswith(':') else self.values[left], \
+				self.get(item, self.path(right)) if not right.startswith(':') else self.values[right]
+			if left is None or right is None:
+				return False
+			if not dict([ ('=', left == right), ('<>', left != right), ('<', left < right), ('>', left > right), ('<=', left <= right), ('>=', left >= right) ])[op]:
+				return False
+		return True
+
+class FakeTable:
+	def __init__(self, name, keys):
+		self.name = name
+		self.keys = keys
+		self.items = {}
+		self.lock = threading.Lock()
+
+	def key_of(self, item):
+		return tuple(item.get(key) for key in self.keys)
+
+	def put_item(self, Item, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+		count_call('dynamodb.put_item')
+		with self.lock:
+			key = self.key_of(Item)
+			if ConditionExpression and not Expression(ExpressionAttributeNames, ExpressionAttributeValues).check(self.items.get(key, {}), ConditionExpression):
+				raise ConditionalCheckFailedException()
+			self.items[key] = copy.deepcopy(Item)
+		return {}
+
+	def get_item(self, Key, ConsistentRead=False):
+		count_call('dynamodb.get_item')
+		with self.lock:
+			item = self.items.get(self.key_of(Key))
+			return { 'Item': copy.deepcopy(item) } if item is not None else {}
+
+	@contextlib.contextmanager
+	def batch_writer(self):
+		count_call('dynamodb.batch_writer')
+		items = []
+		yield types.SimpleNamespace(put_item=lambda Item: items.append(Item))
+		with self.lock:
+			for item in items:
+				self.items[self.key_of(item)] = copy.deepcopy(item)
+
+	def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None):
+		count_call('dynamodb.delete_item')
+		with self.lock:
+			key = self.key_of(Key)
+			if ConditionExpression and not Expression(ExpressionAttributeNames, ExpressionAttributeValues).check(self.items.get(key, {}), ConditionExpression):
+				raise ConditionalCheckFailedException()
+			self.items.pop(key, None)
+		return {}
+
+	def update_item(self, Key, UpdateExpression, ConditionExpression=None, ExpressionAttributeNames=None, ExpressionAttributeValues=None, ReturnValues=None):
+		count_call('dynamodb.update_item')
+		expression = Expression(ExpressionAttributeNames, ExpressionAttributeValues)
+		with self.lock:
+			key = self.key_of(Key)
+			item = copy.deepcopy(self.items.get(key, dict(Key)))
+			if ConditionExpression and not expression.check(item if key in self.items else {}, ConditionExpression):
+				raise ConditionalCheckFailedException()
+			expression.update(item, UpdateExpression)
+			self.items[key] = item
+			return { 'Attributes': copy.deepcopy(item) } if ReturnValues == 'ALL_NEW' else {}
+
+	def query(self, KeyConditionExpression, ExpressionAttributeValues, ExpressionAttributeNames=None):
+		count_call('dynamodb.query')
+		name, value = [ part.strip() for part in KeyConditionExpression.split('=') ]
+		name = (ExpressionAttributeNames or {}).get(name, name)
+		value = ExpressionAttributeValues[value]
+		with self.lock:
+			items = [ copy.deepcopy(item) for item in self.items.values() if item.get(name) == value ]
+		return { 'Items': sorted(items, key=lambda item: str(self.key_of(item))) }
+
+class FakeDynamoDB:
+	def __init__(self, schemas):
+		self.tables = { name: FakeTable(name, keys) for name, keys in schemas.items() }
+		self.meta = types.SimpleNamespace(client=types.SimpleNamespace(exceptions=types.SimpleNamespace(
+			ConditionalCheckFailedException=ConditionalCheckFailedException)))
+
+	def Table(self, name):
+		return self.tables[name]
+
+	def batch_get_item(self, RequestItems):
+		count_call('dynamodb.batch_get_item')
+		responses = {}
+		for name, request in RequestItems.items():
+			table = self.tables[name]
+			with table.lock:
+				items = [ table.items.get(table.key_of(key)) for key in request['Keys'] ]
+			responses[name] = [ copy.deepcopy(item) for item in items if item is not None ]
+		return dict(Responses=responses, UnprocessedKeys={})
+
+# ---------------------------------------------------------------------------
+# S3 / SQS / SNS / Lambda
+# ---------------------------------------------------------------------------
+
+class FakeS3:
+	def __init__(self):
+		self.objects = {}
+		self.lock = threading.Lock()
+		self.exceptions = types.SimpleNamespace(NoSuchKey=NoSuchKey)
+		self.meta = types.SimpleNamespace(client=self)
+
+	def put_object(self, Bucket, Key, Body, **kwargs):
+		count_call('s3.put_object')
+		with self.lock:
+			self.objects[(Bucket, Key)] = Body.encode('utf-8') if isinstance(Body, str) else bytes(Body)
+		return {}
+
+	def get_object(self, Bucket, Key):
+		count_call('s3.get_object')
+		with self.lock:
+			if (Bucket, Key) not in self.objects:
+				raise NoSuchKey()
+			return { 'Body': io.BytesIO(self.objects[(Bucket, Key)]) }
+
+	def generate_presigned_url(self, method, Params, ExpiresIn):
+		return 'https://{Bucket}.s3.local/{Key}'.format(**Params)
+
+	def Object(self, bucket, key):
+		s3 = self
+		return types.SimpleNamespace(
+			put = lambda Body, **kwargs: s3.put_object(Bucket=bucket, Key=key, Body=Body),
+			get = lambda: s3.get_object(Bucket=bucket, Key=key),
+			meta = types.SimpleNamespace(client=s3),
+		)
+
+class FakeSQS:
+	"""
+	带可见性超时的内存队列。时间为虚拟时钟，没有可见消息时直接快进到下一条消息可见的时刻。
+	"""
+	def __init__(self, visibility_timeout):
+		self.visibility_timeout = visibility_timeout
+		self.messages = collections.OrderedDict()
+		self.lock = threading.Lock()
+		self.offset = 0
+		self.sequence = 0
+
+	def now(self):
+		return time.time() + self.offset
+
+	def enqueue(self, body, delay):
+		self.sequence += 1
+		message_id = f'msg-{self.sequence}'
+		self.messages[message_id] = dict(id=message_id, body=body, visible_at=self.now() + delay, receive_count=0, sent=int(self.now() * 1000))
+
+	def send_message(self, QueueUrl, MessageBody, DelaySeconds=0):
+		count_call('sqs.send_message')
+		with self.lock:
+			self.enqueue(MessageBody, DelaySeconds)
+		return { 'MessageId': f'msg-{self.sequence}' }
+
+	def send_message_batch(self, QueueUrl, Entries):
+		count_call('sqs.send_message_batch')
+		with self.lock:
+			for entry in Entries:
+				self.enqueue(entry['MessageBody'], entry.get('DelaySeconds', 0))
+		return { 'Successful': [ dict(Id=entry['Id']) for entry in Entries ], 'Failed': [] }
+
+	def change_message_visibility(self, QueueUrl, ReceiptHandle, VisibilityTimeout):
+		count_call('sqs.change_message_visibility')
+		with self.lock:
+			if ReceiptHandle in self.messages:
+				self.messages[ReceiptHandle]['visible_at'] = self.now() + VisibilityTimeout
+
+	def delete_message(self, QueueUrl, ReceiptHandle):
+		count_call('sqs.delete_message')
+		with self.lock:
+			self.messages.pop(ReceiptHandle, None)
+
+	def receive(self, max_count):
+		count_call('sqs.receive_message')
+		with self.lock:
+			now, records = self.now(), []
+			for message in self.messages.values():
+				if len(records) >= max_count: break
+				if message['visible_at'] > now: continue
+				message['receive_count'] += 1
+				message['visible_at'] = now + self.visibility_timeout
+				records.append(dict(
+					messageId = message['id'],
+					receiptHandle = message['id'],
+					body = message['body'],
+					attributes = dict(ApproximateReceiveCount=str(message['receive_count']), SentTimestamp=str(message['sent'])),
+				))
+			return records
+
+	def fast_forward(self):
+		with self.lock:
+			if self.messages:
+				self.offset += max(min(message['visible_at'] for message in self.messages.values()) - self.now(), 0) + 0.001
+
+class FakeSNS:
+	def Topic(self, arn):
+		def publish(Message, Subject):
+			count_call('sns.publish')
+			return { 'MessageId': f'sns-{calls["sns.publish"]}' }
+		return types.SimpleNamespace(publish=publish)
+
+class FakeLambda:
+	def __init__(self):
+		self.invocations = []
+
+	def invoke(self, FunctionName, InvocationType, Payload):
+		count_call('lambda.invoke')
+		self.invocations.append(json.loads(Payload))
+		return { 'StatusCode': 202 }
+
+class FakeContext:
+	def __init__(self, timeout):
+		self.deadline = time.time() + timeout
+
+	def get_remaining_time_in_millis(self):
+		return int((self.deadline - time.time()) * 1000)
+
+# ---------------------------------------------------------------------------
+# Bedrock
+# ---------------------------------------------------------------------------
+
+class StreamBody(list):
+	def close(self):
+		pass
+
+class FakeBedrock:
+	"""
+	按配置的延迟和限流概率返回合成的审核结果，同时模拟Prompt Caching：相同的cache_control前缀再次出现时计为缓存命中。
+	"""
+	def __init__(self, latency, throttle_rate, findings, seed):
+		self.latency = latency
+		self.throttle_rate = throttle_rate
+		self.findings = findings
+		self.random = random.Random(seed)
+		self.lock = threading.Lock()
+		self.prefixes = collections.Counter()
+		self.tokens = collections.Counter()
+
+	def make_usage(self, params):
+		system = params.get('system') or ''
+		blocks = system if isinstance(system, list) else [ dict(text=system) ]
+		texts = [ block.get('text', '') for block in blocks ] + [ content.get('text', '') for message in params.get('messages', []) for content in message.get('content', []) ]
+		usage = dict(input_tokens=sum(len(text) for text in texts) // 4)
+		if blocks and blocks[0].get('cache_control'):
+			digest = hashlib.sha256(blocks[0]['text'].encode('utf-8')).hexdigest()
+			prefix_tokens = len(blocks[0]['text']) // 4
+			with self.lock:
+				hit = digest in self.prefixes
+				self.prefixes[digest] += 1
+			usage['input_tokens'] -= prefix_tokens
+			usage['cache_read_input_tokens' if hit else 'cache_creation_input_tokens'] = prefix_tokens
+		return usage
+
+	def make_reply(self, params):
+		text = json.dumps(params)
+		paths = re.findall(r'([\w./-]+\.py)', text) or [ 'unknown.py' ]
+		findings = [ dict(level=self.random.choice([ 'serious', 'major', 'trivial' ]), title=f'Benchmark finding {index}', content='合成的审核结果', filepath=f'{paths[index % len(paths)]} @ line 1-5') for index in range(self.findings) ]
+		return '```json\n' + json.dumps(findings, ensure_ascii=False) + '\n```'
+
+	def call(self, operation, body):
+		count_call(f'bedrock.{operation}')
+		with self.lock:
+			throttled = self.random.random() < self.throttle_rate
+		if throttled:
+			count_call('bedrock.throttled')
+			raise make_error('ThrottlingException', operation)
+		time.sleep(self.latency)
+		params = json.loads(body)
+		usage = self.make_usage(params)
+		reply = self.make_reply(params)
+		usage['output_tokens'] = len(reply) // 4
+		with self.lock:
+			self.tokens.update(usage)
+		return usage, reply
+
+	def invoke_model(self, body, modelId):
+		usage, reply = self.call('invoke_model', body)
+		data = json.dumps(dict(content=[ dict(type='text', text=reply) ], usage=usage, stop_reason='end_turn'))
+		return { 'body': io.BytesIO(data.encode('utf-8')) }
+
+	def invoke_model_with_response_stream(self, body, modelId):
+		usage, reply = self.call('invoke_model_with_response_stream', body)
+		chunk = lambda data: { 'chunk': { 'bytes': json.dumps(data).encode('utf-8') } }
+		input_usage = { key: value for key, value in usage.items() if key != 'output_tokens' }
+		events = [ chunk(dict(type='message_start', message=dict(usage=input_usage))) ]
+		events += [ chunk(dict(type='content_block_delta', delta=dict(type='text_delta', text=reply[index:index + 40]))) for index in range(0, len(reply), 40) ]
+		events.append(chunk(dict(type='message_delta', delta=dict(stop_reason='end_turn'), usage=dict(output_tokens=usage['output_tokens']))))
+		events.append(chunk(dict(type='message_stop')))
+		return { 'body': StreamBody(events) }
+
+# ---------------------------------------------------------------------------
+# Gitlab
+# ---------------------------------------------------------------------------
+
+def blob_id(content):
+	data = content.encode('utf-8')
+	return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+class SyntheticRepository:
+	"""
+	合成的Python项目，有base和head两个commit，head中修改了changed个文件。
+	"""
+	def __init__(self, files, lines, changed, directories, seed):
+		rand = random.Random(seed)
+		self.directories = directories
+		self.commits = dict(base={}, head={})
+		for index in range(files):
+			path = f'src/pkg{index % directories}/sub{index % 3}/module_{index}.py'
+			self.commits['base'][path] = self.make_file(rand, index, lines)
+		self.commits['head'] = dict(self.commits['base'])
+		for path in rand.sample(sorted(self.commits['base']), min(changed, files)):
+			lines_of = self.commits['base'][path].split('\n')
+			position = rand.randrange(len(lines_of))
+			lines_of[position:position + 1] = [ f'    value = compute(value, {rand.randrange(1000)})  # changed' ] * 3
+			self.commits['head'][path] = '\n'.join(lines_of)
+		self.commits['head']['.codereview.yaml'] = 'target: src/**/*.py\nbusiness: benchmark\n'
+		self.commits['base']['.codereview.yaml'] = self.commits['head']['.codereview.yaml']
+
+	def make_file(self, rand, index, lines):
+		output = [ f'"""Module {index} of the synthetic benchmark project."""', 'import os, json' ]
+		if index > 0:
+			# 每个模块导入前一个模块，使依赖索引有边可用
+			previous = index - 1
+			output.append(f'from src.pkg{previous % self.directories}.sub{previous % 3}.module_{previous} import function_3')
+		output.append('')
+		while len(output) < lines:
+			name = f'function_{len(output)}'
+			output += [ f'def {name}(value):', f'    value = value * {rand.randrange(1, 100)} + {rand.randrange(100)}',
+				'    if value > 1000:', '        return json.dumps(dict(value=value))', '    return str(value)', '' ]
+		return '\n'.join(output[:lines])
+
+	def files(self, ref):
+		if ref not in self.commits:
+			raise Exception(f'404 Commit Not Found: {ref}')
+		return self.commits[ref]
+
+class FakeProject:
+	def __init__(self, url, repository):
+		self.repository = repository
+		self.manager = types.SimpleNamespace(gitlab=types.SimpleNamespace(url=url))
+		self.files = types.SimpleNamespace(raw=self.raw, head=self.head)
+
+	def raw(self, file_path, ref):
+		count_call('gitlab.files.raw')
+		files = self.repository.files(ref)
+		if file_path not in files:
+			raise Exception(f'404 File Not Found: {file_path}')
+		return files[file_path].encode('utf-8')
+
+	def head(self, file_path, ref):
+		count_call('gitlab.files.head')
+		files = self.repository.files(ref)
+		if file_path not in files:
+			raise Exception(f'404 File Not Found: {file_path}')
+		return { 'X-Gitlab-Blob-Id': blob_id(files[file_path]) }
+
+	def repository_tree(self, ref, all=False, recursive=False):
+		count_call('gitlab.repository_tree')
+		return [ dict(path=path, id=blob_id(content), type='blob') for path, content in sorted(self.repository.files(ref).items()) ]
+
+	def repository_archive(self, sha, format='tar.gz', streamed=False, action=None):
+		count_call('gitlab.repository_archive')
+		buffer = io.BytesIO()
+		with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+			for path, content in sorted(self.repository.files(sha).items()):
+				data = content.encode('utf-8')
+				info = tarfile.TarInfo(f'project-{sha}/{path}')
+				info.size = len(data)
+				tar.addfile(info, io.BytesIO(data))
+		data = buffer.getvalue()
+		for index in range(0, len(data), 64 * 1024):
+			action(data[index:index + 64 * 1024])
+
+	def repository_compare(self, from_, to):
+		count_call('gitlab.repository_compare')
+		before, after = self.repository.files(from_), self.repository.files(to)
+		diffs = []
+		for path in sorted(set(before) | set(after)):
+			if before.get(path) == after.get(path): continue
+			diff = '\n'.join(difflib.unified_diff((before.get(path) or '').split('\n'), (after.get(path) or '').split('\n'), lineterm='', n=0))
+			diffs.append(dict(old_path=path, new_path=path, diff=diff, new_file=path not in before, deleted_file=path not in after, renamed_file=False))
+		return dict(diffs=diffs)
+
+def make_gitlab_module(projects):
+	module = types.ModuleType('gitlab')
+	class Gitlab:
+		def __init__(self, url=None, private_token=None, **kwargs):
+			self.url = url
+			self.projects = types.SimpleNamespace(get=lambda project_id: FakeProject(url, projects[str(project_id)]))
+	module.Gitlab = Gitlab
+	return module
+
+# ---------------------------------------------------------------------------
+# 运行
+# ---------------------------------------------------------------------------
+
+TABLES = dict(
+	REQUEST_TABLE = ('bench-request', [ 'commit_id', 'request_id' ]),
+	TASK_TABLE = ('bench-task', [ 'request_id', 'number' ]),
+	RULE_TABLE = ('bench-rule', [ 'mode', 'number' ]),
+	REPOSITORY_TABLE = ('bench-repo', [ 'repository_url', 'branch_regexp' ]),
+	RESULT_CACHE_TABLE = ('bench-result-cache', [ 'cache_key' ]),
+)
+
+def install_fakes(args):
+	"""
+	设置环境变量并把boto3、gitlab替换为内存替身，必须在导入lambda模块之前调用。
+	"""
+	environment = dict(
+		TASK_SQS_URL = 'https://sqs.local/bench-task',
+		SNS_TOPIC_ARN = 'arn:aws:sns:local:000000000000:bench-report',
+		BUCKET_NAME = 'bench-report',
+		PAYLOAD_BUCKET = 'bench-report',
+		TASK_DISPATCHER_FUN_NAME = 'bench-dispatcher',
+		BLOB_CACHE_LOCAL_DIR = tempfile.mkdtemp(prefix='bench-blob-cache-'),
+		LOG_LEVEL = 'INFO' if args.verbose else 'ERROR',
+		BEDROCK_STREAMING = 'true' if args.streaming else 'false',
+		BEDROCK_INITIAL_CONCURRENCY = str(args.bedrock_concurrency),
+		SQS_RECORD_CONCURRENCY = str(args.record_concurrency),
+		GITLAB_SNAPSHOT_MODE = args.snapshot,
+		REQUEST_DEDUPE_SECONDS = '86400' if args.dedupe else '0',
+	)
+	for name, (table, _) in TABLES.items():
+		environment[name] = table
+	if not args.result_cache:
+		environment['RESULT_CACHE_TABLE'] = ''
+	for key, value in environment.items():
+		os.environ.setdefault(key, value)
+
+	services = dict(
+		dynamodb = FakeDynamoDB({ table: keys for table, keys in TABLES.values() }),
+		s3 = FakeS3(),
+		sqs = FakeSQS(args.visibility_timeout),
+		sns = FakeSNS(),
+		lambda_client = FakeLambda(),
+		bedrock = FakeBedrock(args.bedrock_latency, args.throttle_rate, args.findings, args.seed),
+	)
+	lookup = { 'dynamodb': services['dynamodb'], 's3': services['s3'], 'sqs': services['sqs'], 'sns': services['sns'],
+		'lambda': services['lambda_client'], 'bedrock-runtime': services['bedrock'] }
+	boto3 = types.ModuleType('boto3')
+	boto3.client = lambda service_name=None, *args, **kwargs: lookup[service_name]
+	boto3.resource = lambda service_name=None, *args, **kwargs: lookup[service_name]
+	boto3.session = types.SimpleNamespace(Session=lambda *args, **kwargs: boto3)
+	sys.modules['boto3'] = boto3
+
+	repository = SyntheticRepository(args.files, args.lines, args.changed, args.directories, args.seed)
+	sys.modules['gitlab'] = make_gitlab_module({ '1': repository })
+	sys.path.insert(0, LAMBDA_DIR)
+	return services
+
+def make_webhook_event(index):
+	body = dict(
+		object_kind = 'push',
+		ref = 'refs/heads/main',
+		before = 'base',
+		after = 'head',
+		user_username = f'bench{index}',
+		project = dict(id=1, name='Benchmark Project', web_url='https://gitlab.local/bench/project', path_with_namespace='bench/project'),
+	)
+	return dict(body=json.dumps(body), headers={ 'X-Gitlab-Token': 'bench-token', 'X-Gitlab-Event-UUID': f'bench-delivery-{index}' })
+
+def drain_queue(task_executor, sqs, args, stages):
+	"""
+	模拟SQS事件源：每轮最多启动lambda_concurrency个并发调用，每个调用最多batch_size条消息，失败的消息按可见性超时重新投递。
+	"""
+	rounds = 0
+	with ThreadPoolExecutor(max_workers=args.lambda_concurrency) as executor:
+		while sqs.messages and rounds < args.max_rounds:
+			batches = []
+			for _ in range(args.lambda_concurrency):
+				records = sqs.receive(args.batch_size)
+				if not records: break
+				batches.append(records)
+			if not batches:
+				sqs.fast_forward()
+				continue
+			rounds += 1
+
+			def invoke(records):
+				start = time.perf_counter()
+				response = task_executor.lambda_handler(dict(Records=records), FakeContext(args.lambda_timeout))
+				failures = set(item['itemIdentifier'] for item in response.get('batchItemFailures', []))
+				for record in records:
+					if record['messageId'] not in failures:
+						sqs.delete_message(QueueUrl=None, ReceiptHandle=record['receiptHandle'])
+				return time.perf_counter() - start
+
+			for duration in executor.map(invoke, batches):
+				stages['executor_invocation'].append(duration)
+	return rounds
+
+def run(args):
+	services = install_fakes(args)
+	import request_handler, task_dispatcher, task_executor
+
+	# 初始化规则和仓库配置
+	for rule in json.load(open(os.path.join(LAMBDA_DIR, 'rules.json'))):
+		services['dynamodb'].Table(os.environ['RULE_TABLE']).put_item(Item=rule)
+	services['dynamodb'].Table(os.environ['REPOSITORY_TABLE']).put_item(Item={
+		'repository_url': 'https://gitlab.local/bench/project', 'branch_regexp': '.*', 'event_push': args.mode,
+	})
+	calls.clear()
+
+	stages = collections.defaultdict(list)
+	if args.tracemalloc:
+		tracemalloc.start()
+	start = time.perf_counter()
+
+	sink = io.StringIO() if not args.verbose else sys.stdout
+	with contextlib.redirect_stdout(sink):
+		for index in range(args.requests):
+			begin = time.perf_counter()
+			request_handler.lambda_handler(make_webhook_event(index), FakeContext(args.lambda_timeout))
+			stages['webhook'].append(time.perf_counter() - begin)
+			# 模拟Gitlab重试投递同一个事件
+			for _ in range(args.redeliveries):
+				begin = time.perf_counter()
+				request_handler.lambda_handler(make_webhook_event(index), FakeContext(args.lambda_timeout))
+				stages['webhook_redelivery'].append(time.perf_counter() - begin)
+
+		invocations = services['lambda_client'].invocations
+		while invocations:
+			begin = time.perf_counter()
+			task_dispatcher.lambda_handler(invocations.pop(0), FakeContext(args.lambda_timeout))
+			stages['dispatch'].append(time.perf_counter() - begin)
+
+		begin = time.perf_counter()
+		rounds = drain_queue(task_executor, services['sqs'], args, stages)
+		stages['execute'].append(time.perf_counter() - begin)
+
+	elapsed = time.perf_counter() - start
+	traced_peak = tracemalloc.get_traced_memory()[1] if args.tracemalloc else None
+
+	requests = [ item for item in services['dynamodb'].Table(os.environ['REQUEST_TABLE']).items.values() if not item['request_id'].startswith('#') ]
+	summary = collections.Counter()
+	for item in requests:
+		summary.update(item.get('metrics', {}))
+	tasks = sum(item.get('task_total', 0) for item in requests)
+
+	return dict(
+		config = vars(args),
+		elapsed_seconds = round(elapsed, 3),
+		requests = len(requests),
+		reports = sum(1 for item in requests if item.get('report_status') == 'Complete'),
+		tasks = dict(total=tasks, complete=sum(item.get('task_complete', 0) for item in requests), failure=sum(item.get('task_failure', 0) for item in requests)),
+		throughput = dict(requests_per_second=round(len(requests) / elapsed, 3), tasks_per_second=round(tasks / elapsed, 3)),
+		executor_rounds = rounds,
+		stages = { name: dict(count=len(values), total=round(sum(values), 3), max=round(max(values), 3)) for name, values in stages.items() },
+		request_metrics = dict(sorted(summary.items())),
+		bedrock = dict(tokens=dict(services['bedrock'].tokens), distinct_prefixes=len(services['bedrock'].prefixes), prefix_uses=sum(services['bedrock'].prefixes.values())),
+		memory = dict(max_rss_mb=round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1), traced_peak_mb=round(traced_peak / 1024 / 1024, 1) if traced_peak is not None else None),
+		api_calls = dict(sorted(calls.items())),
+	)
+
+def print_result(result):
+	config = result['config']
+	print(f"Benchmark: mode={config['mode']}, requests={config['requests']}, files={config['files']}x{config['lines']} lines, changed={config['changed']}")
+	print(f"Elapsed: {result['elapsed_seconds']}s, requests: {result['requests']}, reports: {result['reports']}, tasks: {result['tasks']}")
+	print(f"Throughput: {result['throughput']['requests_per_second']} requests/s, {result['throughput']['tasks_per_second']} tasks/s, executor rounds: {result['executor_rounds']}")
+	print(f"Memory: max RSS {result['memory']['max_rss_mb']} MB, traced peak {result['memory']['traced_peak_mb']} MB")
+	print('\nWall clock per stage (seconds):')
+	for name, stage in result['stages'].items():
+		print(f"  {name:<24} count={stage['count']:<6} total={stage['total']:<10} max={stage['max']}")
+	print('\nRequest metrics (sum of REQUEST_TABLE.metrics):')
+	for name, value in result['request_metrics'].items():
+		print(f'  {name:<24} {value}')
+	print('\nBedrock:', json.dumps(result['bedrock']))
+	print('\nAPI calls:')
+	for name, value in result['api_calls'].items():
+		print(f'  {name:<40} {value}')
+
+def parse_args():
+	parser = argparse.ArgumentParser(description='Offline end-to-end benchmark of the code reviewer lambdas.')
+	parser.add_argument('--mode', choices=[ 'all', 'single', 'diff' ], default='all')
+	parser.add_argument('--requests', type=int, default=1, help='number of webhook requests')
+	parser.add_argument('--redeliveries', type=int, default=0, help='extra deliveries of each webhook, as Gitlab retries')
+	parser.add_argument('--dedupe', action='store_true', help='merge requests for the same commit (all benchmark requests use the same commits)')
+	parser.add_argument('--files', type=int, default=200, help='number of files in the synthetic repository')
+	parser.add_argument('--lines', type=int, default=200, help='lines per file')
+	parser.add_argument('--changed', type=int, default=20, help='number of files changed between the two commits')
+	parser.add_argument('--directories', type=int, default=10, help='number of top level packages')
+	parser.add_argument('--snapshot', choices=[ 'archive', 'files' ], default='archive', help='GITLAB_SNAPSHOT_MODE')
+	parser.add_argument('--bedrock-latency', type=float, default=0.05, help='seconds per Bedrock call')
+	parser.add_argument('--throttle-rate', type=float, default=0.0, help='probability that a Bedrock call is throttled')
+	parser.add_argument('--findings', type=int, default=2, help='findings per Bedrock reply')
+	parser.add_argument('--bedrock-concurrency', type=int, default=4, help='BEDROCK_INITIAL_CONCURRENCY')
+	parser.add_argument('--streaming', action=argparse.BooleanOptionalAction, default=True, help='BEDROCK_STREAMING')
+	parser.add_argument('--result-cache', action=argparse.BooleanOptionalAction, default=True, help='use the result cache table')
+	parser.add_argument('--lambda-concurrency', type=int, default=4, help='concurrent executor invocations')
+	parser.add_argument('--batch-size', type=int, default=10, help='SQS records per executor invocation')
+	parser.add_argument('--record-concurrency', type=int, default=10, help='SQS_RECORD_CONCURRENCY')
+	parser.add_argument('--visibility-timeout', type=int, default=900)
+	parser.add_argument('--lambda-timeout', type=int, default=900)
+	parser.add_argument('--max-rounds', type=int, default=100000)
+	parser.add_argument('--seed', type=int, default=0)
+	parser.add_argument('--tracemalloc', action='store_true', help='trace Python allocations (slower)')
+	parser.add_argument('--verbose', action='store_true', help='show lambda logs')
+	parser.add_argument('--json', action='store_true', help='print the result as JSON')
+	return parser.parse_args()
+
+if __name__ == '__main__':
+	args = parse_args()
+	result = run(args)
+	if args.json:
+		print(json.dumps(result, indent=2, ensure_ascii=False))
+	else:
+		print_result(result)
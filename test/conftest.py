@@ -0,0 +1,5 @@
+import os, sys
+
+# Lambda代码以扁平模块的方式部署，测试时直接从lambda目录导入
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'lambda'))
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
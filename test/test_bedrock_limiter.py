@@ -0,0 +1,45 @@
+from concurrent.futures import ThreadPoolExecutor
+from botocore.stub import Stubber
+import bedrock_limiter
+
+def run_in_worker(function):
+	# 模拟task_executor中的record_executor：limiter在导入线程创建，在工作线程中使用
+	with ThreadPoolExecutor(max_workers=1) as executor:
+		return executor.submit(function).result()
+
+def stub_worker(responses):
+	client = bedrock_limiter.dynamodb.meta.client
+	stubber = Stubber(client)
+	for method, response in responses:
+		if response is None:
+			stubber.add_client_error(method, service_error_code='ConditionalCheckFailedException', http_status_code=400)
+		else:
+			stubber.add_response(method, response)
+	stubber.activate()
+	return stubber
+
+def test_acquire_when_state_exists():
+	limiter = bedrock_limiter.DynamoDBLimiter('limiter')
+	def acquire():
+		stubber = stub_worker([ ('put_item', None), ('update_item', {}) ])
+		with stubber:
+			return limiter.acquire('claude3')
+	assert run_in_worker(acquire) is True
+
+def test_acquire_when_limit_is_full():
+	limiter = bedrock_limiter.DynamoDBLimiter('limiter')
+	def acquire():
+		stubber = stub_worker([ ('put_item', None), ('update_item', None), ('update_item', None) ])
+		with stubber:
+			return limiter.acquire('claude3')
+	assert run_in_worker(acquire) is False
+
+def test_release_without_slot():
+	limiter = bedrock_limiter.DynamoDBLimiter('limiter')
+	item = { 'model': { 'S': 'claude3' }, 'in_flight': { 'N': '0' }, 'limit': { 'N': '4' } }
+	def release():
+		stubber = stub_worker([ ('update_item', None), ('get_item', { 'Item': item }), ('update_item', None) ])
+		with stubber:
+			limiter.release('claude3', throttled=True)
+			stubber.assert_no_pending_responses()
+	run_in_worker(release)
@@ -0,0 +1,26 @@
+import os
+import blob_cache
+
+def reset(monkeypatch, directory):
+	monkeypatch.setattr(blob_cache, 'BLOB_CACHE_LOCAL_DIR', str(directory))
+	monkeypatch.setattr(blob_cache, 'BLOB_CACHE_BUCKET', None)
+	monkeypatch.setattr(blob_cache, 'local_index', None)
+	monkeypatch.setattr(blob_cache, 'local_size', 0)
+
+def test_local_cache_hit(tmp_path, monkeypatch):
+	reset(monkeypatch, tmp_path)
+	assert blob_cache.get_blob('a' * 40, lambda: 'content') == 'content'
+	assert blob_cache.get_blob('a' * 40, lambda: None) == 'content'
+
+def test_unusable_cache_dir_still_returns_content(tmp_path, monkeypatch):
+	path = tmp_path / 'not-a-dir'
+	path.write_text('')
+	reset(monkeypatch, path)
+	assert blob_cache.get_blob('b' * 40, lambda: 'content') == 'content'
+	blob_cache.put_blob('c' * 40, 'content')
+
+def test_failed_write_is_not_indexed(tmp_path, monkeypatch):
+	reset(monkeypatch, tmp_path)
+	monkeypatch.setattr(blob_cache, 'get_local_path', lambda sha: os.path.join(str(tmp_path), 'missing', sha))
+	assert blob_cache.get_blob('d' * 40, lambda: 'content') == 'content'
+	assert blob_cache.local_index == {} and blob_cache.local_size == 0
@@ -0,0 +1,97 @@
+import blob_cache, codelib, dependency_index
+
+def build(files):
+	return dependency_index.DependencyIndex({ path: dependency_index.extract(path, content) for path, content in files.items() }, {})
+
+def test_python_from_imports_on_consecutive_lines():
+	summary = dependency_index.extract_python('m.py', 'from a import x\nfrom b import y\nfrom c import z\n')
+	assert summary['imports'] == [ [ 'a.x', 'a' ], [ 'b.y', 'b' ], [ 'c.z', 'c' ] ]
+
+def test_python_parenthesized_and_commented_imports():
+	summary = dependency_index.extract_python('m.py', 'from a import (\n    x,  # first\n    y as z,\n)\nimport b.c as d, e\nfrom f import g  # note\n')
+	assert summary['imports'] == [ [ 'b.c' ], [ 'e' ], [ 'a.x', 'a' ], [ 'a.y', 'a' ], [ 'f.g', 'f' ] ]
+
+def test_python_relative_imports():
+	index = build({
+		'pkg/a.py': 'import os\nfrom .b import thing\nfrom .c import func\nfrom .. import top\n',
+		'pkg/b.py': 'def thing(): pass\n',
+		'pkg/c.py': 'def func(): pass\n',
+		'top.py': '',
+	})
+	assert index.dependencies['pkg/a.py'] == { 'pkg/b.py', 'pkg/c.py', 'top.py' }
+	assert index.dependents['pkg/c.py'] == { 'pkg/a.py' }
+
+def test_python_source_root():
+	index = build({
+		'src/app/main.py': 'from app.service import run\n',
+		'src/app/service.py': 'def run(): pass\n',
+	})
+	assert index.get_related([ 'src/app/main.py' ]) == [ 'src/app/service.py' ]
+	assert index.get_related([ 'src/app/service.py' ]) == [ 'src/app/main.py' ]
+
+def test_java_imports_and_same_package():
+	index = build({
+		'src/com/x/Foo.java': 'package com.x;\nimport com.y.Bar;\npublic class Foo { Baz b; Bar r; }',
+		'src/com/x/Baz.java': 'package com.x;\nclass Baz {}',
+		'src/com/y/Bar.java': 'package com.y;\nimport static com.x.Foo.run;\npublic class Bar {}',
+	})
+	assert index.dependencies['src/com/x/Foo.java'] == { 'src/com/x/Baz.java', 'src/com/y/Bar.java' }
+	assert index.dependencies['src/com/y/Bar.java'] == { 'src/com/x/Foo.java' }
+
+def test_javascript_relative_imports():
+	index = build({
+		'web/app.ts': "import { h } from './util.js';\nconst z = require('../lib')\nimport React from 'react'\n",
+		'web/util.ts': 'export const h = 1',
+		'lib/index.js': 'module.exports = {}',
+	})
+	assert index.dependencies['web/app.ts'] == { 'web/util.ts', 'lib/index.js' }
+
+def test_go_qualified_references():
+	index = build({
+		'cmd/main.go': 'package main\nimport (\n\t"example.com/m/internal/store"\n\t"fmt"\n)\nfunc main() { store.Open(); fmt.Println() }',
+		'internal/store/db.go': 'package store\nfunc Open() {}',
+		'internal/store/other.go': 'package store\nfunc Close() {}',
+	})
+	assert index.dependencies['cmd/main.go'] == { 'internal/store/db.go' }
+
+def test_related_files_of_a_batch():
+	index = build({
+		'app/a.py': 'from app import b\n',
+		'app/b.py': 'from app import c\n',
+		'app/c.py': '',
+		'app/d.py': 'from app import a\n',
+	})
+	assert index.get_related([ 'app/a.py', 'app/b.py' ]) == [ 'app/c.py', 'app/d.py' ]
+
+FILES = {
+	'app/a.py': 'from app import b\n',
+	'app/b.py': 'def run(): pass\n',
+	'README.md': '',
+}
+
+def fake_repository(monkeypatch, tmp_path, archive):
+	calls = []
+	monkeypatch.setattr(blob_cache, 'BLOB_CACHE_LOCAL_DIR', str(tmp_path))
+	monkeypatch.setattr(blob_cache, 'BLOB_CACHE_BUCKET', None)
+	monkeypatch.setattr(blob_cache, 'local_index', None)
+	monkeypatch.setattr(dependency_index, 'CONTEXT_ARCHIVE_MIN_FILES', 1)
+	monkeypatch.setattr(codelib, 'get_repository_blobs', lambda repo_context, commit_id: { path: path.replace('/', '-') for path in FILES })
+	monkeypatch.setattr(codelib, 'is_archive_enabled', lambda repo_context: archive)
+	monkeypatch.setattr(codelib, 'iter_project_files', lambda repo_context, commit_id, targets: calls.append('archive') or iter(FILES.items()))
+	monkeypatch.setattr(codelib, 'get_repository_blob', lambda repo_context, path, blob_id, commit_id: calls.append(path) or FILES[path])
+	return calls
+
+def test_build_index_from_archive_then_cache(monkeypatch, tmp_path):
+	calls = fake_repository(monkeypatch, tmp_path, archive=True)
+	index = dependency_index.build_index({}, 'c1', [ '**' ])
+	assert index.dependencies['app/a.py'] == { 'app/b.py' }
+	assert calls == [ 'archive' ]
+	# 摘要已缓存，再次建立索引不再获取文件
+	dependency_index.build_index({}, 'c1', [ '**' ])
+	assert calls == [ 'archive' ]
+
+def test_build_index_without_archive(monkeypatch, tmp_path):
+	calls = fake_repository(monkeypatch, tmp_path, archive=False)
+	index = dependency_index.build_index({}, 'c1', [ '**' ])
+	assert index.dependencies['app/a.py'] == { 'app/b.py' }
+	assert sorted(calls) == [ 'app/a.py', 'app/b.py' ]
@@ -0,0 +1,62 @@
+import json
+import pytest
+import findings_parser
+
+FINDINGS = [
+	{ 'title': 'Array size', 'content': 'Fix:\n```java\nint[] a = new int[3];\n```', 'filepath': 'A.java' },
+	{ 'title': 'Braces', 'content': 'Use:\n```java\nif (x) { b(); }\n```', 'filepath': 'B.java' },
+]
+
+def test_plain_array():
+	assert findings_parser.extract_findings(json.dumps(FINDINGS)) == FINDINGS
+
+def test_code_blocks_in_content_with_outer_fence():
+	reply = '```json\n' + json.dumps(FINDINGS, indent=2) + '\n```'
+	assert findings_parser.extract_findings(reply) == FINDINGS
+
+def test_code_blocks_in_content_with_surrounding_text():
+	reply = 'Here are the findings [2 in total]:\n```json\n' + json.dumps(FINDINGS) + '\n```\nHope it helps.'
+	assert findings_parser.extract_findings(reply) == FINDINGS
+
+def test_truncated_reply():
+	reply = '```json\n' + json.dumps(FINDINGS)[:-20]
+	assert findings_parser.extract_findings(reply) == FINDINGS[:1]
+
+def test_empty_array():
+	assert findings_parser.extract_findings('```json\n[]\n```') == []
+
+def test_single_object():
+	assert findings_parser.extract_findings(json.dumps(FINDINGS[0])) == [ FINDINGS[0] ]
+
+def test_python_literal():
+	assert findings_parser.extract_findings(repr(FINDINGS)) == FINDINGS
+
+def test_no_findings():
+	with pytest.raises(ValueError):
+		findings_parser.extract_findings('No issues found.')
+
+def test_stream_yields_objects_incrementally():
+	stream = findings_parser.FindingsStream()
+	text = '```json\n' + json.dumps(FINDINGS) + '\n```'
+	found = []
+	for index in range(0, len(text), 7):
+		found += stream.feed(text[index:index + 7])
+	assert found == FINDINGS
+	assert stream.is_complete()
+
+def test_stream_skips_bracketed_preamble():
+	stream = findings_parser.FindingsStream()
+	text = 'Here are the findings [2 in total]:\n```json\n' + json.dumps(FINDINGS)
+	found = []
+	for index in range(0, len(text), 5):
+		found += stream.feed(text[index:index + 5])
+	assert found == FINDINGS
+	assert stream.is_complete()
+
+def test_truncated_reply_with_bracketed_preamble():
+	reply = 'Here are the findings [2 in total]:\n```json\n' + json.dumps(FINDINGS)[:-20]
+	assert findings_parser.extract_findings(reply) == FINDINGS[:1]
+
+def test_only_bracketed_text():
+	with pytest.raises(ValueError):
+		findings_parser.extract_findings('See rule [3] and [a, b].')
@@ -0,0 +1,47 @@
+import types
+import gitlab_code
+
+DIFF = '@@ -1,2 +1,3 @@\n a\n+b\n c\n'
+
+def make_diff(path, old_path=None, deleted=False, renamed=False):
+	return dict(new_path=path, old_path=old_path or path, deleted_file=deleted, renamed_file=renamed, diff=DIFF)
+
+class FakeProject:
+	def __init__(self, compare=None, commits=()):
+		self.compare = compare
+		self.calls = []
+		commits = { commit.id: commit for commit in commits }
+		self.commits = types.SimpleNamespace(
+			get = lambda commit_id: self.record('get', commit_id) or commits[commit_id],
+			list = lambda ref_name, all=False: self.record('list', ref_name) or list(commits.values())[::-1],
+		)
+
+	def record(self, *call):
+		self.calls.append(call)
+
+	def repository_compare(self, from_, to):
+		self.record('compare', from_, to)
+		if self.compare is None:
+			raise Exception('404 Not Found')
+		return dict(diffs=self.compare)
+
+def make_commit(commit_id, diffs):
+	return types.SimpleNamespace(id=commit_id, diff=lambda all=False: diffs)
+
+def test_compare_returns_hunks():
+	project = FakeProject(compare=[ make_diff('a.py'), make_diff('b.py', deleted=True) ])
+	assert gitlab_code.get_involved_changes(project, 'base', 'head') == { 'a.py': [ (1, 3) ] }
+
+def test_compare_failure_falls_back_to_commits():
+	project = FakeProject(commits=[
+		make_commit('c1', [ make_diff('a.py'), make_diff('old.py') ]),
+		make_commit('c2', [ make_diff('new.py', old_path='old.py', renamed=True), make_diff('gone.py', deleted=True) ]),
+	])
+	assert gitlab_code.get_involved_changes(project, 'base', 'head') == { 'a.py': [], 'new.py': [] }
+	assert gitlab_code.get_diff_files(project, 'base', 'head') == [ 'a.py', 'new.py' ]
+
+def test_new_branch_uses_head_commit():
+	project = FakeProject(compare=[], commits=[ make_commit('head', [ make_diff('a.py') ]) ])
+	assert gitlab_code.get_involved_changes(project, '0' * 40, 'head') == { 'a.py': [] }
+	assert ('get', 'head') in project.calls
+	assert not any(call[0] == 'compare' for call in project.calls)
@@ -0,0 +1,72 @@
+import re
+import pytest
+import base
+
+def old_match_glob_pattern(string, pattern):
+	# 改为GlobMatcher之前的实现，用于对比匹配结果
+	regex = re.escape(pattern)
+	regex = regex.replace(r'\*\*', '.*')
+	regex = regex.replace(r'\*', '[^/]*')
+	regex = regex.replace(r'\?', '.')
+	return bool(re.match(regex, string))
+
+@pytest.mark.parametrize('pattern, path, expected', [
+	# **/ 匹配零或多层目录
+	('**/*.py', 'a.py', True),
+	('**/*.py', 'x/y/a.py', True),
+	('src/**/*.py', 'src/a.py', True),
+	('src/**/*.py', 'src/x/y/a.py', True),
+	('src/**/*.py', 'lib/a.py', False),
+	# 匹配到路径末尾
+	('*.py', 'a.py', True),
+	('*.py', 'a.pyc', False),
+	('**/*.java', 'src/A.java.bak', False),
+	# * 和 ? 不跨越目录
+	('*.py', 'x/a.py', False),
+	('a?.py', 'ab.py', True),
+	('a?.py', 'a/.py', False),
+	# 匹配到目录时包含整个子树
+	('src', 'src/x/a.py', True),
+	('src/*', 'src/x/a.py', True),
+	('src', 'srcx/a.py', False),
+	('/src', 'src/a.py', True),
+	('**', 'a/b/c.txt', True),
+])
+def test_glob_pattern(pattern, path, expected):
+	assert base.match_glob_pattern(path, pattern) == expected
+
+@pytest.mark.parametrize('targets, path, expected', [
+	([ 'src/**', '!src/gen/**' ], 'src/gen/x.py', False),
+	([ 'src/**', '!src/gen/**' ], 'src/app/x.py', True),
+	([ 'src/**', '!src/gen' ], 'src/gen/a/b.py', False),
+	([ '**/*.py', '!**/*_test.py' ], 'src/a_test.py', False),
+	([ '**/*.py', '!**/*_test.py' ], 'src/a.py', True),
+	# 只有排除模式时包含其他所有文件
+	([ '!vendor' ], 'a.py', True),
+	([ '!vendor' ], 'vendor/x/y.go', False),
+	([ '!' ], 'a.py', True),
+	('src/**/*.py, !src/gen', 'src/gen/a.py', False),
+])
+def test_glob_targets(targets, path, expected):
+	assert base.compile_targets(targets).match(path) == expected
+
+PATHS = [ 'a.py', 'a.pyc', 'README.md', '.codereview.yaml', 'src/a.py', 'src/x/b.py', 'src/x/b.pyc', 'src/x/B.java', 'srcx/a.py', 'lib/c.py', 'test/x/d_test.py' ]
+
+@pytest.mark.parametrize('pattern, changed', [
+	# 默认target和README、压测脚本中使用的target
+	('**', []),
+	('src/**/*.py', [ 'src/a.py', 'src/x/b.pyc' ]),
+	('**/*.py', [ 'a.py', 'src/x/b.pyc' ]),
+	('**/*.java', []),
+	('*.py', [ 'a.pyc' ]),
+	('src', [ 'srcx/a.py' ]),
+])
+def test_glob_compared_with_old_matcher(pattern, changed):
+	# 旧实现只匹配前缀，**/至少匹配一层目录；差异只有**/匹配零层目录和匹配到路径末尾两处
+	assert [ path for path in PATHS if base.match_glob_pattern(path, pattern) != old_match_glob_pattern(path, pattern) ] == changed
+
+def test_pruned_directories_are_bounded(monkeypatch):
+	monkeypatch.setattr(base, 'GLOB_PRUNED_MAX_DIRS', 10)
+	matcher = base.GlobMatcher([ '**', '!gen' ])
+	assert matcher.filter([ f'd{index}/e/f.py' for index in range(50) ] + [ 'gen/a/b.py' ]) == [ f'd{index}/e/f.py' for index in range(50) ]
+	assert len(matcher.pruned) <= 10
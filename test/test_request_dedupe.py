@@ -0,0 +1,82 @@
+import time, types, datetime
+import pytest
+import request_dedupe, task_dispatcher
+
+class ConditionalCheckFailedException(Exception):
+	pass
+
+class FakeTable:
+	"""
+	只实现去重登记用到的条件：不存在、已过期或属于同一请求时可以登记；属于同一请求时可以删除。
+	"""
+	def __init__(self):
+		self.items = {}
+
+	def get_key(self, item):
+		return (item['commit_id'], item['request_id'])
+
+	def get_item(self, Key, ConsistentRead=False):
+		item = self.items.get(self.get_key(Key))
+		return { 'Item': dict(item) } if item else {}
+
+	def put_item(self, Item, ConditionExpression=None, ExpressionAttributeValues=None):
+		existing = self.items.get(self.get_key(Item))
+		if existing and existing['create_time'] >= ExpressionAttributeValues[':e'] and existing['target_request_id'] != ExpressionAttributeValues[':r']:
+			raise ConditionalCheckFailedException()
+		self.items[self.get_key(Item)] = dict(Item)
+
+	def delete_item(self, Key, ConditionExpression=None, ExpressionAttributeValues=None):
+		existing = self.items.get(self.get_key(Key))
+		if not existing or existing['target_request_id'] != ExpressionAttributeValues[':r']:
+			raise ConditionalCheckFailedException()
+		del self.items[self.get_key(Key)]
+
+	def update_item(self, Key, **kwargs):
+		pass
+
+@pytest.fixture
+def table(monkeypatch):
+	table = FakeTable()
+	fake = types.SimpleNamespace(
+		Table = lambda name: table,
+		meta = types.SimpleNamespace(client=types.SimpleNamespace(exceptions=types.SimpleNamespace(ConditionalCheckFailedException=ConditionalCheckFailedException))),
+	)
+	monkeypatch.setattr(request_dedupe, 'dynamodb', fake)
+	monkeypatch.setattr(task_dispatcher, 'dynamodb', fake)
+	return table
+
+def make_params(request_id, previous_commit_id='c0'):
+	return dict(request_id=request_id, project_id=1, commit_id='c1', previous_commit_id=previous_commit_id, mode='single')
+
+def test_duplicated_event_attaches_to_existing_request(table):
+	now = datetime.datetime.now()
+	assert request_dedupe.register_review(make_params('r1'), now) is None
+	assert request_dedupe.register_review(make_params('r2'), now) == 'r1'
+	# 同一请求重复登记(例如投递恢复)不视为重复
+	assert request_dedupe.register_review(make_params('r1'), now) is None
+	item, = table.items.values()
+	assert item['expire_time'] >= int(time.time()) + request_dedupe.REQUEST_DEDUPE_SECONDS
+
+def test_different_previous_commit_is_not_duplicated(table):
+	now = datetime.datetime.now()
+	assert request_dedupe.register_review(make_params('r1'), now) is None
+	assert request_dedupe.register_review(make_params('r2', previous_commit_id='c9'), now) is None
+
+def test_release_allows_new_request(table):
+	now = datetime.datetime.now()
+	request_dedupe.register_review(make_params('r1'), now)
+	request_dedupe.release_review(make_params('r1'))
+	assert request_dedupe.register_review(make_params('r2'), now) is None
+
+def test_release_keeps_registration_of_other_request(table):
+	now = datetime.datetime.now()
+	request_dedupe.register_review(make_params('r1'), now)
+	request_dedupe.release_review(make_params('r2'))
+	assert request_dedupe.register_review(make_params('r3'), now) == 'r1'
+
+def test_superseded_request_releases_registration(table):
+	now = datetime.datetime.now()
+	request_dedupe.register_review(make_params('r1'), now)
+	task_dispatcher.mark_superseded(make_params('r1'), 'r2')
+	assert table.items == {}
+	assert request_dedupe.register_review(make_params('r3'), now) is None